@@ -1,103 +1,347 @@
 """Functions to create compositor node setups to export render layers for compositing in Nuke
 
+Which AOVs (render passes) are exported is set by an AOV profile; see
+AOV_PROFILES. The profile of a blend file is chosen in the Nuke Export panel
+(the scene's "nuke_aov_profile"), and a blend file can add its own profiles,
+or replace the built in ones, as JSON in the scene's "nuke_aov_profiles"
+custom property; e.g.
+
+    {"COMP_LIGHT": ["rgba", "alpha", "depth", "diffuse_direct", "gloss_direct", "crypto_object"]}
+
+A shot can pick another profile with "nuke_aov_profile" in the shot list,
+which render_script.py applies before rendering; either the name of a profile
+or a list of AOVs.
+
+The bit depth and codec of each slot are set by an EXR policy, in the same way;
+see EXR_POLICIES. All the slots of a multilayer EXR File Output node share its
+format, so slots that need a different format from the rest of their node are
+split off into a File Output node of their own. benchmark_exr_policies()
+writes a sample frame under each policy and reports its size and write time:
+
+  blender -b <blend file> --python create_nuke_export_nodes.py -- benchmark <output dir> [view layer] [policy ...]
+
 """
 
 import os
+import sys
+import json
+import time
+import shutil
 import bpy
 
+# Custom properties that mark the nodes of a view layer's Nuke export setup, so
+# that setting up the view layer again reuses them, rather than adding another
+# set of nodes. The File Output nodes are "image" and "data", plus any split off
+# by the EXR policy, e.g. "image_half_piz"; render_script.py looks for those. We
+# also mark the Render Layers ("render_layers") and the multi exposure group
+# ("exposure") nodes.
+NUKE_VIEW_LAYER_NAME_PROP = "nuke_view_layer_name"
+NUKE_NODE_TYPE_PROP = "nuke_node_type"
+NUKE_NODE_TYPES = ["render_layers", "exposure", "image", "data"]
+NUKE_OUTPUT_NODE_KINDS = ["image", "data"]
+
+NUKE_EXPORT_NODE_COLOR = (0.22664183378219604, 0.5925127267837524, 0.6079999804496765)
+
+# The AOVs that we can export:
+#
+# (AOV name, view layer setting to enable, File Output node ("image" or "data"),
+#  whether it goes through the multi exposure group, [(File Output slot, Render Layers output)])
+#
+# Image AOVs can be compressed lossily (DWAA); data AOVs must be compressed
+# losslessly. The slot names are the layer names that Nuke sees.
+AOVS = [
+    ("rgba",                  None,                               "image", True,  [("rgba", "Image")]),
+    ("alpha",                 None,                               "image", False, [("alpha", "Alpha")]),
+    ("depth",                 "use_pass_z",                       "image", False, [("depth", "Depth")]),
+    ("mist",                  "use_pass_mist",                    "image", False, [("mist", "Mist")]),
+    ("diffuse_direct",        "use_pass_diffuse_direct",          "image", True,  [("diffuse_direct", "DiffDir")]),
+    ("diffuse_indirect",      "use_pass_diffuse_indirect",        "image", True,  [("diffuse_indirect", "DiffInd")]),
+    ("diffuse_color",         "use_pass_diffuse_color",           "image", True,  [("diffuse_color", "DiffCol")]),
+    ("gloss_direct",          "use_pass_glossy_direct",           "image", True,  [("gloss_direct", "GlossDir")]),
+    ("gloss_indirect",        "use_pass_glossy_indirect",         "image", True,  [("gloss_indirect", "GlossInd")]),
+    ("gloss_color",           "use_pass_glossy_color",            "image", True,  [("gloss_color", "GlossCol")]),
+    ("transmission_direct",   "use_pass_transmission_direct",     "image", True,  [("transmission_direct", "TransDir")]),
+    ("transmission_indirect", "use_pass_transmission_indirect",   "image", True,  [("transmission_indirect", "TransInd")]),
+    ("transmission_color",    "use_pass_transmission_color",      "image", True,  [("transmission_color", "TransCol")]),
+    ("emission",              "use_pass_emit",                    "image", True,  [("emission", "Emit")]),
+    ("environment",           "use_pass_environment",             "image", True,  [("environment", "Env")]),
+    ("shadow",                "use_pass_shadow",                  "image", True,  [("shadow", "Shadow")]),
+    ("position",              "use_pass_position",                "data",  False, [("position", "Position")]),
+    ("normal",                "use_pass_normal",                  "data",  False, [("normal", "Normal")]),
+    ("crypto_object",         "use_pass_cryptomatte_object",      "data",  False, [("CryptoObject", "Image"),
+                                                                                  ("CryptoObject00", "CryptoObject00"),
+                                                                                  ("CryptoObject01", "CryptoObject01"),
+                                                                                  ("CryptoObject02", "CryptoObject02")]),
+    ("crypto_material",       "use_pass_cryptomatte_material",    "data",  False, [("CryptoMaterial00", "CryptoMaterial00"),
+                                                                                  ("CryptoMaterial01", "CryptoMaterial01"),
+                                                                                  ("CryptoMaterial02", "CryptoMaterial02")]),
+    ("crypto_asset",          "use_pass_cryptomatte_asset",       "data",  False, [("CryptoAsset00", "CryptoAsset00"),
+                                                                                  ("CryptoAsset01", "CryptoAsset01"),
+                                                                                  ("CryptoAsset02", "CryptoAsset02")]),
+]
+
+# "rgba" and "alpha" are always exported, whatever the profile.
+REQUIRED_AOVS = ["rgba", "alpha"]
+
+AOV_PROFILES = {
+    "ALL":      [ aov[0] for aov in AOVS ],
+    "BEAUTY":   ["rgba", "alpha", "depth"],
+    "LIGHTING": ["rgba", "alpha", "depth", "diffuse_direct", "diffuse_indirect", "diffuse_color",
+                 "gloss_direct", "gloss_indirect", "gloss_color", "emission", "crypto_object"],
+    "DATA":     ["rgba", "alpha", "depth", "mist", "position", "normal", "crypto_object"],
+}
+DEFAULT_AOV_PROFILE = "ALL"
+
+NUKE_AOV_PROFILES_PROP = "nuke_aov_profiles"
+
+
+# EXR policies: the [bit depth, codec] of the slots of each File Output node
+# ("image" or "data"), and of any AOVs or slots that differ from their node.
+# Depth, position and the cryptomattes need full float precision; and data
+# must never be compressed lossily. (DWAA/DWAB are only lossy on the colour
+# channels of half float layers; the rest are compressed losslessly.)
+EXR_POLICIES = {
+    "FLOAT":     {"image": ["32", "DWAA"], "data": ["32", "ZIP"]},
+    "HALF":      {"image": ["16", "DWAA"], "data": ["32", "ZIP"],
+                  "depth": ["32", "ZIP"], "normal": ["16", "ZIP"]},
+    "HALF_DWAB": {"image": ["16", "DWAB"], "data": ["32", "ZIP"],
+                  "depth": ["32", "ZIP"], "normal": ["16", "ZIP"]},
+    "HALF_PIZ":  {"image": ["16", "PIZ"], "data": ["32", "PIZ"],
+                  "depth": ["32", "PIZ"], "normal": ["16", "PIZ"]},
+}
+DEFAULT_EXR_POLICY = "FLOAT"
+
+NUKE_EXR_POLICIES_PROP = "nuke_exr_policies"
+
+
+def get_aov_profiles(scene):
+    """The AOV profiles of the blend file: the built in ones, plus any in the scene's "nuke_aov_profiles" """
+    profiles = dict(AOV_PROFILES)
+    custom_profiles = scene.get(NUKE_AOV_PROFILES_PROP)
+    if custom_profiles:
+        try:
+            profiles.update(json.loads(custom_profiles))
+        except ValueError:
+            print("WARNING: Scene \"%s\" has invalid \"%s\"; ignored" % (scene.name, NUKE_AOV_PROFILES_PROP))
+    return profiles
+
+def get_aov_profile(scene, profile = None):
+    """Resolve an AOV profile to the list of AOVs it exports, in the order of AOVS
+
+    profile: The name of a profile, or a list of AOVs. By default, the profile
+             selected in the scene's Nuke Export settings.
+    """
+    if profile is None:
+        profile = getattr(scene, "nuke_aov_profile", None) or scene.get("nuke_aov_profile") or DEFAULT_AOV_PROFILE
+
+    if isinstance(profile, str):
+        try:
+            aov_names = get_aov_profiles(scene)[profile.upper() if profile.upper() in AOV_PROFILES else profile]
+        except KeyError as e:
+            raise ValueError("Unknown AOV profile \"%s\"" % profile) from e
+    else:
+        aov_names = list(profile)
+
+    unknown = set(aov_names) - set(aov[0] for aov in AOVS)
+    if unknown:
+        raise ValueError("Unknown AOVs in profile: " + ", ".join(sorted(unknown)))
+
+    return [ aov[0] for aov in AOVS if aov[0] in aov_names or aov[0] in REQUIRED_AOVS ]
+
+def get_exr_policies(scene):
+    """The EXR policies of the blend file: the built in ones, plus any in the scene's "nuke_exr_policies" """
+    policies = dict(EXR_POLICIES)
+    custom_policies = scene.get(NUKE_EXR_POLICIES_PROP)
+    if custom_policies:
+        try:
+            policies.update(json.loads(custom_policies))
+        except ValueError:
+            print("WARNING: Scene \"%s\" has invalid \"%s\"; ignored" % (scene.name, NUKE_EXR_POLICIES_PROP))
+    return policies
+
+def get_exr_policy(scene, policy = None):
+    """Resolve an EXR policy to a dict like those of EXR_POLICIES
+
+    policy: The name of a policy, or a policy dict. By default, the policy
+            selected in the scene's Nuke Export settings.
+    """
+    if policy is None:
+        policy = getattr(scene, "nuke_exr_policy", None) or scene.get("nuke_exr_policy") or DEFAULT_EXR_POLICY
+
+    if isinstance(policy, str):
+        try:
+            policy = get_exr_policies(scene)[policy.upper() if policy.upper() in EXR_POLICIES else policy]
+        except KeyError as e:
+            raise ValueError("Unknown EXR policy \"%s\"" % policy) from e
+
+    # Anything the policy leaves out is as it was before there were policies.
+    return dict(EXR_POLICIES[DEFAULT_EXR_POLICY], **policy)
+
+def get_output_node_groups(aov_names, exr_policy):
+    """Work out the File Output nodes needed to write 'aov_names' with 'exr_policy'
+
+    Returns a list of (node type, color depth, codec, [slots]). The slots of each
+    kind ("image" or "data") with the most common format go in the "image"
+    or "data" node; the others in nodes named after their format, e.g.
+    "image_half_piz".
+    """
+    groups = {}
+    for (name, _, kind, _, slots) in AOVS:
+        if name not in aov_names:
+            continue
+        for (slot, _) in slots:
+            (color_depth, exr_codec) = exr_policy.get(slot) or exr_policy.get(name) or exr_policy[kind]
+            groups.setdefault((kind, color_depth, exr_codec.upper()), []).append(slot)
+
+    result = []
+    for kind in NUKE_OUTPUT_NODE_KINDS:
+        kind_groups = sorted([ (key, slots) for (key, slots) in groups.items() if key[0] == kind ],
+                             key = lambda group: -len(group[1]))
+        for (i, ((_, color_depth, exr_codec), slots)) in enumerate(kind_groups):
+            node_type = kind if i == 0 else "%s_%s_%s" % (kind, "half" if color_depth == "16" else "float", exr_codec.lower())
+            result.append((node_type, color_depth, exr_codec, slots))
+
+    return result
+
+def get_aov_slots(aov_names, node_type):
+    """The File Output slots, in order, of the AOVs that go to the "image" or "data" node"""
+    return [ slot for (name, _, aov_node_type, _, slots) in AOVS
+                  if name in aov_names and aov_node_type == node_type
+                  for (slot, _) in slots ]
+
+# Changing a setup for a single render, e.g. by render_script.py, goes through
+# 'overrides': something with set(obj, attribute_name, value) and on_revert(fn),
+# like render_script.py's ShotOverrides, so that it can be undone afterwards.
+# Without it, the blend file is changed for good.
+
+def set_attribute(obj, attribute_name, value, overrides = None):
+    if overrides is None:
+        setattr(obj, attribute_name, value)
+    else:
+        overrides.set(obj, attribute_name, value)
+
+def new_node(scene, node_type, overrides = None):
+    node = scene.node_tree.nodes.new(node_type)
+    if overrides is not None:
+        overrides.on_revert(lambda: scene.node_tree.nodes.remove(node))
+    return node
+
+def remove_node(scene, node, overrides = None):
+    """Remove a node; or, with 'overrides', mute and untag it, so that it's no longer part of a setup"""
+    if overrides is None:
+        scene.node_tree.nodes.remove(node)
+        return
+
+    set_attribute(node, "mute", True, overrides)
+    tags = { prop: node[prop] for prop in [NUKE_VIEW_LAYER_NAME_PROP, NUKE_NODE_TYPE_PROP] if prop in node }
+    for prop in tags:
+        del node[prop]
+
+    def retag():
+        for (prop, value) in tags.items():
+            node[prop] = value
+    overrides.on_revert(retag)
+
+def link_sockets(scene, from_socket, to_socket, overrides = None):
+    """Link 'from_socket' to 'to_socket'; replacing any link it has"""
+    links = scene.node_tree.links
+    if overrides is not None:
+        old_from_sockets = [ link.from_socket for link in to_socket.links ]
+        if old_from_sockets == [from_socket]:
+            return
+
+        def unlink():
+            for link in list(to_socket.links):
+                links.remove(link)
+            for old_from_socket in old_from_sockets:
+                links.new(old_from_socket, to_socket)
+        overrides.on_revert(unlink)
+
+    links.new(from_socket, to_socket)
+
+def turn_on_aovs(scene, view_layer_name, aov_names = None, keep_passes = (), overrides = None):
+    """Enable the AOVs that we will be exporting for the given view layer, and disable the others
+
+    aov_names:   The AOVs to enable; by default, those of the scene's AOV profile.
+    keep_passes: View layer settings, e.g. "use_pass_z", to leave on whatever
+                 the profile; for passes that something else needs.
+    """
+    if aov_names is None:
+        aov_names = get_aov_profile(scene)
 
-def turn_on_aovs(scene, view_layer_name):
-    """Enable all the AOVs that we will be exporting for the given view layer"""
     view_layer = scene.view_layers[view_layer_name]
-    view_layer.use_pass_cryptomatte_object = True
-    view_layer.use_pass_cryptomatte_material = True
-    view_layer.use_pass_cryptomatte_asset = True
-    view_layer.use_pass_glossy_direct = True
-    view_layer.use_pass_glossy_indirect = True
-    view_layer.use_pass_glossy_color = True
-    view_layer.use_pass_diffuse_direct = True
-    view_layer.use_pass_diffuse_indirect = True
-    view_layer.use_pass_diffuse_color = True
-    view_layer.use_pass_z = True
-    view_layer.use_pass_mist = True
-    view_layer.use_pass_transmission_direct = True
-    view_layer.use_pass_transmission_indirect = True
-    view_layer.use_pass_transmission_color = True
-    view_layer.use_pass_emit = True
-    view_layer.use_pass_environment = True
-    view_layer.use_pass_shadow = True
-    view_layer.use_pass_position = True
-    view_layer.use_pass_normal = True
-
-def create_file_output_node(scene, base_path, view_layer_name):
+    for (name, view_layer_setting, _, _, _) in AOVS:
+        if view_layer_setting:
+            enable = name in aov_names or (view_layer_setting in keep_passes and getattr(view_layer, view_layer_setting))
+            if getattr(view_layer, view_layer_setting) != enable:
+                set_attribute(view_layer, view_layer_setting, enable, overrides)
+
+def set_file_slots(file_output_node, slot_names):
+    """Make the File Output node's slots 'slot_names'; rebuilding them only if they differ"""
+    if [ socket.name for socket in file_output_node.inputs ] == slot_names:
+        return
+
+    file_output_node.file_slots.clear()
+    for slot_name in slot_names:
+        file_output_node.file_slots.new(slot_name)
+
+def set_output_format(output_node, color_depth, exr_codec, overrides = None):
+    """Make the File Output node write multilayer EXRs with the given bit depth and codec"""
+    set_attribute(output_node.format, "file_format", "OPEN_EXR_MULTILAYER", overrides)
+    set_attribute(output_node.format, "color_depth", color_depth, overrides)
+    set_attribute(output_node.format, "exr_codec", exr_codec, overrides)
+    set_attribute(output_node.format, "color_management", "OVERRIDE", overrides)
+    set_attribute(output_node.format.linear_colorspace_settings, "name", "Linear", overrides)
+
+def create_file_output_node(scene, base_path, view_layer_name, slot_names = None,
+                            color_depth = "32", exr_codec = "DWAA", node_type = "image", overrides = None):
     """Create a file output node to export the image (i.e. not data) layers
     
     These layers can be compressed with DWAA compression.
+
+    slot_names: The slots of the image AOVs to export; by default, those of
+                the scene's AOV profile.
+    node_type:  "image", or the type of a node split off from it by the EXR
+                policy; see get_output_node_groups().
     """
-    file_output_node = scene.node_tree.nodes.new("CompositorNodeOutputFile")
+    file_output_node = new_node(scene, "CompositorNodeOutputFile", overrides)
     
-    file_output_node.file_slots.clear()
-    file_output_node.file_slots.new("rgba")  # 0
-    file_output_node.file_slots.new("alpha") # 1
-    file_output_node.file_slots.new("depth") # 2
-    file_output_node.file_slots.new("mist") # 3
-    file_output_node.file_slots.new("diffuse_direct") # 4
-    file_output_node.file_slots.new("diffuse_indirect") # 5
-    file_output_node.file_slots.new("diffuse_color") # 6
-    file_output_node.file_slots.new("gloss_direct") # 7
-    file_output_node.file_slots.new("gloss_indirect") # 8
-    file_output_node.file_slots.new("gloss_color") # 9
-    file_output_node.file_slots.new("transmission_direct") # 10
-    file_output_node.file_slots.new("transmission_indirect") # 11
-    file_output_node.file_slots.new("transmission_color") # 12
-    file_output_node.file_slots.new("emission") # 13
-    file_output_node.file_slots.new("environment") # 14
-    file_output_node.file_slots.new("shadow") # 15
-     
-    file_output_node.file_slots[0].path = "rgba"
-
-    file_output_node.format.file_format = "OPEN_EXR_MULTILAYER"
-    file_output_node.format.color_depth = "32"
-    file_output_node.format.exr_codec = "DWAA"
-    file_output_node.format.color_management = "OVERRIDE"
-    file_output_node.format.linear_colorspace_settings.name = "Linear"
+    set_file_slots(file_output_node, get_aov_slots(get_aov_profile(scene), "image") if slot_names is None else slot_names)
+
+    set_output_format(file_output_node, color_depth, exr_codec)
     
     file_output_node.base_path = base_path
 
     # Setup custom attributes for the render manager
     file_output_node["nuke_view_layer_name"] = view_layer_name
-    file_output_node["nuke_node_type"] = "image"
+    file_output_node["nuke_node_type"] = node_type
     
     return file_output_node
     
-def create_data_output_node(scene, base_path, view_layer_name):
+def create_data_output_node(scene, base_path, view_layer_name, slot_names = None,
+                            color_depth = "32", exr_codec = "ZIP", node_type = "data", overrides = None):
     """Create a file output node to export the data (i.e. non-image data) layers
     
     These layers must be compressed with a lossless compression algo.
+
+    slot_names: The slots of the data AOVs to export; by default, those of
+                the scene's AOV profile.
+    node_type:  "data", or the type of a node split off from it by the EXR
+                policy; see get_output_node_groups().
     """
 
-    data_output_node = scene.node_tree.nodes.new("CompositorNodeOutputFile")
+    data_output_node = new_node(scene, "CompositorNodeOutputFile", overrides)
     
     
-    data_output_node.file_slots.clear()
-    data_output_node.file_slots.new("position") # 0
-    data_output_node.file_slots.new("normal") # 1
-    data_output_node.file_slots.new("CryptoObject") # 2
-    data_output_node.file_slots.new("CryptoObject00") # 3
-    data_output_node.file_slots.new("CryptoObject01") # 4
-    data_output_node.file_slots.new("CryptoObject02") # 5
-
-    data_output_node.format.file_format = "OPEN_EXR_MULTILAYER"
-    data_output_node.format.color_depth = "32"
-    data_output_node.format.exr_codec = "ZIP"
-    data_output_node.format.color_management = "OVERRIDE"
-    data_output_node.format.linear_colorspace_settings.name = "Linear"
+    set_file_slots(data_output_node, get_aov_slots(get_aov_profile(scene), "data") if slot_names is None else slot_names)
+
+    set_output_format(data_output_node, color_depth, exr_codec)
     
     data_output_node.base_path = base_path
 
     # Setup custom attributes for the render manager
     data_output_node["nuke_view_layer_name"] = view_layer_name
-    data_output_node["nuke_node_type"] = "data"
+    data_output_node["nuke_node_type"] = node_type
     
     return data_output_node
 
@@ -162,99 +406,204 @@ def create_multi_exposure_group(scene):
     return group
        
     
-def setup_nodes(scene, view_layer_name, image_base_path, data_base_path):
-    """Setup and connect all the nodes needed to export multi-layer EXR for Nuke"""
+def is_nuke_node_type(node_type):
+    return node_type in NUKE_NODE_TYPES or (isinstance(node_type, str) and node_type.split("_")[0] in NUKE_OUTPUT_NODE_KINDS)
+
+def tag_node(node, view_layer_name, node_type):
+    node[NUKE_VIEW_LAYER_NAME_PROP] = view_layer_name
+    node[NUKE_NODE_TYPE_PROP] = node_type
+
+def find_nuke_export_nodes(scene, view_layer_name):
+    """Find the nodes of an existing Nuke export setup of a view layer
+
+    Returns ({node type: node}, [duplicate nodes]). If a view layer was set up
+    more than once, before setups were reused, the first node of each type is
+    kept and the others are returned as duplicates.
+
+    Setups made before the Render Layers and multi exposure nodes were marked
+    are recognised by following the links back from the File Output nodes.
+    """
+    nodes = {}
+    duplicates = []
+    for node in scene.node_tree.nodes:
+        if node.get(NUKE_VIEW_LAYER_NAME_PROP) != view_layer_name or not is_nuke_node_type(node.get(NUKE_NODE_TYPE_PROP)):
+            continue
+        if node[NUKE_NODE_TYPE_PROP] in nodes:
+            duplicates.append(node)
+        else:
+            nodes[node[NUKE_NODE_TYPE_PROP]] = node
+
+    def linked_node(to_node, socket_name, node_type):
+        if to_node is None or socket_name not in to_node.inputs:
+            return None
+        for link in to_node.inputs[socket_name].links:
+            if link.from_node.type == node_type:
+                return link.from_node
+        return None
+
+    if "exposure" not in nodes:
+        nodes["exposure"] = linked_node(nodes.get("image"), "rgba", 'GROUP')
+    if "render_layers" not in nodes:
+        nodes["render_layers"] = linked_node(nodes.get("image"), "alpha", 'R_LAYERS')
+
+    # Tag the nodes that we found by their links, so that we find them directly next time.
+    for (node_type, node) in list(nodes.items()):
+        if node is None:
+            del nodes[node_type]
+        else:
+            tag_node(node, view_layer_name, node_type)
+
+    return (nodes, duplicates)
+
+def get_split_base_path(base_path, node_type):
+    """Base path of a File Output node split off by the EXR policy, next to the node it was split from
+
+    e.g. ".../film13_main_s3_" -> ".../film13_main_s3_half_piz_" for "image_half_piz"
+    """
+    return base_path.rstrip("_") + "_" + node_type.split("_", 1)[1] + "_"
+
+def setup_nodes(scene, view_layer_name, image_base_path, data_base_path, aov_names = None, exr_policy = None, overrides = None):
+    """Setup and connect all the nodes needed to export multi-layer EXR for Nuke
+
+    Nodes of an existing setup of the view layer are reused, and duplicate File
+    Output nodes removed; so this can be run again, e.g. to change the output
+    paths, the AOV profile or the EXR policy, without writing every EXR twice.
+
+    aov_names:  The AOVs to export; by default, those of the scene's AOV profile.
+                They must have been turned on (see turn_on_aovs()), so that the
+                Render Layers node has outputs for them.
+    exr_policy: Name of the EXR policy, or policy dict; by default, the scene's.
+                See get_exr_policy().
+    overrides:  Make the changes through this, so that they can be undone; see
+                set_attribute(). Nodes are then muted rather than removed, and
+                a File Output node whose slots change is replaced.
+
+    Returns (number of nodes created, number of duplicate nodes removed)
+    """
+    if aov_names is None:
+        aov_names = get_aov_profile(scene)
+    exr_policy = get_exr_policy(scene, exr_policy)
+    output_node_groups = get_output_node_groups(aov_names, exr_policy)
     
     # Create a group that controls the exposure on multiple channels
     create_multi_exposure_group(scene)
-    
-    render_layers_node = scene.node_tree.nodes.new("CompositorNodeRLayers")
-    file_output_node = create_file_output_node(scene, image_base_path, view_layer_name)
-    data_output_node = create_data_output_node(scene, data_base_path, view_layer_name)
-    
-    multi_exposure_node = scene.node_tree.nodes.new("CompositorNodeGroup")
-    multi_exposure_node.node_tree = bpy.data.node_groups["RJK_MultiExposure"]
-    multi_exposure_node.name = "RJK_MultiExposure"
-    
-    render_layers_node.layer = view_layer_name
-    
-    links = scene.node_tree.links
 
-    links.new(multi_exposure_node.inputs["rgba"], render_layers_node.outputs["Image"])
-    links.new(multi_exposure_node.inputs["diffuse_direct"], render_layers_node.outputs["DiffDir"])
-    links.new(multi_exposure_node.inputs["diffuse_indirect"], render_layers_node.outputs["DiffInd"])
-    links.new(multi_exposure_node.inputs["diffuse_color"], render_layers_node.outputs["DiffCol"])
-    links.new(multi_exposure_node.inputs["gloss_direct"], render_layers_node.outputs["GlossDir"])
-    links.new(multi_exposure_node.inputs["gloss_indirect"], render_layers_node.outputs["GlossInd"])
-    links.new(multi_exposure_node.inputs["gloss_color"], render_layers_node.outputs["GlossCol"])
-    links.new(multi_exposure_node.inputs["transmission_direct"], render_layers_node.outputs["TransDir"])
-    links.new(multi_exposure_node.inputs["transmission_indirect"], render_layers_node.outputs["TransInd"])
-    links.new(multi_exposure_node.inputs["transmission_color"], render_layers_node.outputs["TransCol"])
-    links.new(multi_exposure_node.inputs["emission"], render_layers_node.outputs["Emit"])
-    links.new(multi_exposure_node.inputs["environment"], render_layers_node.outputs["Env"])
-    links.new(multi_exposure_node.inputs["shadow"], render_layers_node.outputs["Shadow"])
-    
-    links.new(file_output_node.inputs["rgba"], multi_exposure_node.outputs["rgba"])
-    links.new(file_output_node.inputs["alpha"], render_layers_node.outputs["Alpha"])
-    links.new(file_output_node.inputs["depth"], render_layers_node.outputs["Depth"])
-    links.new(file_output_node.inputs["mist"], render_layers_node.outputs["Mist"])
-    links.new(file_output_node.inputs["diffuse_direct"], multi_exposure_node.outputs["diffuse_direct"])
-    links.new(file_output_node.inputs["diffuse_indirect"], multi_exposure_node.outputs["diffuse_indirect"])
-    links.new(file_output_node.inputs["diffuse_color"], multi_exposure_node.outputs["diffuse_color"])
-    links.new(file_output_node.inputs["gloss_direct"], multi_exposure_node.outputs["gloss_direct"])
-    links.new(file_output_node.inputs["gloss_indirect"], multi_exposure_node.outputs["gloss_indirect"])
-    links.new(file_output_node.inputs["gloss_color"], multi_exposure_node.outputs["gloss_color"])
-    links.new(file_output_node.inputs["transmission_direct"], multi_exposure_node.outputs["transmission_direct"])
-    links.new(file_output_node.inputs["transmission_indirect"], multi_exposure_node.outputs["transmission_indirect"])
-    links.new(file_output_node.inputs["transmission_color"], multi_exposure_node.outputs["transmission_color"])
-    links.new(file_output_node.inputs["emission"], multi_exposure_node.outputs["emission"])
-    links.new(file_output_node.inputs["environment"], multi_exposure_node.outputs["environment"])
-    links.new(file_output_node.inputs["shadow"], multi_exposure_node.outputs["shadow"])
-    
-    
-    links.new(data_output_node.inputs["position"], render_layers_node.outputs["Position"])
-    links.new(data_output_node.inputs["normal"], render_layers_node.outputs["Normal"])
+    (nodes, duplicates) = find_nuke_export_nodes(scene, view_layer_name)
+    for node in duplicates:
+        remove_node(scene, node, overrides)
+
+    created = []
+
+    render_layers_node = nodes.get("render_layers")
+    if render_layers_node is None:
+        render_layers_node = new_node(scene, "CompositorNodeRLayers", overrides)
+        created.append(render_layers_node)
+
+    # One File Output node per group of slots with the same format. Nodes that
+    # the profile and policy no longer need, e.g. the data node of a profile
+    # without data AOVs, or a node split off by another policy, are removed.
+    output_nodes = {}
+    slot_output_nodes = {}
+    for (node_type, color_depth, exr_codec, slots) in output_node_groups:
+        kind = node_type.split("_")[0]
+        base_path = image_base_path if kind == "image" else data_base_path
+        if node_type != kind:
+            base_path = get_split_base_path(base_path, node_type)
+
+        output_node = nodes.get(node_type)
+        if output_node is not None and overrides is not None and [ socket.name for socket in output_node.inputs ] != slots:
+            # Rebuilding the slots can't be undone; so replace the node.
+            remove_node(scene, output_node, overrides)
+            output_node = None
+
+        if output_node is None:
+            create_output_node = create_file_output_node if kind == "image" else create_data_output_node
+            output_node = create_output_node(scene, base_path, view_layer_name, slots, color_depth, exr_codec, node_type, overrides)
+            created.append(output_node)
+        else:
+            set_file_slots(output_node, slots)
+            set_output_format(output_node, color_depth, exr_codec, overrides)
+        set_attribute(output_node, "base_path", base_path, overrides)
+
+        output_nodes[node_type] = output_node
+        for slot in slots:
+            slot_output_nodes[slot] = output_node
+
+    for (node_type, node) in nodes.items():
+        if node_type not in ["render_layers", "exposure"] and node_type not in output_nodes:
+            remove_node(scene, node, overrides)
+
+    multi_exposure_node = nodes.get("exposure")
+    if multi_exposure_node is None:
+        multi_exposure_node = new_node(scene, "CompositorNodeGroup", overrides)
+        multi_exposure_node.node_tree = bpy.data.node_groups["RJK_MultiExposure"]
+        multi_exposure_node.name = "RJK_MultiExposure"
+        created.append(multi_exposure_node)
+
+    tag_node(render_layers_node, view_layer_name, "render_layers")
+    tag_node(multi_exposure_node, view_layer_name, "exposure")
+
+    set_attribute(render_layers_node, "scene", scene, overrides)
+    set_attribute(render_layers_node, "layer", view_layer_name, overrides)
     
-    links.new(data_output_node.inputs["CryptoObject"], render_layers_node.outputs["Image"])
-    links.new(data_output_node.inputs["CryptoObject00"], render_layers_node.outputs["CryptoObject00"])
-    links.new(data_output_node.inputs["CryptoObject01"], render_layers_node.outputs["CryptoObject01"])
-    links.new(data_output_node.inputs["CryptoObject02"], render_layers_node.outputs["CryptoObject02"])
+    # Linking an input that's already linked replaces the link; so relinking an
+    # existing setup doesn't add anything.
+    for (name, _, _, use_exposure, slots) in AOVS:
+        if name not in aov_names:
+            continue
+
+        for (slot, render_layers_output) in slots:
+            output_node = slot_output_nodes[slot]
+            if use_exposure:
+                # The group's inputs and outputs are named after the slots.
+                link_sockets(scene, render_layers_node.outputs[render_layers_output], multi_exposure_node.inputs[slot], overrides)
+                link_sockets(scene, multi_exposure_node.outputs[slot], output_node.inputs[slot], overrides)
+            else:
+                link_sockets(scene, render_layers_node.outputs[render_layers_output], output_node.inputs[slot], overrides)
+
+    # Leave an existing setup where it is; the user may have arranged it.
+    if not created:
+        return (0, len(duplicates))
     
     # Position and colour nodes
     #
     Vector = render_layers_node.location.__class__
     Color = render_layers_node.color.__class__
 
-    # Find left-most node/bottom-most node
-    x = min ( node.location[0] for node in scene.node_tree.nodes )
-    y = min ( (node.location[1] - node.dimensions[1]) for node in scene.node_tree.nodes )
-
-    render_layers_node.location = Vector((x, y))
-    file_output_node.location = render_layers_node.location + Vector((1000,0))
-    multi_exposure_node.location = render_layers_node.location + Vector((500,0))
-    data_output_node.location = file_output_node.location - Vector((0, 500))
-    file_output_node.color = Color((0.22664183378219604, 0.5925127267837524, 0.6079999804496765))
-    data_output_node.color = Color((0.22664183378219604, 0.5925127267837524, 0.6079999804496765))
-    file_output_node.use_custom_color = True
-    data_output_node.use_custom_color = True
+    if render_layers_node in created:
+        # Find left-most node/bottom-most node
+        x = min ( node.location[0] for node in scene.node_tree.nodes )
+        y = min ( (node.location[1] - node.dimensions[1]) for node in scene.node_tree.nodes )
+        render_layers_node.location = Vector((x, y))
+
+    if multi_exposure_node in created:
+        multi_exposure_node.location = render_layers_node.location + Vector((500,0))
+    # The File Output nodes in a column to the right; "image" at the top, then the
+    # nodes split off from it, then "data", and so on.
+    for (i, output_node) in enumerate(output_nodes.values()):
+        if output_node in created:
+            output_node.location = render_layers_node.location + Vector((1000, -500 * i))
+        set_attribute(output_node, "color", Color(NUKE_EXPORT_NODE_COLOR), overrides)
+        set_attribute(output_node, "use_custom_color", True, overrides)
     
     # Setup a driver to link the exposure to the color management setting.
     # - https://blender.stackexchange.com/questions/39127/how-to-put-together-a-driver-with-python#39129
     # - https://docs.blender.org/api/current/bpy.types.DriverTarget.html
     #
-    d = multi_exposure_node.inputs["Exposure"].driver_add("default_value").driver
-    v = d.variables.new()
-    v.name = "exposure"
-    v.targets[0].id_type = "SCENE"
-    v.targets[0].id = scene
-    v.targets[0].data_path = "view_settings.exposure"
-    d.expression = "exposure"
-    
+    if multi_exposure_node in created:
+        d = multi_exposure_node.inputs["Exposure"].driver_add("default_value").driver
+        v = d.variables.new()
+        v.name = "exposure"
+        v.targets[0].id_type = "SCENE"
+        v.targets[0].id = scene
+        v.targets[0].data_path = "view_settings.exposure"
+        d.expression = "exposure"
 
-def create_nuke_export_compositor_nodes_for_view_layer(render_dir, view_layer_name, shot_name, slate_number):
-    scene = bpy.data.scenes[0]    
+    return (len(created), len(duplicates))
+    
 
-    # Compile render output directory
+def get_nuke_export_base_paths(render_dir, view_layer_name, shot_name, slate_number):
+    """Return the (image, data) base paths of the File Output nodes of a view layer"""
     view_layer_sub_dir_name = (view_layer_name[3:] if view_layer_name.startswith("RL_") else view_layer_name).lower()
     base_path = os.path.join(render_dir, 
                              shot_name,
@@ -270,6 +619,22 @@ def create_nuke_export_compositor_nodes_for_view_layer(render_dir, view_layer_na
                                    shot_name.replace("_","") +"_" + view_layer_sub_dir_name.replace("_","") + "_data_s" + str(slate_number) + "_"
                                   )
 
+    return (image_base_path, data_base_path)
+
+
+def create_nuke_export_compositor_nodes_for_view_layer(render_dir, view_layer_name, shot_name, slate_number, scene = None, aov_profile = None, exr_policy = None):
+    """Set up the Nuke export of one view layer (of the first scene, by default)
+
+    aov_profile: Name of the AOV profile, or list of AOVs; see get_aov_profile().
+    exr_policy:  Name of the EXR policy, or policy dict; see get_exr_policy().
+
+    Returns (number of nodes created, number of duplicate nodes removed)
+    """
+    if scene is None:
+        scene = bpy.data.scenes[0]    
+
+    # Compile render output directory
+    (image_base_path, data_base_path) = get_nuke_export_base_paths(render_dir, view_layer_name, shot_name, slate_number)
 
     scene.use_nodes = True
 
@@ -277,11 +642,261 @@ def create_nuke_export_compositor_nodes_for_view_layer(render_dir, view_layer_na
     print("Turning on CYCLES")
     scene.render.engine = "CYCLES"
     
+    aov_names = get_aov_profile(scene, aov_profile)
+
     print("Turning on AOVs")
-    turn_on_aovs(scene, view_layer_name)
+    turn_on_aovs(scene, view_layer_name, aov_names)
 
     print("Setting up nodes")
-    setup_nodes(scene, view_layer_name, image_base_path, data_base_path)
+    return setup_nodes(scene, view_layer_name, image_base_path, data_base_path, aov_names, exr_policy)
+
+
+def create_nuke_export_compositor_nodes(render_dir = None, shot_name = None, slate_number = None, scenes = None, view_layer_names = None, aov_profile = None, exr_policy = None):
+    """Set up the Nuke export of every selected view layer of every scene in one go
+
+    Doesn't need the UI, so it can be run from a script, e.g. with blender -b
+    --python-expr. A view layer is selected if it's enabled for rendering
+    ("use"), or, if 'view_layer_names' is given, if it's named in it. Existing
+    setups are reused (see setup_nodes()), so it's safe to run again.
+
+    render_dir, shot_name, slate_number:
+                 Where the outputs go; by default, each scene's own
+                 render_directory, shot_name and slate_number (as set in
+                 the Nuke export panel).
+    scenes:      The scenes to set up; all of them by default.
+    aov_profile: Name of the AOV profile, or list of AOVs; by default, each
+                 scene's own profile. See get_aov_profile().
+    exr_policy:  Name of the EXR policy; by default, each scene's own. See
+                 get_exr_policy().
+
+    Returns a list of (scene name, view layer name, nodes created, duplicates removed)
+    """
+    results = []
+    for scene in (bpy.data.scenes if scenes is None else scenes):
+        view_layers = [ view_layer for view_layer in scene.view_layers
+                        if (view_layer.name in view_layer_names if view_layer_names is not None else view_layer.use) ]
+        if not view_layers:
+            continue
+
+        scene.use_nodes = True
+        scene.render.engine = "CYCLES"
+        aov_names = get_aov_profile(scene, aov_profile)
+
+        scene_render_dir = scene.render_directory if render_dir is None else render_dir
+        scene_shot_name = scene.shot_name if shot_name is None else shot_name
+        scene_slate_number = scene.slate_number if slate_number is None else slate_number
+
+        for view_layer in view_layers:
+            (image_base_path, data_base_path) = get_nuke_export_base_paths(scene_render_dir, view_layer.name, scene_shot_name, scene_slate_number)
+            turn_on_aovs(scene, view_layer.name, aov_names)
+            (num_created, num_removed) = setup_nodes(scene, view_layer.name, image_base_path, data_base_path, aov_names, exr_policy)
+
+            print("Nuke export of %s/%s: %d nodes created, %d duplicates removed" % (scene.name, view_layer.name, num_created, num_removed))
+            results.append((scene.name, view_layer.name, num_created, num_removed))
+
+    return results
+
+
+def apply_nuke_export_settings(scene, aov_profile = None, exr_policy = None, keep_passes = (), overrides = None):
+    """Switch the existing Nuke export setups of a scene to another AOV profile and/or EXR policy
+
+    Used by render_script.py for shots with "nuke_aov_profile" or
+    "nuke_exr_policy". Only view layers that have been set up are changed, and
+    their output paths are kept. Either setting defaults to the scene's own.
+
+    keep_passes: View layer settings to leave on; see turn_on_aovs().
+    overrides:   Make the changes through this, so that they can be undone
+                 after the shot; see setup_nodes().
+
+    Returns the names of the view layers changed.
+    """
+    aov_names = get_aov_profile(scene, aov_profile)
+    exr_policy = get_exr_policy(scene, exr_policy)
+
+    view_layer_names = []
+    for node in scene.node_tree.nodes:
+        if node.get(NUKE_NODE_TYPE_PROP) == "image" and node.get(NUKE_VIEW_LAYER_NAME_PROP) in scene.view_layers:
+            view_layer_names.append(node[NUKE_VIEW_LAYER_NAME_PROP])
+
+    for view_layer_name in view_layer_names:
+        (nodes, _) = find_nuke_export_nodes(scene, view_layer_name)
+        image_base_path = nodes["image"].base_path
+        data_base_path = nodes["data"].base_path if "data" in nodes else image_base_path
+
+        turn_on_aovs(scene, view_layer_name, aov_names, keep_passes, overrides)
+        setup_nodes(scene, view_layer_name, image_base_path, data_base_path, aov_names, exr_policy, overrides)
+
+    return view_layer_names
+
+
+def render_compositor(scene, repeats):
+    """Render 'scene' (frames 1 to 'repeats') and return the mean seconds per frame
+
+    The addon mutes every File Output node once a render is complete (see
+    __init__.py); so they're unmuted before each frame, or only the first
+    would be written.
+    """
+    output_nodes = [ node for node in scene.node_tree.nodes if node.type == 'OUTPUT_FILE' ]
+    start_time = time.perf_counter()
+    for frame in range(1, repeats + 1):
+        for node in output_nodes:
+            node.mute = False
+        scene.frame_current = frame
+        bpy.ops.render.render(scene = scene.name)
+    return (time.perf_counter() - start_time) / repeats
+
+def benchmark_exr_policies(scene, view_layer_name, output_dir, policies = None, aov_profile = None, repeats = 3):
+    """Compare the size and write time of the Nuke export EXRs under each EXR policy
+
+    Renders the current frame of the view layer once, with the AOVs of the
+    profile, and keeps all its passes in a full float EXR. Then, for each
+    policy, writes those passes again with the File Output nodes the policy
+    would use, in a scene with no Render Layers node, so that only the
+    compositor runs; less the time of the same scene with no File Output
+    nodes, that's the time taken to write them.
+
+    The frames are written in 'output_dir', one directory per policy (emptied
+    first), and left there to be compared in Nuke. The view layer's passes are
+    put back as they were after the render.
+
+    policies:    Names of the EXR policies to compare; all of them by default.
+    aov_profile: Name of the AOV profile, or list of AOVs; by default, the scene's.
+
+    Returns a list of dicts with "policy", "files", "bytes_per_frame",
+    "write_seconds_per_frame" and "skipped_slots" (slots with no pass in the
+    rendered frame, which aren't written), sorted by size.
+    """
+    aov_names = get_aov_profile(scene, aov_profile)
+    if policies is None:
+        policies = list(get_exr_policies(scene))
+    os.makedirs(output_dir, exist_ok = True)
+
+    # Render the frame, without writing the frames of the shot.
+    view_layer = scene.view_layers[view_layer_name]
+    saved_passes = { view_layer_setting: getattr(view_layer, view_layer_setting)
+                     for (_, view_layer_setting, _, _, _) in AOVS if view_layer_setting }
+    turn_on_aovs(scene, view_layer_name, aov_names)
+    output_nodes = [ node for node in scene.node_tree.nodes if node.type == 'OUTPUT_FILE' ] if scene.node_tree else []
+    mutes = [ node.mute for node in output_nodes ]
+    for node in output_nodes:
+        node.mute = True
+    try:
+        print("Rendering %s/%s" % (scene.name, view_layer_name))
+        bpy.ops.render.render(scene = scene.name, layer = view_layer_name)
+    finally:
+        for (node, mute) in zip(output_nodes, mutes):
+            node.mute = mute
+        for (view_layer_setting, value) in saved_passes.items():
+            setattr(view_layer, view_layer_setting, value)
+
+    image_settings = scene.render.image_settings
+    saved_settings = (image_settings.file_format, image_settings.color_depth, image_settings.exr_codec)
+    source_filepath = os.path.join(output_dir, "source.exr")
+    try:
+        image_settings.file_format = "OPEN_EXR_MULTILAYER"
+        image_settings.color_depth = "32"
+        image_settings.exr_codec = "ZIP"
+        bpy.data.images["Render Result"].save_render(source_filepath, scene = scene)
+    finally:
+        (image_settings.file_format, image_settings.color_depth, image_settings.exr_codec) = saved_settings
+
+    source_image = bpy.data.images.load(source_filepath)
+    benchmark_scene = bpy.data.scenes.new("Nuke EXR benchmark")
+    results = []
+    try:
+        benchmark_scene.render.engine = "CYCLES"
+        benchmark_scene.render.use_compositing = True
+        benchmark_scene.render.use_sequencer = False
+        (benchmark_scene.render.resolution_x, benchmark_scene.render.resolution_y) = source_image.size
+        benchmark_scene.render.resolution_percentage = 100
+        benchmark_scene.use_nodes = True
+
+        tree = benchmark_scene.node_tree
+        tree.nodes.clear()
+        image_node = tree.nodes.new("CompositorNodeImage")
+        image_node.image = source_image
+        try:
+            image_node.layer = view_layer_name
+        except TypeError:
+            pass
+        composite_node = tree.nodes.new("CompositorNodeComposite")
+        tree.links.new(image_node.outputs["Image"], composite_node.inputs["Image"])
+
+        # The render layer outputs are the passes of the source EXR; the exposure
+        # group doesn't change how long the EXRs take to write, so leave it out.
+        slot_sources = { slot: render_layers_output
+                         for (name, _, _, _, slots) in AOVS if name in aov_names
+                         for (slot, render_layers_output) in slots }
+
+        baseline_seconds = render_compositor(benchmark_scene, repeats)
+
+        for policy_name in policies:
+            exr_policy = get_exr_policy(scene, policy_name)
+            policy_dir = os.path.join(output_dir, policy_name.lower())
+            # Files left from an earlier run would be counted in the size.
+            shutil.rmtree(policy_dir, ignore_errors = True)
+            os.makedirs(policy_dir)
+
+            output_nodes = []
+            skipped_slots = []
+            for (node_type, color_depth, exr_codec, slots) in get_output_node_groups(aov_names, exr_policy):
+                output_node = tree.nodes.new("CompositorNodeOutputFile")
+                set_file_slots(output_node, slots)
+                set_output_format(output_node, color_depth, exr_codec)
+                output_node.base_path = os.path.join(policy_dir, node_type + "_")
+                for slot in slots:
+                    # "Image" is the combined pass; the source EXR has the passes under their own names.
+                    source_name = slot if slot_sources[slot] == "Image" and slot in image_node.outputs else slot_sources[slot]
+                    if source_name in image_node.outputs:
+                        tree.links.new(image_node.outputs[source_name], output_node.inputs[slot])
+                    else:
+                        skipped_slots.append(slot)
+                output_nodes.append(output_node)
+
+            if skipped_slots:
+                print("WARNING: %s: no pass in the rendered frame for %s; not written" % (policy_name, ", ".join(skipped_slots)))
+
+            seconds = render_compositor(benchmark_scene, repeats)
+
+            # Per frame actually written; the File Output nodes add the frame number to their base paths.
+            filenames = os.listdir(policy_dir)
+            frames_written = len(set(os.path.splitext(filename)[0][-4:] for filename in filenames))
+            if frames_written != repeats:
+                print("WARNING: %s: %d of %d frames written" % (policy_name, frames_written, repeats))
+
+            results.append({
+                "policy": policy_name,
+                "files": len(output_nodes),
+                "bytes_per_frame": sum(os.path.getsize(os.path.join(policy_dir, filename)) for filename in filenames) // max(1, frames_written),
+                "write_seconds_per_frame": max(0.0, seconds - baseline_seconds) * repeats / max(1, frames_written),
+                "skipped_slots": skipped_slots,
+            })
+
+            for output_node in output_nodes:
+                tree.nodes.remove(output_node)
+    finally:
+        bpy.data.scenes.remove(benchmark_scene)
+        bpy.data.images.remove(source_image)
+
+    results.sort(key = lambda result: result["bytes_per_frame"])
+
+    print("%-16s %5s %12s %10s" % ("Policy", "Files", "MB/frame", "Write (s)"))
+    for result in results:
+        print("%-16s %5d %12.2f %10.3f" % (result["policy"], result["files"],
+                                          result["bytes_per_frame"] / (1024 * 1024), result["write_seconds_per_frame"]))
+
+    return results
+
+
+if __name__ == "__main__":
+    # blender -b <blend file> --python create_nuke_export_nodes.py -- benchmark <output dir> [view layer] [policy ...]
+    argv = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else []
+    if len(argv) >= 2 and argv[0] == "benchmark":
+        scene = bpy.context.scene
+        view_layer_name = argv[2] if len(argv) > 2 else bpy.context.view_layer.name
+        benchmark_exr_policies(scene, view_layer_name, argv[1], argv[3:] or None)
+    else:
+        print("Usage: blender -b <blend file> --python create_nuke_export_nodes.py -- benchmark <output dir> [view layer] [policy ...]")
 
 
 #scene = bpy.data.scenes[0]    
@@ -4,7 +4,14 @@ Add a sub-panel to the output properties panal to make it easy to create composi
 to export render layers for compositing in Nuke.
 
 Configure the shot name and slate number. Then choose the view layer name and hit "Create Nuke export nodes"
-to create the compositor nodes.
+to create the compositor nodes; or hit "Create Nuke export nodes for all view layers" to set up every view
+layer that is enabled for rendering, in every scene, each with its own render directory, shot name and
+slate number. Either way, an existing setup of a view layer is
+reused rather than duplicated.
+
+The EXR policy sets the bit depth and codec of each AOV. "Benchmark EXR policies" renders the current
+frame of the view layer and writes it under each policy, to <render directory>/exr_benchmark, and
+reports the size and write time of each.
 
 
 """
@@ -36,6 +43,43 @@ class CreateNukeExportNodesOperator(bpy.types.Operator):
         return {'FINISHED'}
     
 
+class CreateAllNukeExportNodesOperator(bpy.types.Operator):
+    
+    bl_idname = 'opr.nuke_export_nodes_batch_creator_operator'
+    bl_label = 'Nuke Export Nodes Creator (all view layers)'
+    
+    def execute(self, context):
+        # Each scene goes to its own render directory, shot and slate.
+        results = create_nuke_export_nodes.create_nuke_export_compositor_nodes()
+
+        self.report({'INFO'}, "Set up %d view layers; %d nodes created, %d duplicates removed" % (
+                        len(results),
+                        sum(num_created for (_, _, num_created, _) in results),
+                        sum(num_removed for (_, _, _, num_removed) in results)))
+            
+        return {'FINISHED'}
+    
+
+class BenchmarkExrPoliciesOperator(bpy.types.Operator):
+    
+    bl_idname = 'opr.nuke_exr_policy_benchmark_operator'
+    bl_label = 'Benchmark the EXR policies of the Nuke export'
+    
+    def execute(self, context):
+        results = create_nuke_export_nodes.benchmark_exr_policies(
+                context.scene,
+                context.scene.nuke_export_view_layer_name_to_setup,
+                os.path.join(context.scene.render_directory, "exr_benchmark")
+        )
+
+        self.report({'INFO'}, "; ".join("%s: %.1f MB, %.2fs" % (result["policy"],
+                                                                 result["bytes_per_frame"] / (1024 * 1024),
+                                                                 result["write_seconds_per_frame"])
+                                         for result in results))
+            
+        return {'FINISHED'}
+    
+
 class UpdateSlateNumberOperator(bpy.types.Operator):
     
     bl_idname = 'opr.slate_number_updater_operator'
@@ -116,6 +160,12 @@ class NukeExportPanel(bpy.types.Panel):
 
         row = layout.row()
         row.prop(scene, "nuke_export_view_layer_name_to_setup")
+
+        row = layout.row()
+        row.prop(scene, "nuke_aov_profile")
+
+        row = layout.row()
+        row.prop(scene, "nuke_exr_policy")
  
         # Big render button
         #layout.label(text="Big Button:")
@@ -123,6 +173,12 @@ class NukeExportPanel(bpy.types.Panel):
         row.scale_y = 2.0
         row.operator("opr.nuke_export_nodes_createor_operator", text="Create Nuke export nodes")
 
+        row = layout.row()
+        row.operator("opr.nuke_export_nodes_batch_creator_operator", text="Create Nuke export nodes for all view layers")
+
+        row = layout.row()
+        row.operator("opr.nuke_exr_policy_benchmark_operator", text="Benchmark EXR policies")
+
         row = layout.row()
         row.scale_y = 2.0
         row.operator("opr.slate_number_updater_operator", text="Update slate number")
@@ -138,6 +194,8 @@ class NukeExportPanel(bpy.types.Panel):
 
 CLASSES = [
     CreateNukeExportNodesOperator,
+    CreateAllNukeExportNodesOperator,
+    BenchmarkExrPoliciesOperator,
     UpdateSlateNumberOperator,
     LaunchRenderOperator,
     NukeExportPanel
@@ -148,6 +206,14 @@ PROPS = [
         ('shot_name', bpy.props.StringProperty(name='Shot name', default='my_shot')),
         ('slate_number', bpy.props.IntProperty(name='Slate number', default=1)),
         ('nuke_export_view_layer_name_to_setup', bpy.props.StringProperty(name='View layer name', default="ViewLayer")),
+        ('nuke_aov_profile', bpy.props.StringProperty(name='AOV profile',
+                                                      description='AOVs to export: ' + ", ".join(create_nuke_export_nodes.AOV_PROFILES) +
+                                                                  ', or a profile in the scene\'s "nuke_aov_profiles"',
+                                                      default=create_nuke_export_nodes.DEFAULT_AOV_PROFILE)),
+        ('nuke_exr_policy', bpy.props.StringProperty(name='EXR policy',
+                                                     description='Bit depth and codec of each AOV: ' + ", ".join(create_nuke_export_nodes.EXR_POLICIES) +
+                                                                 ', or a policy in the scene\'s "nuke_exr_policies"',
+                                                     default=create_nuke_export_nodes.DEFAULT_EXR_POLICY)),
 ]
 
 
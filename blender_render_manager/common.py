@@ -1,6 +1,13 @@
 """Common Code
 
 """
+import hashlib
+import json
+import os
+import re
+import socket
+import sys
+import time
 
 IMAGE_FILE_EXTENSIONS = {
     "PNG": "png",
@@ -13,7 +20,8 @@ IMAGE_FILE_EXTENSIONS = {
 
 def get_quality_index(quality):
     """Map a quality string to an index into the arrays in the JSON file"""
-    return {"LOW": 0, "MEDIUM": 1, "HIGH": 2, "FINAL": 3}.get(quality.upper(), 3)
+    # SPARSE renders some of the frames at LOW quality, and interpolates the rest.
+    return {"LOW": 0, "MEDIUM": 1, "HIGH": 2, "FINAL": 3, "SPARSE": 0}.get(quality.upper(), 3)
 
 
 def parse_resolution_string(resolution_string):
@@ -65,3 +73,526 @@ def set_render_resolution(scene, shot_info, quality):
     scene.render.resolution_percentage = shot_info.get("resolution_percentage", [50, 50, 100, 100])[quality_index]
     scene.render.resolution_x = parse_resolution_string(shot_info.get("target_resolution", "1920x1080"))[0];
     scene.render.resolution_y = parse_resolution_string(shot_info.get("target_resolution", "1920x1080"))[1];
+
+
+def get_process_memory_usage():
+    """Return the resident memory of this process in bytes, or None if we can't tell"""
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+
+    if sys.platform == "win32":
+        import ctypes
+        from ctypes import wintypes
+
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [("cb", wintypes.DWORD),
+                        ("PageFaultCount", wintypes.DWORD),
+                        ("PeakWorkingSetSize", ctypes.c_size_t),
+                        ("WorkingSetSize", ctypes.c_size_t),
+                        ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                        ("PagefileUsage", ctypes.c_size_t),
+                        ("PeakPagefileUsage", ctypes.c_size_t)]
+
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        if ctypes.windll.psapi.GetProcessMemoryInfo(ctypes.windll.kernel32.GetCurrentProcess(),
+                                                    ctypes.byref(counters),
+                                                    counters.cb):
+            return counters.WorkingSetSize
+        return None
+
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def parse_shot_info_overrides(args):
+    """Parse KEY=VALUE command line arguments into a dict of shot info overrides
+
+    VALUE is parsed as JSON if it can be, and taken as a string otherwise.
+    """
+    shot_info_overrides = {}
+    for arg in args:
+        (key, value) = arg.split("=", 1)
+        try:
+            shot_info_overrides[key] = json.loads(value)
+        except ValueError:
+            shot_info_overrides[key] = value
+    return shot_info_overrides
+
+
+def get_render_filestub(shot_list_db, shot_info, shot_category, shot_id, slate_number):
+    """Path + filename stub of the frames that render_script.py writes for a shot
+
+    e.g. Renders/Title/slate_3/film_1_3_
+
+    """
+    # Use output path override given in the shot list, if given. Otherwise, fallback on eg. Renders/Title/slate_3/...
+    if shot_info.get("output_filepath_override"):
+        return shot_info["output_filepath_override"]
+
+    # Backwards compatble with files that use 'title' instead of 'shot_name'
+    shot_name = shot_info.get("shot_name")
+    if not shot_name:
+        shot_name = shot_info["title"]
+
+    output_path_base = os.path.join(shot_list_db.render_root, shot_name)
+    filename = str(shot_category) + "_" + str(shot_id) + "_" + str(slate_number) + "_"
+
+    return os.path.join(output_path_base, "slate_%s" % str(slate_number), filename)
+
+
+def get_tile_border(tile_index, columns, rows):
+    """Render border of tile 'tile_index' of a columns x rows grid; (min_x, max_x, min_y, max_y)
+
+    Tiles are numbered row by row from the top left; the border is in Blender's
+    coordinates, i.e. fractions of the frame with y going up from the bottom.
+    """
+    if not 0 <= tile_index < columns * rows:
+        raise ValueError("Tile %d out of range for a %dx%d grid" % (tile_index, columns, rows))
+
+    (row, column) = divmod(tile_index, columns)
+    return (column / columns, (column + 1) / columns,
+            1.0 - (row + 1) / rows, 1.0 - row / rows)
+
+
+def get_tile_filestub(render_filestub, tile_index):
+    """Path + filename stub of the frames of one tile of a tiled render
+
+    e.g. Renders/Title/slate_3/tiles/film_1_3_tile_5_
+
+    """
+    render_dir, filename = os.path.split(render_filestub)
+    return os.path.join(render_dir, "tiles", filename + "tile_%d_" % tile_index)
+
+
+def get_render_passes_dir(render_dir, view_layer_name = None):
+    """Directory that render_script.py writes the render passes of a shot to
+
+    e.g. Renders/Title/slate_3/passes; with 'view_layer_name' (when more than
+    one view layer is rendered), Renders/Title/slate_3/passes/<view layer>.
+
+    """
+    if view_layer_name:
+        return os.path.join(render_dir, "passes", view_layer_name)
+    return os.path.join(render_dir, "passes")
+
+
+def get_composite_filestub(shot_list_db, shot_info, shot_category, shot_id, slate_number):
+    """Path + filename stub of the frames that compositor_script.py writes for a shot
+
+    e.g. Renders/Title/slate_3_composite/film_1_3_comp_
+
+    """
+    if shot_info.get("output_filepath_override"):
+        render_dir, render_filename = os.path.split(shot_info["output_filepath_override"])
+        return os.path.join(render_dir + "_composite", render_filename + "comp_")
+
+    shot_name = shot_info.get("shot_name")
+    if not shot_name:
+        shot_name = shot_info["title"]
+
+    output_path_base = os.path.join(shot_list_db.render_root, shot_name)
+    filename = str(shot_category) + "_" + str(shot_id) + "_" + str(slate_number) + "_comp_"
+
+    return os.path.join(output_path_base, "slate_%s_composite" % str(slate_number), filename)
+
+
+def get_denoise_filestub(shot_list_db, shot_info, shot_category, shot_id, slate_number):
+    """Path + filename stub of the frames that denoise_script.py writes for a shot
+
+    e.g. Renders/Title/slate_3_denoised/film_1_3_dn_
+
+    """
+    if shot_info.get("output_filepath_override"):
+        render_dir, render_filename = os.path.split(shot_info["output_filepath_override"])
+        return os.path.join(render_dir + "_denoised", render_filename + "dn_")
+
+    shot_name = shot_info.get("shot_name")
+    if not shot_name:
+        shot_name = shot_info["title"]
+
+    output_path_base = os.path.join(shot_list_db.render_root, shot_name)
+    filename = str(shot_category) + "_" + str(shot_id) + "_" + str(slate_number) + "_dn_"
+
+    return os.path.join(output_path_base, "slate_%s_denoised" % str(slate_number), filename)
+
+
+def get_composite_source_filestub(shot_list_db, shot_info, shot_category, shot_id, slate_number):
+    """The frames that the compositor works on: the denoised frames, for shots with "denoise_enabled"; otherwise the rendered ones"""
+    if parse_boolean(shot_info.get("denoise_enabled", False)):
+        return get_denoise_filestub(shot_list_db, shot_info, shot_category, shot_id, slate_number)
+    return get_render_filestub(shot_list_db, shot_info, shot_category, shot_id, slate_number)
+
+
+def get_frame_range(shot_info):
+    """Return (frame_start, frame_end) from the shot info or None, if not specified"""
+    if 'frame_start' in shot_info and 'frame_end' in shot_info:
+        return (shot_info["frame_start"], shot_info["frame_end"])
+    else:
+        return None
+
+
+def scan_frame_numbers(filestub, file_extension):
+    """Return the set of frame numbers for which 'filestub' + "0001." + 'file_extension' exists
+
+    This lists the directory once, rather than stat'ing every frame of the shot, which
+    matters when the renders live on a NAS.
+    """
+    directory, stub = os.path.split(filestub)
+    pattern = re.compile(re.escape(stub) + "([0-9]+)\\." + re.escape(file_extension))
+
+    try:
+        candidates = os.listdir(directory if directory else ".")
+    except FileNotFoundError:
+        return set()
+
+    frames = set()
+    for candidate in candidates:
+        m = pattern.fullmatch(candidate)
+        if m:
+            frames.add(int(m.group(1)))
+
+    return frames
+
+
+def scan_frame_mtimes(filestub, file_extension):
+    """Like scan_frame_numbers(), but returns a dict mapping frame number -> modification time
+
+    Uses os.scandir(), which gets the timestamps along with the directory listing
+    on Windows, so this is about as cheap as scan_frame_numbers() there.
+    """
+    directory, stub = os.path.split(filestub)
+    pattern = re.compile(re.escape(stub) + "([0-9]+)\\." + re.escape(file_extension))
+
+    frames = {}
+    try:
+        with os.scandir(directory if directory else ".") as entries:
+            for entry in entries:
+                m = pattern.fullmatch(entry.name)
+                if m:
+                    frames[int(m.group(1))] = entry.stat().st_mtime
+    except FileNotFoundError:
+        pass
+
+    return frames
+
+
+def bisection_frame_order(frame_start, frame_end):
+    """The frames of a shot in coarse-to-fine order: first, last, middle, quarters, eighths, ...
+
+    e.g. 1..9 -> 1, 9, 5, 3, 7, 2, 4, 6, 8
+    """
+    import collections
+
+    order = [frame_start] if frame_end == frame_start else [frame_start, frame_end]
+    intervals = collections.deque([(frame_start, frame_end)])
+    while intervals:
+        (a, b) = intervals.popleft()
+        if b - a < 2:
+            continue
+        middle = (a + b) // 2
+        order.append(middle)
+        intervals.append((a, middle))
+        intervals.append((middle, b))
+
+    return order
+
+
+def get_frame_order(frame_start, frame_end, frame_order = "SEQUENTIAL", frame_chunk = None):
+    """The frames to render, in the order to render them
+
+    frame_order: "SEQUENTIAL" or "BISECT"; see bisection_frame_order()
+    frame_chunk: [i, k] to give just the frames of chunk i of k. The chunks
+                 take turns through the order, so each chunk is spread over
+                 the whole shot too.
+    """
+    if frame_order.upper() == "BISECT":
+        frames = bisection_frame_order(frame_start, frame_end)
+    elif frame_order.upper() == "SEQUENTIAL":
+        frames = list(range(frame_start, frame_end + 1))
+    else:
+        raise ValueError("Unknown frame order \"%s\"" % frame_order)
+
+    if frame_chunk:
+        (chunk_index, num_chunks) = frame_chunk
+        frames = frames[chunk_index::num_chunks]
+
+    return frames
+
+
+def get_sparse_frames(frame_start, frame_end, frame_step, frame_chunk = None):
+    """The frames to render at SPARSE quality: every 'frame_step'th frame, and always the last
+
+    frame_chunk: [i, k] to give just the frames of chunk i of k; as for get_frame_order().
+    """
+    frames = list(range(frame_start, frame_end + 1, max(1, frame_step)))
+    if frames[-1] != frame_end:
+        frames.append(frame_end)
+
+    if frame_chunk:
+        (chunk_index, num_chunks) = frame_chunk
+        frames = frames[chunk_index::num_chunks]
+
+    return frames
+
+
+def contiguous_frame_ranges(frames, max_length = None):
+    """Split a collection of frame numbers into runs of consecutive frames
+
+    e.g. {1,2,3,7,8,10} -> [(1,3), (7,8), (10,10)]
+
+    max_length:  If given, longer runs are split into runs of at most this many frames.
+    """
+    ranges = []
+    for frame in sorted(frames):
+        if ranges and frame == ranges[-1][1] + 1 and (max_length is None or frame - ranges[-1][0] < max_length):
+            ranges[-1][1] = frame
+        else:
+            ranges.append([frame, frame])
+
+    return [ tuple(r) for r in ranges ]
+
+
+def format_frame_ranges(frames):
+    """Summarise a collection of frame numbers compactly for logging
+
+    e.g. {1,2,3,7,8,10} -> "1-3, 7-8, 10"
+    """
+    return ", ".join(
+        str(start) if start == end else "%d-%d" % (start, end)
+        for (start, end) in contiguous_frame_ranges(frames)
+    )
+
+
+def parse_frame_ranges(text):
+    """The frame numbers of a summary made by format_frame_ranges()
+
+    e.g. "1-3, 7-8, 10" -> {1,2,3,7,8,10}. Used to pass just some frames of a
+    shot, e.g. those used in the cut, to the compositor, denoiser and
+    previewer on their command lines.
+    """
+    frames = set()
+    for part in text.replace(" ", "").split(","):
+        if part:
+            (first, _, last) = part.partition("-")
+            frames.update(range(int(first), int(last or first) + 1))
+    return frames
+
+
+##
+## Frame claiming
+##
+## When several processes work on the same shot (e.g. sharded compositors), each
+## frame is claimed by atomically creating a lock file next to the output frame.
+## Only the process that created the lock file works on the frame.
+##
+FRAME_LOCK_EXTENSION = ".lock"
+
+# Results of claim_unfinished_frame()
+FRAME_CLAIMED = "claimed"
+FRAME_CLAIMED_ELSEWHERE = "claimed_elsewhere"
+FRAME_ALREADY_DONE = "already_done"
+
+def claim_frame(output_frame_filepath, stale_after = 3600):
+    """Try to claim the frame that will be written to 'output_frame_filepath'
+
+    Returns True if we now own the frame. A lock older than 'stale_after' seconds
+    is assumed to belong to a process that died and is taken over.
+    """
+    lock_filepath = output_frame_filepath + FRAME_LOCK_EXTENSION
+    os.makedirs(os.path.dirname(lock_filepath) or ".", exist_ok = True)
+
+    for attempt in range(2):
+        try:
+            fd = os.open(lock_filepath, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                if attempt == 0 and time.time() - os.stat(lock_filepath).st_mtime > stale_after:
+                    os.remove(lock_filepath)
+                    continue
+            except FileNotFoundError:
+                # Owner just finished with it; try again.
+                continue
+            return False
+
+        with os.fdopen(fd, "w") as lock_file:
+            lock_file.write("%s %d\n" % (socket.gethostname(), os.getpid()))
+        return True
+
+    return False
+
+
+def claim_unfinished_frame(output_frame_filepath, is_done, stale_after = 3600):
+    """Claim a frame, unless another process holds it or has already done it
+
+    Another process may have finished the frame, and released its lock, between
+    us deciding the frame needs doing and claiming it; so once we hold the lock,
+    we look again.
+
+    is_done: Function of no arguments; True if the output frame is there and up-to-date.
+
+    Returns FRAME_CLAIMED, FRAME_CLAIMED_ELSEWHERE or FRAME_ALREADY_DONE. Only
+    for FRAME_CLAIMED do we hold the lock, to be released with release_frame().
+    """
+    if not claim_frame(output_frame_filepath, stale_after):
+        return FRAME_CLAIMED_ELSEWHERE
+
+    if is_done():
+        release_frame(output_frame_filepath)
+        return FRAME_ALREADY_DONE
+
+    return FRAME_CLAIMED
+
+
+def release_frame(output_frame_filepath):
+    """Release a frame claimed with claim_frame()"""
+    try:
+        os.remove(output_frame_filepath + FRAME_LOCK_EXTENSION)
+    except FileNotFoundError:
+        pass
+
+
+def remove_frame_locks(filestub):
+    """Remove all frame locks next to the frames of 'filestub'
+
+    Only call this when no process can be working on the frames; e.g. before
+    launching the processes that use them.
+    """
+    directory, stub = os.path.split(filestub)
+    try:
+        candidates = os.listdir(directory if directory else ".")
+    except FileNotFoundError:
+        return
+
+    for candidate in candidates:
+        if candidate.startswith(stub) and candidate.endswith(FRAME_LOCK_EXTENSION):
+            release_frame(os.path.join(directory, candidate[:-len(FRAME_LOCK_EXTENSION)]))
+
+
+##
+## Composite versioning
+##
+## Next to each composited frame we record a hash of everything that went into
+## it: the resolved compositor chain and output settings and the compositor
+## itself (e.g. the compositor .blend); and the size and timestamp of the source
+## frame. When any of these change, the record no longer matches and the
+## compositor redoes the frame.
+##
+COMPOSITE_RECORD_EXTENSION = ".version.json"
+
+def get_file_sha256(filepath):
+    h = hashlib.sha256()
+    with open(filepath, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def get_composite_version(shot_info, quality, compositor_filepath):
+    """Hash of the compositor settings of a shot and the compositor file
+
+    compositor_filepath: The compositor .blend, or script, that does the work.
+    """
+    settings = {
+        "compositor_chain": shot_info.get("compositor_chain", {}),
+        "quality": quality.upper(),
+        "output": { key: shot_info.get(key) for key in ["composite_file_format",
+                                                        "composite_color_mode",
+                                                        "composite_color_depth",
+                                                        "target_resolution",
+                                                        "resolution_percentage"] },
+    }
+
+    h = hashlib.sha256(json.dumps(settings, sort_keys = True).encode("utf-8"))
+    h.update(get_file_sha256(compositor_filepath).encode("utf-8"))
+    return h.hexdigest()
+
+
+def get_denoise_version(shot_info, denoiser_filepath):
+    """Hash of the denoise settings of a shot and the denoiser; like get_composite_version()
+
+    The records written with write_composite_record() work just as well for
+    denoised frames; so changing the "denoise" settings denoises the shot again,
+    without rendering it again.
+    """
+    settings = {
+        "denoise": shot_info.get("denoise", {}),
+        "output": { key: shot_info.get(key) for key in ["render_file_format",
+                                                        "render_color_mode",
+                                                        "render_color_depth",
+                                                        "render_exr_codec"] },
+    }
+
+    h = hashlib.sha256(json.dumps(settings, sort_keys = True).encode("utf-8"))
+    h.update(get_file_sha256(denoiser_filepath).encode("utf-8"))
+    return h.hexdigest()
+
+
+def write_composite_record(output_frame_filepath, source_frame_filepath, version):
+    """Record what went into the composited frame 'output_frame_filepath'"""
+    source_stat = os.stat(source_frame_filepath)
+    record = {
+        "version": version,
+        "source_size": source_stat.st_size,
+        "source_mtime_ns": source_stat.st_mtime_ns,
+    }
+
+    with open(output_frame_filepath + COMPOSITE_RECORD_EXTENSION, "w") as file:
+        json.dump(record, file)
+
+
+def is_composite_current(output_frame_filepath, source_frame_filepath, version):
+    """Check the record of a composited frame
+
+    Returns True if the frame was composited from the current source frame with
+    compositor 'version', False if it's stale or None if there is no record; e.g.
+    the frame was composited before we kept records.
+
+    We compare the size and timestamp of the source frame with the record,
+    rather than re-hashing it, so that checking is cheap.
+    """
+    try:
+        with open(output_frame_filepath + COMPOSITE_RECORD_EXTENSION, "r") as file:
+            record = json.load(file)
+    except FileNotFoundError:
+        return None
+    except ValueError:
+        return False
+
+    try:
+        source_stat = os.stat(source_frame_filepath)
+    except FileNotFoundError:
+        return False
+
+    return (record.get("version") == version
+            and record.get("source_size") == source_stat.st_size
+            and record.get("source_mtime_ns") == source_stat.st_mtime_ns)
+
+
+def find_stale_composites(frames, output_frame_filepath, source_frame_filepath, version):
+    """Return (stale frames, number of frames without a record) of already composited 'frames'
+
+    output_frame_filepath, source_frame_filepath: Functions mapping a frame number to a filepath.
+
+    Frames without a record are assumed to be current, so that upgrading doesn't
+    make the compositor redo every shot.
+    """
+    stale_frames = set()
+    num_unrecorded = 0
+    for frame in frames:
+        current = is_composite_current(output_frame_filepath(frame), source_frame_filepath(frame), version)
+        if current is None:
+            num_unrecorded += 1
+        elif not current:
+            stale_frames.add(frame)
+
+    return stale_frames, num_unrecorded
@@ -11,6 +11,7 @@ import sys
 import copy
 import os
 import functools
+import collections
 import logging
 import time
 
@@ -101,6 +102,7 @@ def configure_compositor_chain(compositor_chain_db):
         ("Lens Distortion", "dispersion"): functools.partial(set_node_input_default_value, 2),
         ("Filter", "factor"): functools.partial(set_node_input_default_value, 0),
         ("Blur", "size"): functools.partial(set_node_input_default_value, 1),
+        ("Exposure", "exposure"): functools.partial(set_node_input_default_value, 1),
     }
 
     # Loop through the nodes that we expect in the chain
@@ -114,6 +116,56 @@ def configure_compositor_chain(compositor_chain_db):
             except AttributeError:
                 logging.exception("Compositor config specified non-existant property \"%s\" for node \"%s\"." % (node_property, node_name))
 
+class SourceImageCache:
+    """A bounded cache of the images loaded for the "Source Image" node
+
+    bpy.data.images.load() adds a new image datablock for every frame and nothing
+    ever removes them, so a compositor running over thousands of frames would grow
+    without limit. We keep the 'max_images' most recently used images and remove
+    the rest from bpy.data.images.
+    """
+    def __init__(self, max_images = 1):
+        self._max_images = max(1, max_images)
+        self._images = collections.OrderedDict()
+
+    def load(self, filepath):
+        image = self._images.pop(filepath, None)
+        if image is None:
+            image = bpy.data.images.load(filepath, check_existing = True)
+        self._images[filepath] = image
+
+        while len(self._images) > self._max_images:
+            (_, old_image) = self._images.popitem(last = False)
+            bpy.data.images.remove(old_image)
+
+        return image
+
+def get_memory_report():
+    """Summarise the memory used by images and by the process as a whole"""
+    loaded_images = [ image for image in bpy.data.images if image.has_data ]
+    image_bytes = sum(image.size[0] * image.size[1] * image.channels * (4 if image.is_float else 1)
+                      for image in loaded_images)
+
+    return {
+        "images": len(bpy.data.images),
+        "loaded_images": len(loaded_images),
+        "image_bytes": image_bytes,
+        "process_bytes": get_process_memory_usage(),
+    }
+
+def log_memory_report(baseline_report = None):
+    """Log the memory report, relative to 'baseline_report' if given. Returns the report"""
+    report = get_memory_report()
+
+    process_mb = "unknown" if report["process_bytes"] is None else "%.0f MB" % (report["process_bytes"] / 2**20)
+    if baseline_report and report["process_bytes"] is not None and baseline_report["process_bytes"] is not None:
+        process_mb += " (%+.0f MB since start)" % ((report["process_bytes"] - baseline_report["process_bytes"]) / 2**20)
+
+    logging.info("Memory: %d images (%d loaded, %.1f MB of pixels); process %s" % (
+                     report["images"], report["loaded_images"], report["image_bytes"] / 2**20, process_mb))
+
+    return report
+
 def setup_compositor_source_image(src_filepath):
     """Setup the compositor source image node to load the rendered image"""
 
@@ -132,7 +184,7 @@ def setup_compositor_source_image(src_filepath):
     #except KeyError as e:
     #    raise ValueError("Source image loaded, but not available.")
 
-    image = bpy.data.images.load(src_filepath, check_existing = True)
+    image = source_image_cache.load(src_filepath)
     scene = bpy.data.scenes[0]
 
     # We expect the compositor node setup to have an Image Sequenece node called "Source Image"
@@ -147,6 +199,32 @@ def setup_compositor_source_image(src_filepath):
     scene.node_tree.nodes["Source Image"].layer = 'View Layer'
     print(src_filepath)
 
+def setup_compositor_source_sequence(first_src_filepath, frame_start, frame_end):
+    """Setup the compositor source image node to read a range of rendered frames as a sequence
+
+    first_src_filepath:  The file of frame 'frame_start'. Blender finds the other
+                         frames by replacing the frame number in the filename.
+    """
+    image = source_image_cache.load(first_src_filepath)
+    scene = bpy.data.scenes[0]
+
+    try:
+        source_image_node = scene.node_tree.nodes["Source Image"]
+    except KeyError as e:
+        raise ValueError("Compositor missing 'Source Image' node.")
+
+    source_image_node.image = image
+    image.colorspace_settings.name = 'Raw'
+    image.source = 'SEQUENCE'
+
+    # Blender reads file number (scene frame - frame_start + 1 + frame_offset), so
+    # this offset makes scene frame N read file N.
+    source_image_node.frame_duration = frame_end - frame_start + 1
+    source_image_node.frame_start = frame_start
+    source_image_node.frame_offset = frame_start - 1
+    source_image_node.layer = 'View Layer'
+    print(first_src_filepath, "(frames %d-%d)" % (frame_start, frame_end))
+
 
 ## This is a Blender python script. It should
 ## 1. Get from the command line
@@ -167,8 +245,13 @@ def setup_compositor_source_image(src_filepath):
 argv = sys.argv
 argv = argv[argv.index("--") + 1:]  # get all args after "--"
 
+# An optional sixth argument limits the shot to some of its frames; see parse_frame_ranges().
 if len(argv) == 5:
     [shot_list_db_filepath, shot_category, shot_id, quality, slate_number] = argv
+    frames_wanted = None
+elif len(argv) == 6:
+    [shot_list_db_filepath, shot_category, shot_id, quality, slate_number] = argv[:5]
+    frames_wanted = parse_frame_ranges(argv[5])
 else:
     raise ValueError("Not enough command line parameters supplied to compositor_script.py")
 
@@ -188,27 +271,14 @@ scene = bpy.data.scenes[scene_name]
 ## Figure out the incoming filestub from the shot list DB settings
 ##
 
-# Use output path override given in the shot list, if given. Otherwise, fallback on eg. Renders/Title/slate_3/...
-# XXX Duplicate code
-if shot_info.get("output_filepath_override"):
-    incoming_filestub = shot_info.get("output_filepath_override")
-else:
-    output_path_base =  os.path.join(shot_list_db.render_root, shot_info["title"])
-
-    if slate_number is None:
-        slate_number = find_next_slate_number(output_path_base)
-
-    filename =  shot_category + "_" + shot_id + "_" + slate_number + "_"
-    incoming_filestub = os.path.join(output_path_base, "slate_%s/" % str(slate_number)) + filename 
+incoming_filestub = get_composite_source_filestub(shot_list_db, shot_info, shot_category, shot_id, slate_number)
+outgoing_filestub = get_composite_filestub(shot_list_db, shot_info, shot_category, shot_id, slate_number)
 
-incoming_file_format = shot_list_db.get_shot_info(shot_category, shot_id).get("render_file_format", "PNG")
+incoming_file_format = shot_info.get("render_file_format", "PNG")
 incoming_file_extension = IMAGE_FILE_EXTENSIONS[incoming_file_format]
-outgoing_file_format = shot_list_db.get_shot_info(shot_category, shot_id).get("composite_file_format", "PNG")
+outgoing_file_format = shot_info.get("composite_file_format", "PNG")
 outgoing_file_extension = IMAGE_FILE_EXTENSIONS[outgoing_file_format]
 
-filename =  shot_category + "_" + shot_id + "_" + slate_number + "_comp_" 
-outgoing_filestub = os.path.join(output_path_base, "slate_%s_composite/" % str(slate_number)) + filename
-
 ##
 ## Setup the nodes in the compositor chain.
 ##
@@ -228,6 +298,9 @@ scene.render.image_settings.file_format = shot_info.get("composite_file_format",
 scene.render.image_settings.color_mode = shot_info.get("composite_color_mode", 'RGBA')
 scene.render.image_settings.color_depth = shot_info.get("composite_color_depth", "16")
 
+# We may be redoing frames composited with old settings; see below.
+scene.render.use_overwrite = True
+
 ##
 ## Some helper functions
 ##
@@ -249,6 +322,35 @@ def composite_frame(frame_number):
     scene.frame_end = frame_number
     bpy.ops.render.render(animation=True)
 
+    write_composite_record(outgoing_frame_filepath(frame_number), incoming_frame_filepath(frame_number), composite_version)
+
+##
+## In batch mode, we composite each run of consecutive frames with a single render
+## call, rather than loading the image and calling render for every frame. This
+## saves the per-frame setup, which dominates when the compositor chain is light.
+##
+use_batch_mode = parse_boolean(shot_info.get("compositor_batch_mode", False))
+batch_size = shot_info.get("compositor_batch_size", 100)
+
+source_image_cache = SourceImageCache(shot_info.get("compositor_image_cache_size", 1))
+
+def composite_frame_range(frame_start, frame_end):
+    """Composite frames 'frame_start' to 'frame_end' (inclusive) in one render call"""
+    setup_compositor_source_sequence(incoming_frame_filepath(frame_start), frame_start, frame_end)
+
+    ## Set output
+    scene.render.filepath = outgoing_filestub
+
+    scene.frame_start = frame_start
+    scene.frame_end = frame_end
+    bpy.ops.render.render(animation=True)
+
+    # Blender caches the buffer of every frame of the sequence that it read.
+    bpy.data.scenes[0].node_tree.nodes["Source Image"].image.buffers_free()
+
+    for frame_number in range(frame_start, frame_end + 1):
+        write_composite_record(outgoing_frame_filepath(frame_number), incoming_frame_filepath(frame_number), composite_version)
+
 
 ##
 ## Monitor incoming 
@@ -267,33 +369,140 @@ except KeyError as e:
 print("INCOMING FRAME PATH:", incoming_frame_filepath(0))
 print("OUTGOING FRAME PATH:", outgoing_frame_filepath(0))
 
-num_frames = (frame_end - frame_start + 1)
-while True:
-    composited_frames = set(
-        frame_number
-        for frame_number in range(frame_start, frame_end + 1)
-        if os.path.exists(outgoing_frame_filepath(frame_number))
-     )
+frames_in_shot = set(range(frame_start, frame_end + 1))
+if frames_wanted is not None:
+    frames_in_shot &= frames_wanted
+num_frames = len(frames_in_shot)
+
+# Next to each composited frame, we record a hash of the compositor chain and this
+# blend file, and the size and timestamp of the source frame. Frames whose record doesn't match any more,
+# e.g. because someone tweaked the Glare settings, are composited again.
+composite_version = get_composite_version(shot_info, quality, bpy.data.filepath)
+
+stale_frames, num_unrecorded_frames = find_stale_composites(
+                                          scan_frame_numbers(outgoing_filestub, outgoing_file_extension) & frames_in_shot,
+                                          outgoing_frame_filepath,
+                                          incoming_frame_filepath,
+                                          composite_version)
+
+logging.info("Frames composited with out-of-date settings: %s" % (format_frame_ranges(stale_frames) or "none"))
+if num_unrecorded_frames:
+    logging.info("%d composited frames have no version record; assuming they are up-to-date" % num_unrecorded_frames)
 
-    incoming_frames = set(
-        frame_number 
-        for frame_number in range(frame_start, frame_end + 1)
-        if os.path.exists(incoming_frame_filepath(frame_number))
-    )
+# Several compositor processes may be working on this shot (see composite_shot()
+# in render_manager.py). So, before compositing a frame, we claim it with a lock
+# file; if another process already holds the lock, we leave the frame to it.
+lock_timeout = shot_info.get("compositor_lock_timeout", 3600)
 
-    print("INCOMING:", incoming_frames)
-    print("FRAMES ALREADY COMPOSITED:", composited_frames)
+def claim_frames(frames, max_frames):
+    """Claim up to 'max_frames' of 'frames', in order
+
+    Returns (claimed frames, frames already claimed by another process,
+             frames that another process has composited since we last looked)
+    """
+    claimed = []
+    refused = set()
+    already_composited = set()
+    for frame in sorted(frames):
+        if len(claimed) >= max_frames:
+            break
+        is_done = lambda: (os.path.exists(outgoing_frame_filepath(frame))
+                           and is_composite_current(outgoing_frame_filepath(frame), incoming_frame_filepath(frame), composite_version) is not False)
+        result = claim_unfinished_frame(outgoing_frame_filepath(frame), is_done, lock_timeout)
+        if result == FRAME_CLAIMED_ELSEWHERE:
+            refused.add(frame)
+        elif result == FRAME_ALREADY_DONE:
+            already_composited.add(frame)
+        else:
+            claimed.append(frame)
+    return claimed, refused, already_composited
+
+# We track state incrementally, rather than checking every frame of the shot on every
+# pass; on long shots that's a lot of file system traffic. We list the incoming and
+# outgoing directories once per pass; the latter picks up frames composited by other
+# compositor processes. The listing of the incoming directory comes with the
+# timestamps of the frames, so we also see frames that are rendered again while
+# we run, and composite them again.
+composited_frames = set()
+seen_incoming_mtimes = {}
+frames_waiting_to_be_composited = set()
+
+# Log memory use every so often, so that we can check that it stays flat on long runs.
+memory_report_interval = shot_info.get("compositor_memory_report_interval", 50)
+baseline_memory_report = log_memory_report()
+num_frames_composited_since_report = 0
+
+while True:
+    # Only frames that weren't there last time are new; frames whose timestamp
+    # has changed since then have been rendered again.
+    incoming_mtimes = { frame: mtime for (frame, mtime) in scan_frame_mtimes(incoming_filestub, incoming_file_extension).items()
+                        if frame in frames_in_shot }
+    new_incoming_frames = set(incoming_mtimes) - set(seen_incoming_mtimes)
+    rerendered_frames = { frame for frame in incoming_mtimes
+                          if frame in seen_incoming_mtimes and incoming_mtimes[frame] != seen_incoming_mtimes[frame] }
+    seen_incoming_mtimes = incoming_mtimes
+
+    stale_frames |= rerendered_frames
+    composited_frames -= rerendered_frames
+    composited_frames |= (scan_frame_numbers(outgoing_filestub, outgoing_file_extension) & frames_in_shot) - stale_frames
+
+    frames_waiting_to_be_composited |= new_incoming_frames | rerendered_frames
+    frames_waiting_to_be_composited -= composited_frames
+
+    if rerendered_frames:
+        logging.info("Frames rendered again since they were composited: %s" % format_frame_ranges(rerendered_frames))
+    logging.info("New incoming frames: %s; composited %d of %d; waiting: %s" % (
+                     format_frame_ranges(new_incoming_frames) or "none",
+                     len(composited_frames),
+                     num_frames,
+                     format_frame_ranges(frames_waiting_to_be_composited) or "none"))
 
     # Quit when we have composited all frames
     if len(composited_frames) == num_frames:
         logging.info("Composited %d of %d frames; exiting"% (num_frames, num_frames))
+        log_memory_report(baseline_memory_report)
         exit()
 
-    frames_waiting_to_be_composited = incoming_frames - composited_frames
-
-    for frame in frames_waiting_to_be_composited:
-        composite_frame(frame)
-
-    if len(frames_waiting_to_be_composited) == 0:
-        logging.info("No frames waiting to be composited; sleeping 30s")
-        time.sleep(30)
\ No newline at end of file
+    # Frames we couldn't claim are being composited by another process.
+    frames_claimed_elsewhere = set()
+    num_frames_composited_this_pass = 0
+
+    while True:
+        claimed_frames, refused_frames, already_composited_frames = claim_frames(
+                                                                        frames_waiting_to_be_composited - frames_claimed_elsewhere,
+                                                                        batch_size if use_batch_mode else 1)
+        frames_claimed_elsewhere |= refused_frames
+        composited_frames |= already_composited_frames
+        stale_frames -= already_composited_frames
+        frames_waiting_to_be_composited -= already_composited_frames
+
+        if not claimed_frames:
+            break
+
+        try:
+            if use_batch_mode:
+                for (run_start, run_end) in contiguous_frame_ranges(claimed_frames):
+                    composite_frame_range(run_start, run_end)
+            else:
+                for frame in claimed_frames:
+                    composite_frame(frame)
+        finally:
+            for frame in claimed_frames:
+                release_frame(outgoing_frame_filepath(frame))
+
+        composited_frames.update(claimed_frames)
+        stale_frames.difference_update(claimed_frames)
+        frames_waiting_to_be_composited -= composited_frames
+        num_frames_composited_this_pass += len(claimed_frames)
+
+        num_frames_composited_since_report += len(claimed_frames)
+        if num_frames_composited_since_report >= memory_report_interval:
+            log_memory_report(baseline_memory_report)
+            num_frames_composited_since_report = 0
+
+    if num_frames_composited_this_pass == 0:
+        if frames_claimed_elsewhere:
+            logging.info("Frames %s being composited by other processes; sleeping 30s" % format_frame_ranges(frames_claimed_elsewhere))
+        else:
+            logging.info("No frames waiting to be composited; sleeping 30s")
+        time.sleep(30)
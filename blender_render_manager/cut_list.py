@@ -0,0 +1,198 @@
+"""Cut list
+
+Read an edit (a CMX3600 EDL, or a simple CSV cut list) and work out which
+frames of each shot are actually used in the cut, so that FINAL renders can be
+limited to those frames plus some handles, rather than the whole, usually
+generously handled, frame range of the shot.
+
+EDL events are matched to shots by the clip name ("* FROM CLIP NAME:" comment)
+or, failing that, the reel name. A name matches a shot if it is the shot's
+"shot_name" (or "title"), "<category>/<id>", "<category>_<id>", or the name of
+one of its rendered frames/sequences (e.g. "film_1_3_0001.png" or
+"film_1_3_[0001-0240].png"). The source in/out timecodes of the event give the
+frames used; a timecode is converted to a frame number as
+
+    frame_start + (timecode - source_timecode)
+
+if the shot info gives the "source_timecode" of its first frame, or just as the
+number of frames since 00:00:00:00 if it doesn't (which is what you get when
+the frames were conformed with their frame numbers as timecode).
+
+A CSV cut list has a header row and the columns "shot", "in" and "out". "in"
+and "out" are inclusive frame numbers of the shot, or timecodes as above. e.g.
+
+    shot,in,out
+    film/3,1012,1090
+    film_4,00:00:42:00,00:00:45:12
+
+Nothing in here uses bpy.
+
+"""
+import csv
+import os
+import re
+
+from common import *
+
+DEFAULT_FPS = 24
+DEFAULT_HANDLES = 8
+
+EDL_EVENT_PATTERN = re.compile(
+    "([0-9]+)\\s+(\\S+)\\s+(\\S+)\\s+(C|D|W[0-9]*|K\\S*)\\s+(?:[0-9]+\\s+)?"
+    "([0-9]{2}:[0-9]{2}:[0-9]{2}[:;][0-9]{2})\\s+([0-9]{2}:[0-9]{2}:[0-9]{2}[:;][0-9]{2})\\s+"
+    "([0-9]{2}:[0-9]{2}:[0-9]{2}[:;][0-9]{2})\\s+([0-9]{2}:[0-9]{2}:[0-9]{2}[:;][0-9]{2})")
+EDL_CLIP_NAME_PATTERN = re.compile("\\*\\s*FROM CLIP NAME:\\s*(.+)")
+TIMECODE_PATTERN = re.compile("([0-9]{2}):([0-9]{2}):([0-9]{2})[:;]([0-9]{2})")
+
+# Strip a frame number (or range) and extension from a clip name, e.g.
+# "film_1_3_0001.png" / "film_1_3_[0001-0240].png" -> "film_1_3_"
+SEQUENCE_NAME_PATTERN = re.compile("(.*?)(\\[[0-9]+-[0-9]+\\]|#+|[0-9]+)?(\\.[A-Za-z0-9]+)?")
+
+
+def timecode_to_frames(timecode, fps = DEFAULT_FPS):
+    """"hh:mm:ss:ff" -> number of frames since 00:00:00:00 (non drop frame)"""
+    m = TIMECODE_PATTERN.fullmatch(timecode.strip())
+    if not m:
+        raise ValueError("Invalid timecode: " + timecode)
+    (hours, minutes, seconds, frames) = map(int, m.groups())
+    return ((hours * 60 + minutes) * 60 + seconds) * fps + frames
+
+
+def read_edl(filepath):
+    """Read the events of a CMX3600 EDL
+
+    Returns a list of dicts with "name" (clip name, or reel if there isn't
+    one), "reel", "source_in" and "source_out" (timecodes; out is exclusive,
+    as in the EDL).
+    """
+    events = []
+    with open(filepath, "r", encoding = "utf-8", errors = "replace") as f:
+        for line in f:
+            line = line.strip()
+
+            m = EDL_EVENT_PATTERN.match(line)
+            if m:
+                # Only video events; the cut's audio doesn't tell us about frames.
+                if not m.group(3).upper().startswith("V"):
+                    continue
+                events.append({"name": m.group(2), "reel": m.group(2),
+                               "source_in": m.group(5), "source_out": m.group(6),
+                               "exclusive_out": True})
+                continue
+
+            m = EDL_CLIP_NAME_PATTERN.match(line)
+            if m and events:
+                events[-1]["name"] = m.group(1).strip()
+
+    return events
+
+
+def read_csv_cut_list(filepath):
+    """Read a CSV cut list; see the module docstring. Returns events like read_edl()"""
+    events = []
+    with open(filepath, "r", newline = "", encoding = "utf-8-sig") as f:
+        for row in csv.DictReader(f):
+            row = { key.strip().lower(): (value or "").strip() for (key, value) in row.items() if key }
+            if not row.get("shot"):
+                continue
+            events.append({"name": row["shot"], "reel": None,
+                           "source_in": row["in"], "source_out": row["out"],
+                           "exclusive_out": False})
+
+    return events
+
+
+def read_cut_list(filepath):
+    """Read an EDL or a CSV cut list, depending on the file extension"""
+    if os.path.splitext(filepath)[1].lower() == ".csv":
+        return read_csv_cut_list(filepath)
+    else:
+        return read_edl(filepath)
+
+
+def get_shot_names(shot_list_db, shot_category, shot_id):
+    """Names that an edit might use for a shot; see the module docstring"""
+    shot_info = shot_list_db.get_shot_info(shot_category, shot_id)
+    names = { "%s/%s" % (shot_category, shot_id), "%s_%s" % (shot_category, shot_id) }
+
+    for key in ["shot_name", "title"]:
+        if shot_info.get(key):
+            names.add(str(shot_info[key]))
+
+    # The rendered frames of any slate are "<category>_<id>_<slate>_", or the output override.
+    if shot_info.get("output_filepath_override"):
+        names.add(os.path.basename(shot_info["output_filepath_override"]))
+
+    return { name.lower() for name in names }
+
+
+def match_shot(name, shot_names):
+    """Find the (category, id) of the shot that a clip name refers to, or None"""
+    name = name.strip().lower()
+    stem = SEQUENCE_NAME_PATTERN.fullmatch(name).group(1)
+
+    for (shot, names) in shot_names.items():
+        if name in names or stem.rstrip("_.") in names or stem in names:
+            return shot
+
+    # A rendered sequence: "<category>_<id>_<slate>_"
+    for shot in shot_names:
+        prefix = ("%s_%s_" % shot).lower()
+        if stem.startswith(prefix) and stem[len(prefix):].rstrip("_").isdigit():
+            return shot
+
+    return None
+
+
+def event_frames(event, shot_info, fps = DEFAULT_FPS):
+    """Return the (first, last) frame of the shot used by an event"""
+    def to_frame(value):
+        if TIMECODE_PATTERN.fullmatch(value):
+            frame = timecode_to_frames(value, fps)
+            if "source_timecode" in shot_info:
+                frame += shot_info.get("frame_start", 0) - timecode_to_frames(shot_info["source_timecode"], fps)
+            return frame
+        return int(value)
+
+    first = to_frame(event["source_in"])
+    last = to_frame(event["source_out"]) - (1 if event["exclusive_out"] else 0)
+    return (min(first, last), max(first, last))
+
+
+def get_cut_frame_ranges(shot_list_db, events, handles = DEFAULT_HANDLES, fps = DEFAULT_FPS):
+    """Work out the frames of each shot to render for an edit
+
+    Each event's frames are extended by 'handles' frames at each end (or the
+    shot's "cut_handles", if it has them), clipped to the shot's frame range
+    and merged with the shot's other events.
+
+    Returns ({(category, id): [(first, last), ...]}, [names of events that didn't match a shot]).
+    """
+    shot_names = { (category, shot_id): get_shot_names(shot_list_db, category, shot_id)
+                   for (category, shot_id) in shot_list_db.shot_ids }
+
+    shot_frames = {}
+    unmatched = []
+    for event in events:
+        shot = match_shot(event["name"], shot_names)
+        if shot is None and event.get("reel"):
+            shot = match_shot(event["reel"], shot_names)
+        if shot is None:
+            unmatched.append(event["name"])
+            continue
+
+        shot_info = shot_list_db.get_shot_info(*shot)
+        shot_handles = shot_info.get("cut_handles", handles)
+        (first, last) = event_frames(event, shot_info, shot_info.get("fps", fps))
+        first -= shot_handles
+        last += shot_handles
+
+        frame_range = get_frame_range(shot_info)
+        if frame_range:
+            (first, last) = (max(first, frame_range[0]), min(last, frame_range[1]))
+        if first > last:
+            continue
+
+        shot_frames.setdefault(shot, set()).update(range(first, last + 1))
+
+    return ({ shot: contiguous_frame_ranges(frames) for (shot, frames) in shot_frames.items() }, unmatched)
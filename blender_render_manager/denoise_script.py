@@ -0,0 +1,245 @@
+"""Blender script to denoise shots rendered with render_manager
+
+For shots with "denoise_enabled": true, render_script.py leaves the rendered
+frames noisy and stores Cycles' denoise passes (albedo and normal; see
+"denoise_data" in render_script.py) in the default SEPARATE output mode. This
+denoises the frames afterwards, on the CPU, with the compositor's Denoise node
+(Open Image Denoise), so that GPU machines can get on with rendering the next
+shot.
+
+The denoised frames go in a directory next to the slate; e.g. for frames in
+
+  Renders/Title/slate_3/film_1_3_0001.exr
+
+we write
+
+  Renders/Title/slate_3_denoised/film_1_3_dn_0001.exr
+
+and the compositor composites those, rather than the noisy frames. Like
+composited frames, each denoised frame has a record of the settings it was made
+with, so changing the "denoise" settings of the shot denoises it again without
+rendering it again; e.g.
+
+    "denoise": {
+        "prefilter": "ACCURATE",
+        "use_hdr": true,
+        "view_layer": "View Layer"
+    }
+
+"use_hdr" defaults to true for EXR frames. "view_layer" says whose denoise
+passes to use, if the shot renders more than one view layer.
+
+Doesn't need the shot's blend file:
+
+  blender -b --factory-startup --python denoise_script.py -- <shot list> <category> <id> <slate>
+
+"""
+import bpy
+import sys
+import os
+import functools
+import logging
+import time
+
+logging.getLogger().setLevel(logging.INFO)
+
+# Find the directory where this file (denoise_script.py) resides
+# NOTE: This will break if os.chdir() is called before this line runs
+script_py_path = os.path.dirname(os.path.realpath(__file__))
+
+# Append this directory to path, so that we can find "shot_list_db.py"
+sys.path.append(script_py_path)
+
+import shot_list_db
+from common import *
+
+DENOISE_PASSES = ["denoise_albedo", "denoise_normal"]
+
+def setup_denoise_nodes(scene, denoise_db, use_hdr):
+    """Replace the compositor nodes of 'scene' with Image -> Denoise -> Composite
+
+    Returns {"image": node, "denoise_albedo": node, "denoise_normal": node}
+    """
+    scene.use_nodes = True
+    tree = scene.node_tree
+    tree.nodes.clear()
+
+    image_nodes = {}
+    for (i, name) in enumerate(["image"] + DENOISE_PASSES):
+        node = tree.nodes.new(type = "CompositorNodeImage")
+        node.location = (0, -300 * i)
+        image_nodes[name] = node
+
+    denoise_node = tree.nodes.new(type = "CompositorNodeDenoise")
+    denoise_node.location = (300, 0)
+    denoise_node.prefilter = denoise_db.get("prefilter", "ACCURATE")
+    denoise_node.use_hdr = use_hdr
+
+    composite_node = tree.nodes.new(type = "CompositorNodeComposite")
+    composite_node.location = (600, 0)
+
+    tree.links.new(image_nodes["image"].outputs["Image"], denoise_node.inputs["Image"])
+    tree.links.new(image_nodes["denoise_normal"].outputs["Image"], denoise_node.inputs["Normal"])
+    tree.links.new(image_nodes["denoise_albedo"].outputs["Image"], denoise_node.inputs["Albedo"])
+    tree.links.new(denoise_node.outputs["Image"], composite_node.inputs["Image"])
+    # Keep the alpha of the render; the denoiser only does colour.
+    tree.links.new(image_nodes["image"].outputs["Alpha"], composite_node.inputs["Alpha"])
+
+    return image_nodes
+
+def load_image(node, filepath):
+    """Point an Image node at 'filepath', removing the image it had before"""
+    old_image = node.image
+    image = bpy.data.images.load(filepath)
+    image.colorspace_settings.name = 'Raw'
+    node.image = image
+    if old_image is not None:
+        bpy.data.images.remove(old_image)
+    return image
+
+
+## This is a Blender python script. It should
+## 1. Get the shot list, shot and slate from the command line
+## 2. Set up a compositor node tree that denoises an image with its albedo and normal
+## 3. Set the output format to the render's, so the denoised frames can replace the noisy ones
+## 4. Denoise every rendered frame whose passes are there and which hasn't been
+##    denoised with the current settings, claiming each with a lock file so that
+##    several machines can share the shot
+## 5. Loop back to 4 until all the frames of the shot are denoised
+
+
+# Parse command line
+#
+argv = sys.argv
+argv = argv[argv.index("--") + 1:]  # get all args after "--"
+
+# An optional fifth argument limits the shot to some of its frames; see parse_frame_ranges().
+if len(argv) == 4:
+    [shot_list_db_filepath, shot_category, shot_id, slate_number] = argv
+    frames_wanted = None
+elif len(argv) == 5:
+    [shot_list_db_filepath, shot_category, shot_id, slate_number] = argv[:4]
+    frames_wanted = parse_frame_ranges(argv[4])
+else:
+    raise ValueError("Not enough command line parameters supplied to denoise_script.py")
+
+shot_list_db = shot_list_db.ShotListDb.from_file(shot_list_db_filepath)
+shot_info = shot_list_db.get_shot_info(shot_category, shot_id)
+denoise_db = shot_info.get("denoise", {})
+
+try:
+    (frame_start, frame_end) = get_frame_range(shot_info)
+except TypeError as e:
+    raise Exception("For denoising, 'frame_start' and 'frame_end' must be specified in the JSON shot-info file") from e
+
+##
+## Where the frames come from and go to
+##
+incoming_filestub = get_render_filestub(shot_list_db, shot_info, shot_category, shot_id, slate_number)
+outgoing_filestub = get_denoise_filestub(shot_list_db, shot_info, shot_category, shot_id, slate_number)
+
+file_format = shot_info.get("render_file_format", "PNG")
+file_extension = IMAGE_FILE_EXTENSIONS[file_format]
+
+passes_dir = get_render_passes_dir(os.path.dirname(incoming_filestub), denoise_db.get("view_layer"))
+
+frame_filepath = lambda filestub, file_extension, frame_number: filestub + ("%04d" % frame_number) + "." + file_extension
+incoming_frame_filepath = functools.partial(frame_filepath, incoming_filestub, file_extension)
+outgoing_frame_filepath = functools.partial(frame_filepath, outgoing_filestub, file_extension)
+pass_frame_filepaths = { name: functools.partial(frame_filepath, os.path.join(passes_dir, name, name + "_"), "exr")
+                         for name in DENOISE_PASSES }
+
+##
+## Set up the scene
+##
+scene = bpy.context.scene
+image_nodes = setup_denoise_nodes(scene, denoise_db, parse_boolean(denoise_db.get("use_hdr", file_format.startswith("OPEN_EXR"))))
+
+# There's no Render Layers node, so rendering only runs the compositor.
+scene.render.engine = 'CYCLES'
+scene.cycles.device = 'CPU'
+scene.render.use_compositing = True
+scene.render.use_sequencer = False
+scene.render.resolution_percentage = 100
+
+# Write the pixels as they are; the frames were already display transformed (or are linear EXRs).
+scene.view_settings.view_transform = 'Raw'
+scene.view_settings.look = 'None'
+scene.render.image_settings.file_format = file_format
+scene.render.image_settings.color_mode = shot_info.get("render_color_mode", 'RGBA')
+scene.render.image_settings.color_depth = shot_info.get("render_color_depth", "16")
+if file_format.startswith("OPEN_EXR"):
+    scene.render.image_settings.exr_codec = shot_info.get("render_exr_codec", "DWAA")
+
+def denoise_frame(frame_number):
+    """Denoise a single frame"""
+    image = load_image(image_nodes["image"], incoming_frame_filepath(frame_number))
+    for name in DENOISE_PASSES:
+        load_image(image_nodes[name], pass_frame_filepaths[name](frame_number))
+
+    (scene.render.resolution_x, scene.render.resolution_y) = image.size
+
+    # Write the frame under a temporary name, and only put it in place once its
+    # record is written; so a denoised frame always has a record.
+    os.makedirs(os.path.dirname(outgoing_filestub), exist_ok = True)
+    (frame_base, frame_ext) = os.path.splitext(outgoing_frame_filepath(frame_number))
+    scene.render.filepath = frame_base + ".tmp" + frame_ext
+    bpy.ops.render.render(write_still = True)
+
+    write_composite_record(outgoing_frame_filepath(frame_number), incoming_frame_filepath(frame_number), denoise_version)
+    os.replace(frame_base + ".tmp" + frame_ext, outgoing_frame_filepath(frame_number))
+
+##
+## Denoise the frames as they arrive
+##
+frames_in_shot = set(range(frame_start, frame_end + 1))
+if frames_wanted is not None:
+    frames_in_shot &= frames_wanted
+
+# Like the compositor; frames denoised with other settings, or from an older
+# render of the frame, are done again.
+denoise_version = get_denoise_version(shot_info, os.path.realpath(__file__))
+lock_timeout = shot_info.get("denoise_lock_timeout", 3600)
+
+print("INCOMING FRAME PATH:", incoming_frame_filepath(0))
+print("OUTGOING FRAME PATH:", outgoing_frame_filepath(0))
+
+while True:
+    # Frames are ready once the render and both passes are on disk.
+    ready_frames = scan_frame_numbers(incoming_filestub, file_extension) & frames_in_shot
+    for name in DENOISE_PASSES:
+        ready_frames &= scan_frame_numbers(os.path.join(passes_dir, name, name + "_"), "exr")
+
+    # Unlike composites, every denoised frame should have a record; one without
+    # is left over from a crash, and is done again.
+    denoised_frames = scan_frame_numbers(outgoing_filestub, file_extension) & frames_in_shot
+    stale_frames = { frame for frame in denoised_frames
+                     if not is_composite_current(outgoing_frame_filepath(frame), incoming_frame_filepath(frame), denoise_version) }
+    denoised_frames -= stale_frames
+
+    if denoised_frames == frames_in_shot:
+        logging.info("Denoised %d of %d frames; exiting" % (len(frames_in_shot), len(frames_in_shot)))
+        break
+
+    frames_to_denoise = sorted(ready_frames - denoised_frames)
+    logging.info("Denoised %d of %d; to denoise: %s; stale: %s" % (
+                     len(denoised_frames), len(frames_in_shot),
+                     format_frame_ranges(frames_to_denoise) or "none",
+                     format_frame_ranges(stale_frames) or "none"))
+
+    num_denoised = 0
+    for frame in frames_to_denoise:
+        # Another process may have denoised it since we looked.
+        is_done = lambda: (os.path.exists(outgoing_frame_filepath(frame))
+                           and is_composite_current(outgoing_frame_filepath(frame), incoming_frame_filepath(frame), denoise_version) is True)
+        if claim_unfinished_frame(outgoing_frame_filepath(frame), is_done, lock_timeout) != FRAME_CLAIMED:
+            continue
+        try:
+            denoise_frame(frame)
+            num_denoised += 1
+        finally:
+            release_frame(outgoing_frame_filepath(frame))
+
+    if num_denoised == 0:
+        logging.info("No frames ready to denoise; sleeping 30s")
+        time.sleep(30)
@@ -0,0 +1,236 @@
+"""Frame interpolator
+
+Fill in the frames of a SPARSE quality render. At SPARSE quality,
+render_script.py renders only every "sparse_frame_step"th frame of the shot
+(and the last frame), at LOW quality settings; this fills the gaps between
+them to make a full length sequence for animatics and blocking.
+
+The in-between frames are made by warping the rendered frames on either side
+of the gap towards each other along their motion, and cross-fading:
+
+- If the shot writes a "vector" render pass (in the default SEPARATE output
+  mode, see configure_render_passes() in render_script.py), we use Blender's
+  own motion vectors. Each rendered frame's vectors give its motion to the
+  next frame (and from the previous one), which we extend linearly across the
+  gap. When more than one view layer is rendered, each writes its own vector
+  pass; "sparse_vector_view_layer" says whose to use, and must be given if
+  more than one has vectors. We can't read the passes out of MULTILAYER EXRs,
+  so shots that write the vector pass in that mode are refused, rather than
+  quietly interpolated without their vectors.
+
+- Otherwise, we fall back on optical flow with ffmpeg's minterpolate filter,
+  if ffmpeg can be found (on the PATH, or set FFMPEG to its path).
+
+- Failing that, the frames are just cross-faded.
+
+Interpolated frames are written in place of the missing frames, so the slate
+looks complete, and listed in <frames>interpolated.json, so that they can be
+told apart from rendered ones.
+
+"""
+import os
+import json
+import shutil
+import logging
+import tempfile
+import subprocess
+
+import numpy as np
+
+import image_io
+from common import *
+
+logging.basicConfig(level=logging.INFO)
+
+
+def _warp(pixels, flow_x, flow_y):
+    """Backward warp: out[y, x] = pixels[y + flow_y, x + flow_x], clamped at the edges"""
+    import cv2
+
+    (height, width) = pixels.shape[:2]
+    (grid_y, grid_x) = np.mgrid[0:height, 0:width].astype(np.float32)
+    return cv2.remap(pixels, grid_x + flow_x, grid_y + flow_y,
+                     interpolation = cv2.INTER_LINEAR, borderMode = cv2.BORDER_REPLICATE)
+
+
+def interpolate_with_vectors(frame_a, frame_b, vectors_a, vectors_b, gap, offset):
+    """Make the frame 'offset' frames after frame_a, of a 'gap' frame gap to frame_b
+
+    vectors_a/b: The vector passes of the two frames. Blender's vector pass
+                 holds, in pixels with y up, the motion from the previous frame
+                 in RG and the motion to the next frame in BA.
+    """
+    t = offset / gap
+
+    # Where each pixel was in frame_a: move back along frame_a's motion to the next frame...
+    from_a = _warp(frame_a, -offset * vectors_a[:, :, 2], offset * vectors_a[:, :, 3])
+    # ... and where it will be in frame_b: forward along frame_b's motion from the previous frame.
+    from_b = _warp(frame_b, (gap - offset) * vectors_b[:, :, 0], -(gap - offset) * vectors_b[:, :, 1])
+
+    return (1.0 - t) * from_a + t * from_b
+
+
+def crossfade(frame_a, frame_b, gap, offset):
+    t = offset / gap
+    return (1.0 - t) * frame_a + t * frame_b
+
+
+def find_ffmpeg():
+    return os.environ.get("FFMPEG") or shutil.which("ffmpeg")
+
+
+def interpolate_with_ffmpeg(ffmpeg, keyframe_filepaths, frame_step):
+    """Interpolate evenly spaced keyframes with ffmpeg's motion compensated minterpolate
+
+    Returns a list of float RGBA frames; frame i is at i/frame_step of the way
+    through the keyframes.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # ffmpeg wants a numbered sequence with no gaps; and PNGs, since it
+        # can't be relied on to read every EXR.
+        for (i, keyframe_filepath) in enumerate(keyframe_filepaths):
+            image_io.write_image(os.path.join(tmp_dir, "key_%04d.png" % i), image_io.read_image(keyframe_filepath),
+                                 file_format = "PNG", color_depth = "16", color_mode = "RGBA")
+
+        cmd = [ffmpeg, "-y", "-loglevel", "error",
+               "-framerate", "1", "-start_number", "0", "-i", os.path.join(tmp_dir, "key_%04d.png"),
+               "-vf", "minterpolate=fps=%d:mi_mode=mci:mc_mode=aobmc:me_mode=bidir" % frame_step,
+               "-pix_fmt", "rgba64be", "-start_number", "0", os.path.join(tmp_dir, "out_%04d.png")]
+        subprocess.run(cmd, check = True)
+
+        num_frames = (len(keyframe_filepaths) - 1) * frame_step + 1
+        return [ image_io.read_image(os.path.join(tmp_dir, "out_%04d.png" % i)) for i in range(num_frames)
+                 if os.path.exists(os.path.join(tmp_dir, "out_%04d.png" % i)) ]
+
+
+def find_vector_filestub(shot_info, render_filestub):
+    """Filestub of the vector pass frames of a shot (see get_render_passes_dir()), or None if it doesn't write them
+
+    Raises ValueError if the shot writes vectors that we can't use.
+    """
+    render_passes_db = shot_info.get("render_passes", {})
+    if not render_passes_db.get("vector", False):
+        return None
+
+    if render_passes_db.get("output_mode", "SEPARATE").upper() != "SEPARATE":
+        raise ValueError("Can't interpolate with the vector pass of MULTILAYER render passes; "
+                         "use \"output_mode\": \"SEPARATE\", or turn the vector pass off to interpolate without it")
+
+    passes_dir = get_render_passes_dir(os.path.dirname(render_filestub))
+    view_layer_name = shot_info.get("sparse_vector_view_layer")
+    if view_layer_name:
+        return os.path.join(get_render_passes_dir(os.path.dirname(render_filestub), view_layer_name), "vector", "vector_")
+
+    # Just the one view layer: passes/vector; otherwise passes/<view layer>/vector
+    if os.path.isdir(os.path.join(passes_dir, "vector")):
+        return os.path.join(passes_dir, "vector", "vector_")
+
+    try:
+        view_layer_names = sorted(name for name in os.listdir(passes_dir)
+                                  if os.path.isdir(os.path.join(passes_dir, name, "vector")))
+    except FileNotFoundError:
+        view_layer_names = []
+
+    if len(view_layer_names) > 1:
+        raise ValueError("View layers %s all have vector passes; set \"sparse_vector_view_layer\" to say which to use"
+                         % ", ".join(view_layer_names))
+    if view_layer_names:
+        return os.path.join(get_render_passes_dir(os.path.dirname(render_filestub), view_layer_names[0]), "vector", "vector_")
+
+    # Not rendered yet.
+    return os.path.join(passes_dir, "vector", "vector_")
+
+
+def interpolate_shot(shot_list_db, shot_category, shot_id, slate):
+    """Fill in the frames missing between the rendered frames of a SPARSE render. Returns the number of frames made"""
+    shot_info = shot_list_db.get_shot_info(shot_category, shot_id)
+    frame_range = get_frame_range(shot_info)
+    if frame_range is None:
+        raise ValueError("Shot %s/%s needs a frame range to be interpolated" % (shot_category, shot_id))
+
+    render_filestub = get_render_filestub(shot_list_db, shot_info, shot_category, shot_id, slate)
+    file_format = shot_info.get("render_file_format", "PNG")
+    ext = IMAGE_FILE_EXTENSIONS[file_format]
+    output_settings = {
+        "file_format": file_format,
+        "color_depth": shot_info.get("render_color_depth", "16"),
+        "color_mode": shot_info.get("render_color_mode", "RGBA"),
+        "exr_codec": shot_info.get("render_exr_codec", "DWAA"),
+    }
+
+    def frame_filepath(frame):
+        return render_filestub + ("%04d" % frame) + "." + ext
+
+    vector_filestub = find_vector_filestub(shot_info, render_filestub)
+    def vector_filepath(frame):
+        return vector_filestub + ("%04d" % frame) + ".exr" if vector_filestub else ""
+
+    # Frames that we interpolated on an earlier run don't count as keyframes.
+    record_filepath = render_filestub + "interpolated.json"
+    try:
+        with open(record_filepath) as f:
+            record = json.load(f)
+    except (OSError, ValueError):
+        record = {"frames": {}}
+
+    on_disk = scan_frame_numbers(render_filestub, ext)
+    keyframes = sorted(frame for frame in on_disk
+                       if frame_range[0] <= frame <= frame_range[1] and str(frame) not in record["frames"])
+
+    # Wait for all the sparse frames; if we filled in the gap left by one that
+    # failed, it would never be rendered.
+    frame_step = shot_info.get("sparse_frame_step", 4)
+    missing_keyframes = set(get_sparse_frames(frame_range[0], frame_range[1], frame_step)) - set(keyframes)
+    if missing_keyframes:
+        logging.info("Not interpolating %s/%s; frames %s not rendered yet" % (shot_category, shot_id, format_frame_ranges(missing_keyframes)))
+        return 0
+
+    ffmpeg = find_ffmpeg()
+    num_made = 0
+
+    gaps = [ (a, b) for (a, b) in zip(keyframes, keyframes[1:]) if any(f not in on_disk for f in range(a + 1, b)) ]
+
+    # ffmpeg works on the whole sequence at once, but only for evenly spaced
+    # keyframes; a keyframe missing from the middle would throw the timing out.
+    ffmpeg_frames = {}
+    even_keyframes = [ frame for frame in keyframes if (frame - keyframes[0]) % frame_step == 0 ] if keyframes else []
+    if (ffmpeg
+        and len(even_keyframes) > 1
+        and even_keyframes == list(range(keyframes[0], even_keyframes[-1] + 1, frame_step))
+        and not all(os.path.exists(vector_filepath(a)) and os.path.exists(vector_filepath(b)) for (a, b) in gaps)):
+        try:
+            for (i, pixels) in enumerate(interpolate_with_ffmpeg(ffmpeg, [ frame_filepath(frame) for frame in even_keyframes ], frame_step)):
+                ffmpeg_frames[keyframes[0] + i] = pixels
+        except (subprocess.CalledProcessError, OSError):
+            logging.exception("ffmpeg interpolation failed; falling back to cross-fading")
+
+    for (a, b) in gaps:
+        frame_a = image_io.read_image(frame_filepath(a))
+        frame_b = image_io.read_image(frame_filepath(b))
+        gap = b - a
+
+        use_vectors = os.path.exists(vector_filepath(a)) and os.path.exists(vector_filepath(b))
+        if use_vectors:
+            vectors_a = image_io.read_image(vector_filepath(a))
+            vectors_b = image_io.read_image(vector_filepath(b))
+
+        for frame in range(a + 1, b):
+            if frame in on_disk:
+                continue
+
+            if use_vectors:
+                (method, pixels) = ("VECTOR", interpolate_with_vectors(frame_a, frame_b, vectors_a, vectors_b, gap, frame - a))
+            elif frame in ffmpeg_frames and gap == frame_step:
+                (method, pixels) = ("FFMPEG", ffmpeg_frames[frame])
+            else:
+                (method, pixels) = ("CROSSFADE", crossfade(frame_a, frame_b, gap, frame - a))
+
+            image_io.write_image(frame_filepath(frame), pixels, **output_settings)
+            record["frames"][str(frame)] = method
+            num_made += 1
+
+    with open(record_filepath, "w") as f:
+        json.dump(record, f, indent = 2)
+
+    logging.info("Interpolated %d frame(s) of %s/%s" % (num_made, shot_category, shot_id))
+    return num_made
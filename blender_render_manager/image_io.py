@@ -0,0 +1,103 @@
+"""Image I/O outside Blender
+
+Read and write rendered frames as NumPy arrays, so that we can work on them
+without launching Blender. We use OpenCV for the file formats, because it
+handles 16-bit PNG/TIFF and (with OPENCV_IO_ENABLE_OPENEXR set) EXR.
+
+Pixels are always float32 arrays of shape (height, width, 4) in RGBA order.
+Integer formats are scaled to 0..1, but no colour space conversion is done;
+i.e. the values are treated as 'Raw', like the compositor does.
+
+"""
+import os
+
+import numpy as np
+
+# OpenCV disables EXR support unless this is set before it is imported.
+os.environ.setdefault("OPENCV_IO_ENABLE_OPENEXR", "1")
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+
+def is_available():
+    """True if the libraries needed to read and write frames are installed"""
+    return cv2 is not None
+
+
+def _require_cv2():
+    if cv2 is None:
+        raise ImportError("image_io needs OpenCV; pip install opencv-python")
+
+
+def read_image(filepath):
+    """Read an image file into a float32 RGBA array"""
+    _require_cv2()
+
+    pixels = cv2.imread(filepath, cv2.IMREAD_UNCHANGED)
+    if pixels is None:
+        raise IOError("Failed to read image \"%s\"" % filepath)
+
+    if pixels.dtype == np.uint8:
+        pixels = pixels.astype(np.float32) / 255.0
+    elif pixels.dtype == np.uint16:
+        pixels = pixels.astype(np.float32) / 65535.0
+    else:
+        pixels = pixels.astype(np.float32)
+
+    # Greyscale -> RGB; then OpenCV's BGR(A) -> RGBA
+    if pixels.ndim == 2:
+        pixels = np.repeat(pixels[:, :, np.newaxis], 3, axis = 2)
+
+    if pixels.shape[2] == 3:
+        alpha = np.ones(pixels.shape[:2] + (1,), dtype = np.float32)
+        return np.concatenate([pixels[:, :, 2::-1], alpha], axis = 2)
+    else:
+        return pixels[:, :, [2, 1, 0, 3]]
+
+
+def write_image(filepath, pixels, file_format = "PNG", color_depth = "16", color_mode = "RGBA", exr_codec = None):
+    """Write a float32 RGBA array to an image file
+
+    The arguments follow Blender's image settings; e.g. file_format "PNG" or
+    "OPEN_EXR", color_depth "8", "16" or "32" and color_mode "BW", "RGB" or "RGBA".
+
+    The file is written under a temporary name and then renamed, so that
+    anyone watching the directory never sees a partly written frame.
+    """
+    _require_cv2()
+
+    if color_mode == "BW":
+        out = pixels[:, :, 0:3].mean(axis = 2)
+    elif color_mode == "RGB":
+        out = pixels[:, :, 2::-1]
+    else:
+        out = pixels[:, :, [2, 1, 0, 3]]
+
+    params = []
+    if file_format == "OPEN_EXR":
+        out = out.astype(np.float32)
+        params += [cv2.IMWRITE_EXR_TYPE,
+                   cv2.IMWRITE_EXR_TYPE_HALF if str(color_depth) == "16" else cv2.IMWRITE_EXR_TYPE_FLOAT]
+
+        # Only newer versions of OpenCV let us choose the compression.
+        exr_compression = getattr(cv2, "IMWRITE_EXR_COMPRESSION_" + str(exr_codec), None) if exr_codec else None
+        if exr_compression is not None:
+            params += [cv2.IMWRITE_EXR_COMPRESSION, exr_compression]
+    elif file_format in ["PNG", "TIFF"] and str(color_depth) == "16":
+        out = np.round(np.clip(out, 0.0, 1.0) * 65535.0).astype(np.uint16)
+    elif file_format in ["PNG", "TIFF", "JPEG"]:
+        out = np.round(np.clip(out, 0.0, 1.0) * 255.0).astype(np.uint8)
+    else:
+        raise ValueError("Unsupported file format \"%s\"" % file_format)
+
+    directory, filename = os.path.split(filepath)
+    name, extension = os.path.splitext(filename)
+    tmp_filepath = os.path.join(directory, name + ".tmp" + extension)
+
+    os.makedirs(directory or ".", exist_ok = True)
+    if not cv2.imwrite(tmp_filepath, out, params):
+        raise IOError("Failed to write image \"%s\"" % filepath)
+    os.replace(tmp_filepath, filepath)
@@ -0,0 +1,537 @@
+"""NumPy compositor
+
+An out-of-Blender replacement for compositor_script.py for shots whose
+compositor chain only uses simple nodes. Starting Blender is most of the cost
+of compositing a frame through a light chain, so, for these shots, we apply the
+chain to the frames with NumPy in a pool of worker processes instead.
+
+It interprets the same "compositor_chain" section of the shot list as
+configure_compositor_chain() in compositor_script.py. The supported nodes are:
+
+    "Exposure":         exposure
+    "Lens Distortion":  distortion, dispersion, use_fit
+                        (use_projector and use_jitter must be false)
+    "Filter":           filter_type "SOFTEN", factor
+    "Blur":             filter_type "GAUSS", size_x, size_y, size
+                        (use_variable_size, use_bokeh and use_relative must be false)
+
+Any other node must be muted; nodes missing from the chain are assumed to be
+muted. Since we can't see the blend file, the chain must say what every node
+does; e.g. "filter_type" must be given explicitly. Nodes are applied in the order of CHAIN_ORDER, which matches
+the default compositor chain blend file.
+
+Frames are read 'Raw' and written without a view transform, which matches a
+compositor blend file that uses the 'Raw' view transform. Like Blender, we
+write frames at the render resolution of the quality given: "target_resolution"
+scaled by the quality's "resolution_percentage"; frames of another size, e.g.
+rendered at another quality, are resized to it after the chain. Lens Distortion with
+dispersion is an approximation: each channel is sampled once at its own
+distortion, without the spectral blending that Blender does between channels.
+Use VERIFY to check the output against frames composited by Blender.
+
+render_manager.py's composite_shot() runs this instead of Blender when the shot
+has "compositor_engine": "NUMPY" or "AUTO" and the chain is supported.
+
+Usage:
+
+  numpy_compositor.py <shot list> <category> <id> <quality> <slate>
+  numpy_compositor.py VERIFY <shot list> <category> <id> <quality> <slate> [tolerance] [max frames]
+
+VERIFY composites frames that Blender has already composited, in memory, and
+reports the difference per frame. It fails if the mean absolute difference of
+any frame exceeds 'tolerance' (default 0.01).
+
+A frame that fails to composite, e.g. because it was read while still being
+written, is tried again after a delay that doubles with each failure, up to
+"numpy_compositor_max_attempts" (default 5) times; then it is given up on, and
+the compositor exits with an error once the rest of the shot is done.
+
+"""
+import sys
+import os
+import logging
+import multiprocessing
+import time
+
+import numpy as np
+
+# Append this directory to path, so that we can find "shot_list_db.py"
+sys.path.append(os.path.dirname(os.path.realpath(__file__)))
+
+import shot_list_db
+import image_io
+from common import *
+
+logging.basicConfig(level=logging.INFO)
+
+# The order in which the nodes are connected in the default compositor chain.
+CHAIN_ORDER = ["Exposure", "Denoise", "Vector Blur", "Glare", "Lens Distortion", "Filter", "Blur"]
+
+OUTPUT_FILE_FORMATS = ["PNG", "TIFF", "JPEG", "OPEN_EXR"]
+
+DEFAULT_MAX_ATTEMPTS = 5
+RETRY_DELAY = 30
+MAX_RETRY_DELAY = 600
+
+###
+### Nodes
+###
+
+def exposure(pixels, exposure = 0.0):
+    pixels[:, :, 0:3] *= 2.0 ** exposure
+    return pixels
+
+def soften(pixels, factor = 1.0):
+    """Blender's Filter node with filter_type SOFTEN"""
+    kernel = np.array([1.0, 2.0, 1.0], dtype = np.float32) / 4.0
+    filtered = _convolve_separable(pixels, kernel, kernel)
+    return pixels + factor * (filtered - pixels)
+
+def gaussian_blur(pixels, size_x = 0, size_y = 0, size = 1.0):
+    """Blender's Blur node with filter_type GAUSS
+
+    Blender's Gaussian filter falls to (nearly) zero at the given radius; i.e. the
+    standard deviation is a third of the radius.
+    """
+    def kernel(radius):
+        radius = int(round(radius))
+        if radius < 1:
+            return np.ones(1, dtype = np.float32)
+        x = np.arange(-radius, radius + 1, dtype = np.float32)
+        return np.exp(-0.5 * (3.0 * x / radius) ** 2)
+
+    return _convolve_separable(pixels, kernel(size_x * size), kernel(size_y * size))
+
+def lens_distortion(pixels, distortion = 0.0, dispersion = 0.0, use_fit = False):
+    """Blender's Lens Distortion node, without jitter or projector mode"""
+    (height, width) = pixels.shape[:2]
+
+    k_green = min(max(distortion, -0.999), 1.0)
+    d = 0.25 * min(max(dispersion, 0.0), 1.0)
+    k = [ min(max(k_green + d, -0.999), 1.0), k_green, min(max(k_green - d, -0.999), 1.0) ]
+
+    max_k = max(k)
+    sc = 1.0 / (1.0 + 2.0 * max_k) if (use_fit and max_k > 0.0) else 1.0 / (1.0 + max_k)
+
+    cx = 0.5 * width
+    cy = 0.5 * height
+    (y, x) = np.mgrid[0:height, 0:width].astype(np.float32)
+    u = sc * ((x + 0.5) - cx) / cx
+    v = sc * ((y + 0.5) - cy) / cy
+    uv_dot = u * u + v * v
+
+    out = np.zeros_like(pixels)
+    for channel, channel_k in enumerate(k):
+        t = 1.0 - 4.0 * channel_k * uv_dot
+        valid = t >= 0.0
+        scale = 1.0 / (1.0 + np.sqrt(np.where(valid, t, 0.0)))
+
+        sample_x = (u * scale + 0.5) * width - 0.5
+        sample_y = (v * scale + 0.5) * height - 0.5
+        out[:, :, channel] = np.where(valid, _sample_bilinear(pixels[:, :, channel], sample_x, sample_y), 0.0)
+
+        # Alpha follows the undispersed (green) channel.
+        if channel == 1:
+            out[:, :, 3] = np.where(valid, _sample_bilinear(pixels[:, :, 3], sample_x, sample_y), 0.0)
+
+    return out
+
+def resize(pixels, width, height):
+    """Scale the frame to width x height, if it isn't already"""
+    if pixels.shape[:2] == (height, width):
+        return pixels
+
+    import cv2
+
+    shrinking = width < pixels.shape[1] and height < pixels.shape[0]
+    return cv2.resize(pixels, (width, height), interpolation = cv2.INTER_AREA if shrinking else cv2.INTER_LINEAR)
+
+def get_output_resolution(shot_info, quality):
+    """The (width, height) that Blender renders (and composites) the shot at, at 'quality'; see set_render_resolution()"""
+    (width, height) = parse_resolution_string(shot_info.get("target_resolution", "1920x1080"))
+    percentage = shot_info.get("resolution_percentage", [50, 50, 100, 100])[get_quality_index(quality)]
+    return (width * percentage // 100, height * percentage // 100)
+
+def _convolve_separable(pixels, kernel_x, kernel_y):
+    """Convolve each channel with kernel_x along rows and kernel_y along columns
+
+    Pixels outside the image are ignored and the weights renormalised, as Blender
+    does when use_extended_bounds is off.
+    """
+    def convolve_axis(image, kernel, axis):
+        radius = len(kernel) // 2
+        if radius == 0:
+            return image
+        padding = [(0, 0)] * image.ndim
+        padding[axis] = (radius, radius)
+        padded = np.pad(image, padding)
+        length = image.shape[axis]
+        out = np.zeros_like(image)
+        for i, weight in enumerate(kernel):
+            out += weight * np.take(padded, range(i, i + length), axis = axis)
+        return out
+
+    coverage = np.ones(pixels.shape[:2] + (1,), dtype = np.float32)
+    blurred = convolve_axis(convolve_axis(pixels, kernel_x, 1), kernel_y, 0)
+    coverage = convolve_axis(convolve_axis(coverage, kernel_x, 1), kernel_y, 0)
+
+    return blurred / coverage
+
+def _sample_bilinear(channel, x, y):
+    """Sample a 2D array at fractional pixel coordinates; zero outside the image"""
+    (height, width) = channel.shape
+    x0 = np.floor(x).astype(np.int64)
+    y0 = np.floor(y).astype(np.int64)
+    fx = x - x0
+    fy = y - y0
+
+    def texel(xi, yi):
+        inside = (xi >= 0) & (xi < width) & (yi >= 0) & (yi < height)
+        return np.where(inside, channel[np.clip(yi, 0, height - 1), np.clip(xi, 0, width - 1)], 0.0)
+
+    return ((1 - fx) * (1 - fy) * texel(x0, y0) + fx * (1 - fy) * texel(x0 + 1, y0)
+            + (1 - fx) * fy * texel(x0, y0 + 1) + fx * fy * texel(x0 + 1, y0 + 1))
+
+###
+### Chain
+###
+
+def compile_chain(compositor_chain_db):
+    """Turn the "compositor_chain" section of the shot list into a list of (function, kwargs)
+
+    Raises ValueError if the chain uses anything that we can't do in NumPy.
+    """
+    for node_name in compositor_chain_db:
+        if node_name not in CHAIN_ORDER:
+            raise ValueError("Unknown compositor node \"%s\"" % node_name)
+
+    def check(condition, node_name, message):
+        if not condition:
+            raise ValueError("\"%s\": %s" % (node_name, message))
+
+    steps = []
+    for node_name in CHAIN_ORDER:
+        props = dict(compositor_chain_db.get(node_name, {"mute": True}))
+        if props.pop("mute", False):
+            continue
+
+        if node_name == "Exposure":
+            steps.append((exposure, {"exposure": props.pop("exposure", 0.0)}))
+        elif node_name == "Lens Distortion":
+            check(not props.pop("use_projector", False), node_name, "use_projector not supported")
+            check(not props.pop("use_jitter", False), node_name, "use_jitter not supported")
+            steps.append((lens_distortion, {"distortion": props.pop("distortion", 0.0),
+                                            "dispersion": props.pop("dispersion", 0.0),
+                                            "use_fit": props.pop("use_fit", False)}))
+        elif node_name == "Filter":
+            check(props.pop("filter_type", None) == "SOFTEN", node_name, "only filter_type SOFTEN is supported")
+            steps.append((soften, {"factor": props.pop("factor", 1.0)}))
+        elif node_name == "Blur":
+            check(props.pop("filter_type", None) == "GAUSS", node_name, "only filter_type GAUSS is supported")
+            for flag in ["use_variable_size", "use_bokeh", "use_relative"]:
+                check(not props.pop(flag, False), node_name, flag + " not supported")
+            # These don't affect a Gaussian blur of fixed size.
+            props.pop("use_gamma_correction", None)
+            props.pop("use_extended_bounds", None)
+            steps.append((gaussian_blur, {"size_x": props.pop("size_x", 0),
+                                          "size_y": props.pop("size_y", 0),
+                                          "size": props.pop("size", 1.0)}))
+        else:
+            check(False, node_name, "node must be muted")
+
+        check(not props, node_name, "unsupported properties " + ", ".join(props.keys()))
+
+    return steps
+
+def is_chain_supported(compositor_chain_db):
+    try:
+        compile_chain(compositor_chain_db)
+        return True
+    except ValueError:
+        return False
+
+def is_shot_supported(shot_info):
+    """True if we can composite the shot without Blender
+
+    Logs the reason if we can't.
+    """
+    if not image_io.is_available():
+        logging.info("NumPy compositor unavailable; OpenCV not installed")
+        return False
+
+    if shot_info.get("composite_file_format", "PNG") not in OUTPUT_FILE_FORMATS:
+        logging.info("NumPy compositor can't write \"%s\" files" % shot_info.get("composite_file_format"))
+        return False
+
+    try:
+        compile_chain(shot_info.get("compositor_chain", {}))
+    except ValueError as e:
+        logging.info("NumPy compositor can't do compositor chain: %s" % str(e))
+        return False
+
+    return True
+
+def apply_chain(steps, pixels):
+    for (function, kwargs) in steps:
+        pixels = function(pixels, **kwargs)
+    return pixels
+
+###
+### Frame processing (runs in the worker processes)
+###
+
+def composite_frame(job):
+    """Composite one frame; 'job' is (steps, src filepath, dst filepath, output settings, version)"""
+    (steps, src_filepath, dst_filepath, output_settings, version) = job
+    try:
+        image_io.write_image(dst_filepath, apply_chain(steps, image_io.read_image(src_filepath)), **output_settings)
+        write_composite_record(dst_filepath, src_filepath, version)
+        return (dst_filepath, None)
+    except Exception as e:
+        return (dst_filepath, str(e))
+
+###
+### Main
+###
+
+class Shot:
+    """Where the frames of a shot come from and go to"""
+    def __init__(self, shot_list_db_filepath, shot_category, shot_id, quality, slate_number, frames_wanted = None):
+        """frames_wanted: If given, just these frames of the shot; e.g. those used in the cut"""
+        db = shot_list_db.ShotListDb.from_file(shot_list_db_filepath)
+        self.frames_wanted = frames_wanted
+        self.shot_info = db.get_shot_info(shot_category, shot_id)
+
+        try:
+            (self.frame_start, self.frame_end) = get_frame_range(self.shot_info)
+        except TypeError as e:
+            raise Exception("For compositing, 'frame_start' and 'frame_end' must be specified in the JSON shot-info file") from e
+
+        self.incoming_filestub = get_composite_source_filestub(db, self.shot_info, shot_category, shot_id, slate_number)
+        self.outgoing_filestub = get_composite_filestub(db, self.shot_info, shot_category, shot_id, slate_number)
+        self.incoming_file_extension = IMAGE_FILE_EXTENSIONS[self.shot_info.get("render_file_format", "PNG")]
+        self.outgoing_file_extension = IMAGE_FILE_EXTENSIONS[self.shot_info.get("composite_file_format", "PNG")]
+
+        self.output_settings = {
+            "file_format": self.shot_info.get("composite_file_format", "PNG"),
+            "color_depth": self.shot_info.get("composite_color_depth", "16"),
+            "color_mode": self.shot_info.get("composite_color_mode", "RGBA"),
+        }
+
+        # The chain, then scale to the resolution of 'quality'.
+        (width, height) = get_output_resolution(self.shot_info, quality)
+        self.steps = compile_chain(self.shot_info.get("compositor_chain", {})) + [(resize, {"width": width, "height": height})]
+
+        # See get_composite_version(); this script plays the part of the compositor .blend.
+        self.composite_version = get_composite_version(self.shot_info, quality, os.path.realpath(__file__))
+
+    @property
+    def frames(self):
+        frames = set(range(self.frame_start, self.frame_end + 1))
+        return frames if self.frames_wanted is None else frames & set(self.frames_wanted)
+
+    def incoming_frame_filepath(self, frame_number):
+        return self.incoming_filestub + ("%04d" % frame_number) + "." + self.incoming_file_extension
+
+    def outgoing_frame_filepath(self, frame_number):
+        return self.outgoing_filestub + ("%04d" % frame_number) + "." + self.outgoing_file_extension
+
+
+def composite_shot(shot, num_processes = None):
+    """Composite frames of the shot as they arrive, until all are done
+
+    This mirrors the monitor loop of compositor_script.py, including claiming
+    frames with lock files, so it can share a shot with Blender compositors.
+
+    Returns True if every frame was composited; False if we gave up on some.
+    """
+    lock_timeout = shot.shot_info.get("compositor_lock_timeout", 3600)
+    max_attempts = shot.shot_info.get("numpy_compositor_max_attempts", DEFAULT_MAX_ATTEMPTS)
+    frames_in_shot = shot.frames
+    num_processes = num_processes or os.cpu_count()
+
+    logging.info("Compositing with %d NumPy processes" % num_processes)
+    logging.info("INCOMING FRAME PATH: %s" % shot.incoming_frame_filepath(0))
+    logging.info("OUTGOING FRAME PATH: %s" % shot.outgoing_frame_filepath(0))
+
+    # Frames composited with other settings, or from an older source frame, are redone.
+    stale_frames, num_unrecorded_frames = find_stale_composites(
+                                              scan_frame_numbers(shot.outgoing_filestub, shot.outgoing_file_extension) & frames_in_shot,
+                                              shot.outgoing_frame_filepath,
+                                              shot.incoming_frame_filepath,
+                                              shot.composite_version)
+
+    logging.info("Frames composited with out-of-date settings: %s" % (format_frame_ranges(stale_frames) or "none"))
+    if num_unrecorded_frames:
+        logging.info("%d composited frames have no version record; assuming they are up-to-date" % num_unrecorded_frames)
+
+    # Frames that failed -> (number of failures, time.time() before which we don't try again)
+    failures = {}
+    given_up_frames = set()
+
+    # Source frame timestamps as of the last pass; see compositor_script.py.
+    seen_incoming_mtimes = {}
+
+    with multiprocessing.Pool(num_processes) as pool:
+        # Claim a few frames per process at a time, so the pool stays busy but we
+        # don't hog frames that other compositors could be working on.
+        batch_size = 2 * num_processes
+
+        while True:
+            now = time.time()
+
+            # Frames rendered again since we last looked need compositing again.
+            incoming_mtimes = { frame: mtime for (frame, mtime) in scan_frame_mtimes(shot.incoming_filestub, shot.incoming_file_extension).items()
+                                if frame in frames_in_shot }
+            rerendered_frames = { frame for frame in incoming_mtimes
+                                  if frame in seen_incoming_mtimes and incoming_mtimes[frame] != seen_incoming_mtimes[frame] }
+            seen_incoming_mtimes = incoming_mtimes
+            if rerendered_frames:
+                logging.info("Frames rendered again since they were composited: %s" % format_frame_ranges(rerendered_frames))
+                stale_frames |= rerendered_frames
+                for frame in rerendered_frames:
+                    failures.pop(frame, None)
+                given_up_frames -= rerendered_frames
+
+            composited_frames = (scan_frame_numbers(shot.outgoing_filestub, shot.outgoing_file_extension) & frames_in_shot) - stale_frames
+            incoming_frames = set(incoming_mtimes)
+            frames_backing_off = { frame for (frame, (_, retry_time)) in failures.items() if retry_time > now }
+            frames_waiting = sorted(incoming_frames - composited_frames - given_up_frames - frames_backing_off)
+
+            logging.info("Composited %d of %d frames; waiting: %s; retrying later: %s" % (
+                             len(composited_frames), len(frames_in_shot),
+                             format_frame_ranges(frames_waiting) or "none",
+                             format_frame_ranges(frames_backing_off - composited_frames) or "none"))
+
+            if len(composited_frames | given_up_frames) == len(frames_in_shot):
+                if given_up_frames - composited_frames:
+                    logging.error("Gave up on frames %s after %d attempts each" % (
+                                      format_frame_ranges(given_up_frames - composited_frames), max_attempts))
+                    return False
+                logging.info("Composited %d of %d frames; exiting" % (len(frames_in_shot), len(frames_in_shot)))
+                return True
+
+            claimed_frames = []
+            for frame in frames_waiting:
+                if len(claimed_frames) >= batch_size:
+                    break
+                # Another compositor may have done the frame since we last looked.
+                is_done = lambda: (os.path.exists(shot.outgoing_frame_filepath(frame))
+                                   and is_composite_current(shot.outgoing_frame_filepath(frame),
+                                                            shot.incoming_frame_filepath(frame),
+                                                            shot.composite_version) is not False)
+                result = claim_unfinished_frame(shot.outgoing_frame_filepath(frame), is_done, lock_timeout)
+                if result == FRAME_ALREADY_DONE:
+                    stale_frames.discard(frame)
+                elif result == FRAME_CLAIMED:
+                    claimed_frames.append(frame)
+
+            if not claimed_frames:
+                # Don't sleep past the next retry.
+                retry_times = [ retry_time for (frame, (_, retry_time)) in failures.items() if frame not in given_up_frames ]
+                sleep_time = max(1, min([RETRY_DELAY] + [ retry_time - now for retry_time in retry_times ]))
+                logging.info("No frames waiting to be composited; sleeping %ds" % sleep_time)
+                time.sleep(sleep_time)
+                continue
+
+            start_time = time.time()
+            failed_frames = set()
+            try:
+                jobs = [ (shot.steps, shot.incoming_frame_filepath(frame), shot.outgoing_frame_filepath(frame),
+                          shot.output_settings, shot.composite_version)
+                         for frame in claimed_frames ]
+                for (frame, (dst_filepath, error)) in zip(claimed_frames, pool.imap(composite_frame, jobs)):
+                    if error:
+                        failed_frames.add(frame)
+                        num_failures = failures.get(frame, (0, 0))[0] + 1
+                        if num_failures >= max_attempts:
+                            given_up_frames.add(frame)
+                            retry_delay = 0
+                            logging.error("Failed to composite \"%s\": %s; giving up" % (dst_filepath, error))
+                        else:
+                            retry_delay = min(RETRY_DELAY * 2 ** (num_failures - 1), MAX_RETRY_DELAY)
+                            logging.error("Failed to composite \"%s\": %s; retrying in %ds" % (dst_filepath, error, retry_delay))
+                        failures[frame] = (num_failures, time.time() + retry_delay)
+                    else:
+                        failures.pop(frame, None)
+            finally:
+                for frame in claimed_frames:
+                    release_frame(shot.outgoing_frame_filepath(frame))
+
+            stale_frames.difference_update(set(claimed_frames) - failed_frames)
+
+            logging.info("Composited frames %s in %.1fs" % (format_frame_ranges(set(claimed_frames) - failed_frames) or "none",
+                                                            time.time() - start_time))
+
+
+def verify_shot(shot, tolerance = 0.01, max_frames = 10):
+    """Compare our output with frames that Blender has already composited
+
+    Returns True if every frame checked is within 'tolerance' (mean absolute difference).
+    """
+    reference_frames = sorted(
+        scan_frame_numbers(shot.outgoing_filestub, shot.outgoing_file_extension)
+        & scan_frame_numbers(shot.incoming_filestub, shot.incoming_file_extension)
+        & shot.frames
+    )
+
+    if not reference_frames:
+        print("No frames composited by Blender to compare against")
+        return False
+
+    # Spread the frames that we check across the shot.
+    step = max(1, len(reference_frames) // max_frames)
+    reference_frames = reference_frames[::step][:max_frames]
+
+    table = [["Frame", "Mean abs diff", "Max abs diff", "Result"]]
+    all_ok = True
+    for frame in reference_frames:
+        ours = apply_chain(shot.steps, image_io.read_image(shot.incoming_frame_filepath(frame)))
+        reference = image_io.read_image(shot.outgoing_frame_filepath(frame))
+
+        if ours.shape != reference.shape:
+            table.append([frame, "-", "-", "SIZE MISMATCH %s vs %s" % (ours.shape, reference.shape)])
+            all_ok = False
+            continue
+
+        # Compare what we'd actually write; e.g. clipped to 0..1 for PNG.
+        if shot.output_settings["file_format"] != "OPEN_EXR":
+            ours = np.clip(ours, 0.0, 1.0)
+
+        diff = np.abs(ours - reference)
+        ok = diff.mean() <= tolerance
+        all_ok = all_ok and ok
+        table.append([frame, "%.5f" % diff.mean(), "%.5f" % diff.max(), "OK" if ok else "FAIL"])
+
+    print_table(table)
+    return all_ok
+
+
+def main(*_args):
+    args = list(_args)[1:]
+
+    if args and args[0] == "VERIFY":
+        try:
+            [shot_list_db_filepath, shot_category, shot_id, quality, slate_number] = args[1:6]
+            tolerance = float(args[6]) if len(args) > 6 else 0.01
+            max_frames = int(args[7]) if len(args) > 7 else 10
+        except ValueError:
+            print("Usage:", "numpy_compositor.py", "VERIFY", "<shot list>", "<category>", "<id>", "<quality>", "<slate>", "[tolerance]", "[max frames]")
+            return 1
+
+        shot = Shot(shot_list_db_filepath, shot_category, shot_id, quality, slate_number)
+        return 0 if verify_shot(shot, tolerance, max_frames) else 1
+
+    if len(args) in [5, 6]:
+        [shot_list_db_filepath, shot_category, shot_id, quality, slate_number] = args[:5]
+        frames_wanted = parse_frame_ranges(args[5]) if len(args) == 6 else None
+    else:
+        print("Usage:", "numpy_compositor.py", "<shot list>", "<category>", "<id>", "<quality>", "<slate>", "[frames, e.g. 1-10,20-30]")
+        return 1
+
+    shot = Shot(shot_list_db_filepath, shot_category, shot_id, quality, slate_number, frames_wanted)
+    return 0 if composite_shot(shot, shot.shot_info.get("numpy_compositor_processes")) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(*sys.argv))
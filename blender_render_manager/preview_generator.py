@@ -0,0 +1,317 @@
+"""Preview generator
+
+Watch the frames of a slate as they are rendered (or composited) and make
+small 8-bit JPEG proxies of them, plus a contact sheet of the whole shot that
+fills in as frames land. Reviewers can then look at a render without opening
+the full resolution 16-bit PNG or EXR frames.
+
+Frames are processed by a pool of worker threads; OpenCV and NumPy release the
+GIL while they work, so threads are enough. Each frame is shrunk by averaging
+blocks of pixels. A frame that can't be read, e.g. because it is still being
+written, is tried again on the next pass.
+
+Previews go in a directory next to the slate; e.g. for frames in
+
+  Renders/Title/slate_3/film_1_3_0001.png
+
+we write
+
+  Renders/Title/slate_3_preview/film_1_3_proxy_0001.jpg
+  Renders/Title/slate_3_preview/film_1_3_contact_sheet.jpg
+
+With "hold" set, we also write a "hold" sequence, which has a preview for
+every frame of the shot, made by holding the nearest rendered frame:
+
+  Renders/Title/slate_3_preview/film_1_3_hold_0001.jpg
+
+Together with "frame_order": "BISECT" in the shot info, which renders the
+first, last and middle frames first, and so on, this gives something to judge
+the timing and blocking of the whole shot by after a small part of the render.
+"hold" defaults to on for shots rendered in BISECT order.
+
+Settings come from the "preview" section of the shot info; e.g.
+
+    "preview": {
+        "max_size": 960,
+        "tile_size": 240,
+        "contact_sheet_columns": 8,
+        "contact_sheet_tiles": 64,
+        "workers": 4,
+        "hold": false,
+        "source": "RENDER"
+    }
+
+"source" (RENDER or COMPOSITE) says which frames the render queue's preview
+stage works on; the queue runs the stage for shots with "preview_enabled": true.
+
+Usage:
+
+  preview_generator.py <shot list> <category> <id> <slate> [RENDER|COMPOSITE]
+
+"""
+import sys
+import os
+import math
+import logging
+import time
+import bisect
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# Append this directory to path, so that we can find "shot_list_db.py"
+sys.path.append(os.path.dirname(os.path.realpath(__file__)))
+
+import shot_list_db
+import image_io
+from common import *
+
+logging.basicConfig(level=logging.INFO)
+
+PROXY_FILE_EXTENSION = "jpg"
+DEFAULT_PREVIEW_SETTINGS = {
+    "max_size": 960,
+    "tile_size": 240,
+    "contact_sheet_columns": 8,
+    "contact_sheet_tiles": 64,
+    "workers": 4,
+    "hold": False,
+}
+
+
+def downsample(pixels, factor):
+    """Shrink an image by an integer factor, averaging factor x factor blocks
+
+    Any rows or columns left over at the bottom/right edge are dropped.
+    """
+    if factor <= 1:
+        return pixels.astype(np.float32)
+
+    (height, width, channels) = pixels.shape
+    out_height = height // factor
+    out_width = width // factor
+
+    block = pixels[:out_height * factor, :out_width * factor]
+    return block.reshape(out_height, factor, out_width, factor, channels).mean(axis = (1, 3), dtype = np.float32)
+
+
+def linear_to_srgb(pixels):
+    """Apply the sRGB transfer function to linear values"""
+    pixels = np.clip(pixels, 0.0, 1.0)
+    return np.where(pixels <= 0.0031308, pixels * 12.92, 1.055 * np.power(pixels, 1.0 / 2.4) - 0.055)
+
+
+def get_preview_filestub(source_filestub):
+    """Filestub of the previews of the frames of 'source_filestub'"""
+    source_dir, source_filename = os.path.split(source_filestub)
+    return os.path.join(source_dir + "_preview", source_filename)
+
+
+class PreviewGenerator:
+    def __init__(self, source_filestub, source_file_format, frame_range, settings = None, frames_wanted = None):
+        """frames_wanted: If given, just these frames of 'frame_range'; e.g. those used in the cut"""
+        self.source_filestub = source_filestub
+        self.source_file_extension = IMAGE_FILE_EXTENSIONS[source_file_format]
+
+        # EXR frames are scene linear; everything else is already display referred.
+        self.is_linear = source_file_format.startswith("OPEN_EXR")
+
+        self.settings = dict(DEFAULT_PREVIEW_SETTINGS)
+        self.settings.update(settings or {})
+
+        preview_filestub = get_preview_filestub(source_filestub)
+        self.proxy_filestub = preview_filestub + "proxy_"
+        self.contact_sheet_filepath = preview_filestub + "contact_sheet." + PROXY_FILE_EXTENSION
+        self.hold_filestub = preview_filestub + "hold_"
+
+        # Hold frame -> proxy frame that it's currently a copy of
+        self.hold_sources = {}
+
+        self.frame_range = frame_range
+        self.frames_in_shot = None
+        if frame_range is not None:
+            self.frames_in_shot = set(range(frame_range[0], frame_range[1] + 1))
+            if frames_wanted is not None:
+                self.frames_in_shot &= set(frames_wanted)
+        self.contact_sheet = None
+        self.tile_frames = self._choose_tile_frames()
+
+    def _choose_tile_frames(self):
+        """Pick the frames shown on the contact sheet; spread evenly across the shot"""
+        if not self.frames_in_shot:
+            return []
+        frames = sorted(self.frames_in_shot)
+        num_frames = len(frames)
+        num_tiles = min(num_frames, self.settings["contact_sheet_tiles"])
+        return sorted(set(
+            frames[(i * (num_frames - 1)) // max(1, num_tiles - 1)]
+            for i in range(num_tiles)
+        ))
+
+    def source_frame_filepath(self, frame_number):
+        return self.source_filestub + ("%04d" % frame_number) + "." + self.source_file_extension
+
+    def proxy_frame_filepath(self, frame_number):
+        return self.proxy_filestub + ("%04d" % frame_number) + "." + PROXY_FILE_EXTENSION
+
+    def make_proxy(self, frame_number):
+        """Write the proxy of one frame. Returns the proxy pixels"""
+        pixels = image_io.read_image(self.source_frame_filepath(frame_number))
+        factor = math.ceil(max(pixels.shape[:2]) / self.settings["max_size"])
+        proxy = downsample(pixels, factor)
+        del pixels
+
+        if self.is_linear:
+            proxy[:, :, 0:3] = linear_to_srgb(proxy[:, :, 0:3])
+
+        image_io.write_image(self.proxy_frame_filepath(frame_number), proxy,
+                             file_format = "JPEG", color_depth = "8", color_mode = "RGB")
+        return proxy
+
+    def add_to_contact_sheet(self, frame_number, proxy):
+        """Paste the frame's proxy into its tile on the contact sheet, if it has one"""
+        if frame_number not in self.tile_frames:
+            return False
+
+        tile_size = self.settings["tile_size"]
+        tile = downsample(proxy, math.ceil(max(proxy.shape[:2]) / tile_size))
+
+        if self.contact_sheet is None:
+            columns = self.settings["contact_sheet_columns"]
+            rows = math.ceil(len(self.tile_frames) / columns)
+            (self.tile_height, self.tile_width) = tile.shape[:2]
+            self.contact_sheet = np.zeros((rows * self.tile_height, columns * self.tile_width, 4), dtype = np.float32)
+
+        index = self.tile_frames.index(frame_number)
+        (row, column) = divmod(index, self.settings["contact_sheet_columns"])
+        tile = tile[:self.tile_height, :self.tile_width]
+        self.contact_sheet[row * self.tile_height:row * self.tile_height + tile.shape[0],
+                           column * self.tile_width:column * self.tile_width + tile.shape[1]] = tile
+        return True
+
+    def hold_frame_filepath(self, frame_number):
+        return self.hold_filestub + ("%04d" % frame_number) + "." + PROXY_FILE_EXTENSION
+
+    def update_hold_sequence(self, done_frames):
+        """Make every frame of the hold sequence a copy of the nearest frame with a proxy"""
+        if self.frame_range is None or not done_frames:
+            return
+
+        sorted_done_frames = sorted(done_frames)
+        num_updated = 0
+        for frame in range(self.frame_range[0], self.frame_range[1] + 1):
+            # Nearest done frame; the earlier one if it's a tie.
+            i = bisect.bisect_left(sorted_done_frames, frame)
+            candidates = sorted_done_frames[max(0, i - 1):i + 1]
+            source = min(candidates, key = lambda candidate: (abs(candidate - frame), candidate))
+
+            if self.hold_sources.get(frame) == source:
+                continue
+
+            hold_filepath = self.hold_frame_filepath(frame)
+            tmp_filepath = self.hold_filestub + ("%04d" % frame) + ".tmp." + PROXY_FILE_EXTENSION
+            shutil.copyfile(self.proxy_frame_filepath(source), tmp_filepath)
+            os.replace(tmp_filepath, hold_filepath)
+            self.hold_sources[frame] = source
+            num_updated += 1
+
+        if num_updated:
+            logging.info("Updated %d frames of the hold sequence" % num_updated)
+
+    def write_contact_sheet(self):
+        if self.contact_sheet is not None:
+            image_io.write_image(self.contact_sheet_filepath, self.contact_sheet,
+                                 file_format = "JPEG", color_depth = "8", color_mode = "RGB")
+
+    def run(self, sleep_time = 30):
+        """Make previews of frames as they arrive, until every frame of the shot has one"""
+        frames_in_shot = self.frames_in_shot
+
+        # Previews that we made on an earlier run; put them back on the contact sheet.
+        done_frames = scan_frame_numbers(self.proxy_filestub, PROXY_FILE_EXTENSION)
+        for frame in sorted(done_frames & set(self.tile_frames)):
+            self.add_to_contact_sheet(frame, image_io.read_image(self.proxy_frame_filepath(frame)))
+
+        # We don't know what the hold frames on disk are copies of, so rewrite them all.
+        if self.settings["hold"]:
+            self.update_hold_sequence(done_frames)
+
+        with ThreadPoolExecutor(max_workers = self.settings["workers"]) as executor:
+            while True:
+                source_frames = scan_frame_numbers(self.source_filestub, self.source_file_extension)
+                if frames_in_shot is not None:
+                    source_frames &= frames_in_shot
+                new_frames = sorted(source_frames - done_frames)
+
+                logging.info("Previews done: %d; new frames: %s" % (len(done_frames), format_frame_ranges(new_frames) or "none"))
+
+                num_made = 0
+                if new_frames:
+                    start_time = time.time()
+                    futures = [ (frame, executor.submit(self.make_proxy, frame)) for frame in new_frames ]
+                    failed_frames = []
+                    for (frame, future) in futures:
+                        try:
+                            proxy = future.result()
+                        except Exception as e:
+                            # Most likely the frame is still being written; try it again next pass.
+                            logging.warning("Failed to make preview of frame %d: %s" % (frame, e))
+                            failed_frames.append(frame)
+                            continue
+                        self.add_to_contact_sheet(frame, proxy)
+                        done_frames.add(frame)
+                        num_made += 1
+                    if num_made:
+                        self.write_contact_sheet()
+                        if self.settings["hold"]:
+                            self.update_hold_sequence(done_frames)
+                    logging.info("Made %d previews in %.1fs; failed: %s" % (num_made, time.time() - start_time,
+                                                                           format_frame_ranges(failed_frames) or "none"))
+
+                # Without a frame range, we can't tell when the shot is finished; so just do one pass.
+                if frames_in_shot is None or done_frames >= frames_in_shot:
+                    logging.info("Previews complete")
+                    return
+
+                if not num_made:
+                    logging.info("No new previews made; sleeping %ds" % sleep_time)
+                    time.sleep(sleep_time)
+
+
+def main(*_args):
+    args = list(_args)[1:]
+
+    if len(args) == 4:
+        [shot_list_db_filepath, shot_category, shot_id, slate_number] = args
+        source = "RENDER"
+    elif len(args) in [5, 6]:
+        [shot_list_db_filepath, shot_category, shot_id, slate_number, source] = args[:5]
+    else:
+        print("Usage:", "preview_generator.py", "<shot list>", "<category>", "<id>", "<slate>", "[RENDER|COMPOSITE]", "[frames, e.g. 1-10,20-30]")
+        return 1
+    frames_wanted = parse_frame_ranges(args[5]) if len(args) == 6 else None
+
+    db = shot_list_db.ShotListDb.from_file(shot_list_db_filepath)
+    shot_info = db.get_shot_info(shot_category, shot_id)
+
+    if source.upper() == "COMPOSITE":
+        source_filestub = get_composite_filestub(db, shot_info, shot_category, shot_id, slate_number)
+        source_file_format = shot_info.get("composite_file_format", "PNG")
+    else:
+        source_filestub = get_render_filestub(db, shot_info, shot_category, shot_id, slate_number)
+        source_file_format = shot_info.get("render_file_format", "PNG")
+
+    settings = dict(shot_info.get("preview", {}))
+    settings.setdefault("hold", shot_info.get("frame_order", "SEQUENTIAL").upper() == "BISECT")
+
+    PreviewGenerator(source_filestub,
+                     source_file_format,
+                     get_frame_range(shot_info),
+                     settings,
+                     frames_wanted).run()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(*sys.argv))
@@ -10,6 +10,7 @@ import os
 import logging
 import subprocess
 import copy
+import time
 
 from shot_list_db import ShotListDb
 from common import *
@@ -19,6 +20,9 @@ SHOT_LIST_FILEPATH = "blender_shot_list.json"
 BLENDER_ROOT = r"C:\Program Files\Blender Foundation\Blender 3.4"
 RENDER_SCRIPT = "render_script.py"
 COMPOSITOR_SCRIPT = "compositor_script.py"
+NUMPY_COMPOSITOR_SCRIPT = "numpy_compositor.py"
+PREVIEW_SCRIPT = "preview_generator.py"
+DENOISE_SCRIPT = "denoise_script.py"
 
 # Find the directory where this file (render_manager.py) resides
 # NOTE: This will break if os.chdir() is called before this line runs
@@ -34,21 +38,128 @@ render_manager_py_path = os.path.dirname(os.path.realpath(__file__))
 #args = parser.parse_args()
 #print(args.accumulate(args.integers))
 
-def list_shots(shot_list_db):
+def find_latest_slate_number(shot_list_db, shot_info):
+    """Return the number of the highest numbered slate_XXX directory of a shot, or None"""
+    import re
+
+    # With an output path override there's only one place the frames can be.
+    if shot_info.get("output_filepath_override"):
+        return 1
+
+    shot_name = shot_info.get("shot_name") or shot_info["title"]
+    pattern = re.compile("slate_([0-9]+)")
+
+    try:
+        slate_numbers = [ int(m.group(1)) for m in map(pattern.fullmatch, os.listdir(os.path.join(shot_list_db.render_root, shot_name))) if m ]
+    except FileNotFoundError:
+        return None
+
+    return max(slate_numbers, default = None)
+
+def get_shot_status(shot_list_db, shot_category, shot_id):
+    """Work out how far the rendering and compositing of the latest slate of a shot has got"""
+    shot_info = shot_list_db.get_shot_info(shot_category, shot_id)
+    slate = find_latest_slate_number(shot_list_db, shot_info)
+
+    status = {
+        "title": shot_info["title"],
+        "category": shot_info["category"],
+        "id": shot_info["id"],
+        "frame_start": shot_info.get("frame_start"),
+        "frame_end": shot_info.get("frame_end"),
+        "blend_file": shot_info.get("blend_file"),
+        "slate": slate,
+        "frames_expected": None,
+        "frames_rendered": 0,
+        "frames_composited": 0,
+        "missing_frames": None,
+        "last_frame_age": None,
+        "seconds_per_frame": None,
+    }
+
+    if slate is None:
+        return status
+
+    render_ext = IMAGE_FILE_EXTENSIONS[shot_info.get("render_file_format", "PNG")]
+    composite_ext = IMAGE_FILE_EXTENSIONS[shot_info.get("composite_file_format", "PNG")]
+
+    rendered_frames = scan_frame_mtimes(get_render_filestub(shot_list_db, shot_info, shot_category, shot_id, slate), render_ext)
+    composited_frames = scan_frame_numbers(get_composite_filestub(shot_list_db, shot_info, shot_category, shot_id, slate), composite_ext)
+
+    frame_range = get_frame_range(shot_info)
+    if frame_range:
+        expected_frames = set(range(frame_range[0], frame_range[1] + 1))
+        rendered_frames = { frame: mtime for (frame, mtime) in rendered_frames.items() if frame in expected_frames }
+        composited_frames &= expected_frames
+
+        status["frames_expected"] = len(expected_frames)
+        status["missing_frames"] = format_frame_ranges(expected_frames - set(rendered_frames))
+
+    status["frames_rendered"] = len(rendered_frames)
+    status["frames_composited"] = len(composited_frames)
+
+    if rendered_frames:
+        mtimes = sorted(rendered_frames.values())
+        status["last_frame_age"] = round(time.time() - mtimes[-1])
+
+        # Use the median time between frames landing, so that pauses in
+        # rendering (e.g. the queue working on another shot) don't count.
+        if len(mtimes) > 1:
+            deltas = sorted(b - a for (a, b) in zip(mtimes, mtimes[1:]))
+            status["seconds_per_frame"] = round(deltas[len(deltas) // 2], 1)
+
+    return status
+
+def list_shots(shot_list_db, as_json = False):
+    """Print the shots in the shot list along with their render status
+
+    The status of each shot means listing its render directories, which can be
+    slow on a NAS, so we do the shots concurrently.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers = 16) as executor:
+        statuses = list(executor.map(lambda shot: get_shot_status(shot_list_db, *shot), shot_list_db.shot_ids))
+
+    if as_json:
+        print(json.dumps(statuses, indent = 2))
+        return
+
+    def format_age(seconds):
+        if seconds is None:
+            return "-"
+        for (unit, unit_seconds) in [("d", 86400), ("h", 3600), ("m", 60)]:
+            if seconds >= unit_seconds:
+                return "%d%s" % (seconds // unit_seconds, unit)
+        return "%ds" % seconds
+
+    def format_missing(missing_frames, max_length = 30):
+        if missing_frames is None:
+            return "?"
+        if len(missing_frames) > max_length:
+            return missing_frames[:max_length - 3] + "..."
+        return missing_frames or "-"
 
     print_table(
-        [["Title", "Category", "ID", "Frame Start", "End", "Blend File"]]
+        [["Title", "Category", "ID", "Frame Start", "End", "Blend File",
+          "Slate", "Rendered", "Composited", "Missing", "Last Frame", "s/frame"]]
         +
         [
             [
-                shot_list_db.get_shot_info(shot_category, shot_id)["title"],
-                shot_list_db.get_shot_info(shot_category, shot_id)["category"],
-                shot_list_db.get_shot_info(shot_category, shot_id)["id"],
-                shot_list_db.get_shot_info(shot_category, shot_id).get("frame_start", "UNSET"),
-                shot_list_db.get_shot_info(shot_category, shot_id).get("frame_end", "UNSET"),
-                shot_list_db.get_shot_info(shot_category, shot_id).get("blend_file")
+                status["title"],
+                status["category"],
+                status["id"],
+                "UNSET" if status["frame_start"] is None else status["frame_start"],
+                "UNSET" if status["frame_end"] is None else status["frame_end"],
+                status["blend_file"],
+                "-" if status["slate"] is None else status["slate"],
+                "%d/%s" % (status["frames_rendered"], "?" if status["frames_expected"] is None else status["frames_expected"]),
+                status["frames_composited"],
+                format_missing(status["missing_frames"]),
+                format_age(status["last_frame_age"]),
+                "-" if status["seconds_per_frame"] is None else status["seconds_per_frame"],
             ]
-            for (shot_category, shot_id) in shot_list_db.shot_ids
+            for status in statuses
         ]
     )
  
@@ -80,8 +191,29 @@ def find_latest_blend_file(filepath):
         return filepath.replace('[X]', str(max_index))
 
 
-def build_shot(shot_list_db, shot_category, shot_id, quality, slate, in_separate_window = False):
-    shot_info = shot_list_db.get_shot_info(shot_category, shot_id)
+def format_shot_info_overrides(shot_info_overrides):
+    """Shot info overrides as KEY=VALUE arguments for render_script.py
+
+    The values are written as compact JSON, so that lists of numbers (e.g.
+    tile=[3,4,2]) don't need quoting on the command line. See
+    parse_shot_info_overrides().
+    """
+    return [ "%s=%s" % (key, json.dumps(value, separators = (",", ":")))
+             for (key, value) in (shot_info_overrides or {}).items() ]
+
+
+def build_shot(shot_list_db, shot_category, shot_id, quality, slate, in_separate_window = False, shot_info_overrides = None):
+    # A copy; for most shots, get_shot_info() returns the shot list's own record,
+    # and overrides for one job mustn't stick to the shot.
+    shot_info = dict(shot_list_db.get_shot_info(shot_category, shot_id), **(shot_info_overrides or {}))
+
+    # Large stills can be split into tiles; unless we've been asked to render one tile.
+    if shot_info.get("tiles") and not shot_info.get("tile"):
+        return build_tiled_shot(shot_list_db, shot_category, shot_id, quality, slate, in_separate_window)
+
+    # Likewise, shots can be split into chunks of frames.
+    if shot_info.get("frame_chunks", 1) > 1 and not shot_info.get("frame_chunk"):
+        return build_chunked_shot(shot_list_db, shot_category, shot_id, quality, slate, in_separate_window)
 
     # Look up the blend file pattern from the shot list db and resolve to an actual file.
     #
@@ -102,7 +234,9 @@ def build_shot(shot_list_db, shot_category, shot_id, quality, slate, in_separate
                           str(shot_category),
                           str(shot_id),
                           quality,
-                          str(slate)])
+                          str(slate)]
+                         +
+                         format_shot_info_overrides(shot_info_overrides))
 
     print("Launching Blender Renderer")
     print("##########################")
@@ -114,29 +248,312 @@ def build_shot(shot_list_db, shot_category, shot_id, quality, slate, in_separate
 
     print("Returned Value: ", res)
 
+    # Chunks and tiles are only part of the shot; whoever launched them interpolates.
+    if quality.upper() == "SPARSE" and not shot_info.get("frame_chunk") and not shot_info.get("tile"):
+        interpolate_sparse_shot(shot_list_db, shot_category, shot_id, slate)
+
+
+def interpolate_sparse_shot(shot_list_db, shot_category, shot_id, slate):
+    """Fill in the frames that a SPARSE quality render skipped; see frame_interpolator.py"""
+    import frame_interpolator
+
+    frame_interpolator.interpolate_shot(shot_list_db, shot_category, shot_id, slate)
+
+
+def build_tiled_shot(shot_list_db, shot_category, shot_id, quality, slate, in_separate_window = False):
+    """Render a shot with "tiles": [columns, rows] as one job per tile, then stitch the tiles
+
+    Each tile is rendered by a Blender process of its own. Up to
+    "tile_workers" (default 1) of them run at once on this machine; so, by
+    default, the tiles are rendered one after another, which keeps the memory
+    use of each job down but isn't any faster. To render tiles in parallel,
+    raise "tile_workers" (if the machine has the memory and devices for it),
+    or render tiles on other machines with e.g.
+
+      render_manager.py BUILD <category> <id> <quality> <slate> tile=[<index>,<columns>,<rows>]
+
+    and put together with render_manager.py STITCH.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    shot_info = shot_list_db.get_shot_info(shot_category, shot_id)
+    (columns, rows) = shot_info["tiles"]
+    num_workers = shot_info.get("tile_workers", 1)
+
+    def build_tile(tile_index):
+        build_shot(shot_list_db, shot_category, shot_id, quality, slate, in_separate_window,
+                   shot_info_overrides = {"tile": [tile_index, columns, rows]})
+
+    with ThreadPoolExecutor(max_workers = num_workers) as executor:
+        list(executor.map(build_tile, range(columns * rows)))
+
+    stitch_shot(shot_list_db, shot_category, shot_id, slate)
+
+
+def build_chunked_shot(shot_list_db, shot_category, shot_id, quality, slate, in_separate_window = False):
+    """Render a shot with "frame_chunks": k as k jobs, each rendering every k-th frame
+
+    The chunks take turns through the shot's "frame_order", so with "BISECT"
+    every chunk starts with frames spread over the whole shot. Up to
+    "chunk_workers" (default 1) chunks are rendered at once on this machine;
+    other machines can render a chunk with e.g.
+
+      render_manager.py BUILD <category> <id> <quality> <slate> frame_chunk=[<i>,<k>]
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    shot_info = shot_list_db.get_shot_info(shot_category, shot_id)
+    num_chunks = shot_info["frame_chunks"]
+    num_workers = shot_info.get("chunk_workers", 1)
+
+    def build_chunk(chunk_index):
+        build_shot(shot_list_db, shot_category, shot_id, quality, slate, in_separate_window,
+                   shot_info_overrides = {"frame_chunk": [chunk_index, num_chunks]})
+
+    with ThreadPoolExecutor(max_workers = num_workers) as executor:
+        list(executor.map(build_chunk, range(num_chunks)))
+
+    if quality.upper() == "SPARSE":
+        interpolate_sparse_shot(shot_list_db, shot_category, shot_id, slate)
+
+
+def build_frame_ranges(shot_list_db, shot_category, shot_id, quality, slate, frame_ranges, in_separate_window = False):
+    """Render only some frames of a shot; e.g. the frames used in the cut (see cut_list.py)
+
+    frame_ranges: [(first, last), ...]. Each range with frames missing is
+                  rendered as one job, with frame_start/frame_end overridden.
+    """
+    shot_info = shot_list_db.get_shot_info(shot_category, shot_id)
+    render_filestub = get_render_filestub(shot_list_db, shot_info, shot_category, shot_id, slate)
+    ext = IMAGE_FILE_EXTENSIONS[shot_info.get("render_file_format", "PNG")]
+    rendered_frames = scan_frame_numbers(render_filestub, ext)
+
+    for (first, last) in frame_ranges:
+        missing_frames = set(range(first, last + 1)) - rendered_frames
+        if not missing_frames:
+            continue
+
+        # Don't re-render the ends of the range that are already there.
+        # Cut ranges are short, so they aren't split into chunks.
+        build_shot(shot_list_db, shot_category, shot_id, quality, slate, in_separate_window,
+                   shot_info_overrides = {"frame_start": min(missing_frames),
+                                          "frame_end": max(missing_frames),
+                                          "frame_chunks": 1})
+
+
+def import_cut_list(shot_list_db, cut_list_filepath, slate, handles = None, render_queue_filepath = None, quality = "FINAL"):
+    """Render the frames of each shot used in an edit, plus handles; see cut_list.py
+
+    With 'render_queue_filepath', write a render queue file for render_queue.py
+    instead, with the "frame_ranges" of each shot, rather than rendering now.
+    """
+    import cut_list
+
+    events = cut_list.read_cut_list(cut_list_filepath)
+    (shot_frame_ranges, unmatched) = cut_list.get_cut_frame_ranges(
+        shot_list_db, events, cut_list.DEFAULT_HANDLES if handles is None else handles)
+
+    for name in unmatched:
+        print("No shot found for edit event \"%s\"" % name)
+
+    table = [["Category", "ID", "Frames", "Used", "Of"]]
+    for ((shot_category, shot_id), frame_ranges) in shot_frame_ranges.items():
+        shot_info = shot_list_db.get_shot_info(shot_category, shot_id)
+        used_frames = get_expected_frames(shot_info, frame_ranges)
+        all_frames = get_expected_frames(shot_info)
+        table.append([shot_category, shot_id,
+                      format_frame_ranges(used_frames),
+                      len(used_frames),
+                      "UNSET" if all_frames is None else len(all_frames)])
+    print_table(table)
+
+    if render_queue_filepath:
+        with open(render_queue_filepath, "w") as f:
+            json.dump({"quality": quality,
+                       "shots": [ {"category": shot_category, "id": shot_id, "slate": slate,
+                                   "frame_ranges": [ list(r) for r in frame_ranges ]}
+                                  for ((shot_category, shot_id), frame_ranges) in shot_frame_ranges.items() ]},
+                      f, indent = 2)
+        print("Wrote render queue \"%s\"" % render_queue_filepath)
+        return
+
+    for ((shot_category, shot_id), frame_ranges) in shot_frame_ranges.items():
+        build_frame_ranges(shot_list_db, shot_category, shot_id, quality, slate, frame_ranges)
+
+
+def stitch_shot(shot_list_db, shot_category, shot_id, slate):
+    """Stitch the rendered tiles of a tiled shot into frames"""
+    import tile_stitcher
+
+    num_frames = tile_stitcher.stitch_shot(shot_list_db, shot_category, shot_id, slate)
+    print("Stitched %d frame(s)" % num_frames)
+
+
+def get_session_key(shot_list_db, shot_category, shot_id):
+    """Shots with the same key can be rendered in one Blender session; see build_session()
+
+    Returns None for shots that must be rendered on their own: scripts and
+    the Nuke workflow change the file in ways that render_script.py can't undo.
+    Shots can also opt out with "render_in_session": false.
+    """
+    shot_info = shot_list_db.get_shot_info(shot_category, shot_id)
+
+    if (shot_info.get("scripts")
+        or shot_info.get("use_nuke_workflow", False)
+        or shot_info.get("tiles")
+        or shot_info.get("frame_chunks", 1) > 1
+        or not parse_boolean(shot_info.get("render_in_session", True))
+        or "blend_file" not in shot_info):
+        return None
+
+    return (find_latest_blend_file(shot_info["blend_file"]),
+            shot_info.get("scene"),
+            shot_info.get("render_engine", "CYCLES"),
+            shot_info.get("rendering_device", "GPU"))
+
+
+def build_session(shot_list_db, shots, quality, in_separate_window = False):
+    """Render several shots in one Blender process
+
+    shots: List of (category, id, slate). They must all have the same
+           get_session_key(); the blend file is loaded once, and Cycles keeps
+           its data between the shots.
+    """
+    if len(shots) == 1:
+        (shot_category, shot_id, slate) = shots[0]
+        return build_shot(shot_list_db, shot_category, shot_id, quality, slate, in_separate_window)
+
+    session_keys = set(get_session_key(shot_list_db, shot_category, shot_id) for (shot_category, shot_id, _) in shots)
+    if len(session_keys) != 1 or None in session_keys:
+        raise ValueError("Shots can't be rendered in one session: " + ", ".join("%s/%s/%s" % shot for shot in shots))
+
+    (blend_file, _, _, _) = session_keys.pop()
+
+    build_cmd = " ".join((["start", '"Renderer"', '/wait'] if in_separate_window else [])
+                         +
+                         ['"' + os.path.join(BLENDER_ROOT, "blender.exe") + '"', 
+                          "-b", '"' + blend_file + '"', 
+                          "--python", '"' + os.path.join(render_manager_py_path, RENDER_SCRIPT) + '"', 
+                          "--",
+                          SHOT_LIST_FILEPATH,
+                          "SESSION",
+                          quality]
+                         +
+                         [ "%s/%s/%s" % (shot_category, shot_id, slate) for (shot_category, shot_id, slate) in shots ])
+
+    print("Launching Blender Renderer session (%d shots)" % len(shots))
+    print("##########################################")
+    print()
+    print(build_cmd)
+    print()
+
+    res = subprocess.call(build_cmd, shell = True)
+
+    print("Returned Value: ", res)
+
+    if quality.upper() == "SPARSE":
+        for (shot_category, shot_id, slate) in shots:
+            interpolate_sparse_shot(shot_list_db, shot_category, shot_id, slate)
 
-def composite_shot(shot_list_db, shot_category, shot_id, quality, slate, in_separate_window = False):
+
+def get_frames_args(frame_ranges):
+    """Command line arguments that limit the compositor, denoiser or previewer to
+    'frame_ranges' ([(first, last), ...]; e.g. the frames used in the cut); none
+    for the whole shot. See parse_frame_ranges().
+    """
+    if not frame_ranges:
+        return []
+    return ['"' + format_frame_ranges(get_expected_frames({}, frame_ranges)).replace(" ", "") + '"']
+
+def composite_shot(shot_list_db, shot_category, shot_id, quality, slate, in_separate_window = False, num_instances = None,
+                   frame_ranges = None):
+    """Launch the compositor for a shot and wait for it to finish
+
+    num_instances:  Number of compositor processes to run on the shot in parallel.
+                    They share the frames between them, claiming each frame with a
+                    lock file. Defaults to "compositor_instances" in the shot list, or 1.
+    frame_ranges:   If given, [(first, last), ...] of the frames to composite,
+                    rather than the whole shot.
+    """
     shot_info = shot_list_db.get_shot_info(shot_category, shot_id)
 
+    if num_instances is None:
+        num_instances = shot_info.get("compositor_instances", 1)
+
+    # Simple compositor chains can be done without Blender, which saves the cost
+    # of starting it. "compositor_engine" is BLENDER (default), NUMPY or AUTO; for
+    # both NUMPY and AUTO we fall back on Blender if the chain isn't supported.
+    compositor_engine = shot_info.get("compositor_engine", "BLENDER").upper()
+    if compositor_engine in ["NUMPY", "AUTO"]:
+        try:
+            import numpy_compositor
+            use_numpy_compositor = numpy_compositor.is_shot_supported(shot_info)
+        except ImportError as e:
+            logging.info("NumPy compositor unavailable (%s)" % str(e))
+            use_numpy_compositor = False
+
+        if use_numpy_compositor:
+            composite_shot_with_numpy(shot_list_db, shot_category, shot_id, quality, slate, in_separate_window, frame_ranges)
+            return
+
+        logging.info("Falling back on the Blender compositor")
+
     # Look up the blend file pattern from the shot list db and resolve to an actual file.
     #
 
     DEFAULT_COMPOSITOR_CHAIN = "D:\\Assets\\Models\\Mine\\compositor recipes\\default_compositor_chain.blend"
 
-    compositor_cmd = " ".join((["start", '"Compositor"', '/wait'] if in_separate_window else [])
+    compositor_cmds = [
+        " ".join((["start", '"Compositor %d of %d"' % (i + 1, num_instances), '/wait'] if in_separate_window else [])
+                 +
+                 ['"' + os.path.join(BLENDER_ROOT, "blender.exe") + '"', 
+                  "-b", '"' + DEFAULT_COMPOSITOR_CHAIN + '"', 
+                  "--python", '"' + os.path.join(render_manager_py_path, COMPOSITOR_SCRIPT) + '"', 
+                  "--",
+                  SHOT_LIST_FILEPATH,
+                  str(shot_category),
+                  str(shot_id),
+                  quality,
+                  str(slate)]
+                 + get_frames_args(frame_ranges))
+        for i in range(num_instances)
+    ]
+
+    # No compositor is running on this shot yet, so any frame locks were left
+    # behind by a compositor that crashed.
+    remove_frame_locks(get_composite_filestub(shot_list_db, shot_info, shot_category, shot_id, slate))
+
+    print("Launching Blender compositor")
+    print("############################")
+    print()
+    for compositor_cmd in compositor_cmds:
+        print(compositor_cmd)
+    print()
+
+    processes = [ subprocess.Popen(compositor_cmd, shell = True) for compositor_cmd in compositor_cmds ]
+    res = [ process.wait() for process in processes ]
+
+    print("Returned Value: ", res[0] if len(res) == 1 else res)
+
+def composite_shot_with_numpy(shot_list_db, shot_category, shot_id, quality, slate, in_separate_window = False, frame_ranges = None):
+    """Launch numpy_compositor.py for a shot and wait for it to finish"""
+    shot_info = shot_list_db.get_shot_info(shot_category, shot_id)
+
+    compositor_cmd = " ".join((["start", '"NumPy Compositor"', '/wait'] if in_separate_window else [])
                               +
-                              ['"' + os.path.join(BLENDER_ROOT, "blender.exe") + '"', 
-                               "-b", '"' + DEFAULT_COMPOSITOR_CHAIN + '"', 
-                               "--python", '"' + os.path.join(render_manager_py_path, COMPOSITOR_SCRIPT) + '"', 
-                               "--",
+                              ['"' + sys.executable + '"', 
+                               '"' + os.path.join(render_manager_py_path, NUMPY_COMPOSITOR_SCRIPT) + '"', 
                                SHOT_LIST_FILEPATH,
                                str(shot_category),
                                str(shot_id),
                                quality,
-                               str(slate)])
+                               str(slate)]
+                              + get_frames_args(frame_ranges))
 
-    print("Launching Blender compositor")
-    print("############################")
+    remove_frame_locks(get_composite_filestub(shot_list_db, shot_info, shot_category, shot_id, slate))
+
+    print("Launching NumPy compositor")
+    print("##########################")
     print()
     print(compositor_cmd)
     print()
@@ -145,36 +562,169 @@ def composite_shot(shot_list_db, shot_category, shot_id, quality, slate, in_sepa
 
     print("Returned Value: ", res)
 
-def verify_shot(shot_list_db, shot_category, shot_id, slate):
+def denoise_shot(shot_list_db, shot_category, shot_id, slate, in_separate_window = False, frame_ranges = None):
+    """Launch the denoiser for a shot and wait for it to finish; see denoise_script.py
+
+    It doesn't need the shot's blend file, so Blender starts with its factory
+    settings, which is quick. Run it again after changing the shot's "denoise"
+    settings to denoise the shot again.
 
-    ### XXX We have the same code in render_script.py :/
+    frame_ranges: If given, [(first, last), ...] of the frames to denoise.
+    """
     shot_info = shot_list_db.get_shot_info(shot_category, shot_id)
 
-    # Use output path override given in the shot list, if given. Otherwise, fallback on eg. Renders/Title/slate_3/...
-    if shot_info.get("output_filepath_override"):
-        ## THIS DOESN'T WORK (NO bpy MODULE)
-        scene_name = shot_info.get("scene", bpy.data.scenes[0].name)
-        scene = bpy.data.scenes[scene_name]
-        scene.render.filepath = shot_info.get("output_filepath_override")
-    else:
-        output_path_base =  os.path.join(shot_list_db.render_root, shot_info["title"])
+    denoise_cmd = " ".join((["start", '"Denoiser"', '/wait'] if in_separate_window else [])
+                           +
+                           ['"' + os.path.join(BLENDER_ROOT, "blender.exe") + '"', 
+                            "-b", "--factory-startup",
+                            "--python", '"' + os.path.join(render_manager_py_path, DENOISE_SCRIPT) + '"', 
+                            "--",
+                            SHOT_LIST_FILEPATH,
+                            str(shot_category),
+                            str(shot_id),
+                            str(slate)]
+                           + get_frames_args(frame_ranges))
+
+    # No denoiser is running on this shot yet, so any frame locks were left
+    # behind by one that crashed.
+    remove_frame_locks(get_denoise_filestub(shot_list_db, shot_info, shot_category, shot_id, slate))
+
+    print("Launching Blender denoiser")
+    print("##########################")
+    print()
+    print(denoise_cmd)
+    print()
+
+    res = subprocess.call(denoise_cmd, shell = True)
+
+    print("Returned Value: ", res)
+
+def preview_shot(shot_list_db, shot_category, shot_id, slate, source = "RENDER", in_separate_window = False, frame_ranges = None):
+    """Launch preview_generator.py for a shot and wait for it to finish
+
+    source:        "RENDER" to preview the rendered frames or "COMPOSITE" for the composited ones.
+    frame_ranges:  If given, [(first, last), ...] of the frames to preview.
+    """
+    preview_cmd = " ".join((["start", '"Previews"', '/wait'] if in_separate_window else [])
+                           +
+                           ['"' + sys.executable + '"', 
+                            '"' + os.path.join(render_manager_py_path, PREVIEW_SCRIPT) + '"', 
+                            SHOT_LIST_FILEPATH,
+                            str(shot_category),
+                            str(shot_id),
+                            str(slate),
+                            source]
+                           + get_frames_args(frame_ranges))
+
+    print("Launching preview generator")
+    print("###########################")
+    print()
+    print(preview_cmd)
+    print()
 
-    filename_stub =  str(shot_category) + "_" + str(shot_id) + "_" + str(slate) + "_"
-    render_path = os.path.join(output_path_base, "slate_%d\\" % slate) + filename_stub
+    res = subprocess.call(preview_cmd, shell = True)
 
+    print("Returned Value: ", res)
+
+def get_expected_frames(shot_info, frame_ranges = None):
+    """The frames that a render of the shot should produce, or None if we can't tell
+
+    frame_ranges: If given, [(first, last), ...] of the frames wanted (e.g. the
+                  frames used in the cut; see cut_list.py) instead of the
+                  shot's whole frame range.
+    """
+    if frame_ranges:
+        return set(frame for (first, last) in frame_ranges for frame in range(first, last + 1))
+
+    frame_range = get_frame_range(shot_info)
+    if frame_range:
+        return set(range(frame_range[0], frame_range[1] + 1))
+
+    return None
+
+def verify_shot(shot_list_db, shot_category, shot_id, slate, frame_ranges = None):
+    shot_info = shot_list_db.get_shot_info(shot_category, shot_id)
+    render_filestub = get_render_filestub(shot_list_db, shot_info, shot_category, shot_id, slate)
+
+    ext = IMAGE_FILE_EXTENSIONS[shot_info.get("render_file_format", "PNG")]
+    rendered_frames = scan_frame_numbers(render_filestub, ext)
 
     ### If the frame range isn't specified, all we can do is check for at least one frame.
-    if 'frame_start' in shot_info and 'frame_end' in shot_info:
-        ext = IMAGE_FILE_EXTENSIONS[shot_info.get("render_file_format", "PNG")]
-        
-        for frame in range(shot_info["frame_start"], shot_info["frame_end"] + 1):
-            filename = "%04d" % frame + "." + ext
-            if not os.path.exists(render_path + filename):
-                return False
-        return True
+    ### Only frames count; render_script.py also writes e.g. the memory estimate
+    ### and timing reports next to them, before any frame is rendered.
+    expected_frames = get_expected_frames(shot_info, frame_ranges)
+    if expected_frames is not None:
+        return expected_frames <= rendered_frames
+    else:
+        return len(rendered_frames) > 0
+
+def count_rendered_frames(shot_list_db, shot_category, shot_id, slate, frame_ranges = None):
+    """Return (number of frames rendered, number of frames expected) for a shot
+
+    The expected count is None if the shot list doesn't give the frame range
+    (and no 'frame_ranges' are given).
+    """
+    shot_info = shot_list_db.get_shot_info(shot_category, shot_id)
+    render_filestub = get_render_filestub(shot_list_db, shot_info, shot_category, shot_id, slate)
+    ext = IMAGE_FILE_EXTENSIONS[shot_info.get("render_file_format", "PNG")]
+    rendered_frames = scan_frame_numbers(render_filestub, ext)
+
+    expected_frames = get_expected_frames(shot_info, frame_ranges)
+    if expected_frames is not None:
+        return len(rendered_frames.intersection(expected_frames)), len(expected_frames)
     else:
-        return len(os.listdir(render_path)) > 0
+        return len(rendered_frames), None
 
+def show_timings(shot_list_db, shots = None, slate = None):
+    """Summarise the timing reports that render_script.py wrote for the given shots
+
+    'shots' is a list of (category, id); all shots if None. Uses the latest
+    slate of each shot unless 'slate' is given.
+    """
+    import render_timings
+
+    all_reports = []
+    rows = []
+    for (shot_category, shot_id) in (shots or shot_list_db.shot_ids):
+        shot_info = shot_list_db.get_shot_info(shot_category, shot_id)
+        shot_slate = slate if slate is not None else find_latest_slate_number(shot_list_db, shot_info)
+        if shot_slate is None:
+            continue
+
+        reports = render_timings.load_timing_reports(get_render_filestub(shot_list_db, shot_info, shot_category, shot_id, shot_slate))
+        if not reports:
+            continue
+        all_reports += reports
+
+        summary = render_timings.aggregate_timing_reports(reports)
+        setup_phases = { name: seconds for (name, seconds) in summary["phases"].items() if name != "render" }
+        slowest_phase = max(setup_phases, key = setup_phases.get, default = None)
+        frames = summary["frames"]
+
+        rows.append([
+            shot_info["title"], shot_category, shot_id, shot_slate,
+            summary["runs"],
+            frames["count"],
+            "-" if frames["mean"] is None else "%.1f" % frames["mean"],
+            "-" if frames["median"] is None else "%.1f" % frames["median"],
+            "-" if frames["max"] is None else "%.1f" % frames["max"],
+            "%.1f" % sum(setup_phases.values()),
+            "-" if slowest_phase is None else "%s (%.1fs)" % (slowest_phase, setup_phases[slowest_phase]),
+        ])
+
+    if not rows:
+        print("No timing reports found")
+        return
+
+    print_table([["Title", "Category", "ID", "Slate", "Runs", "Frames", "Mean s", "Median s", "Max s", "Setup s", "Slowest Setup Phase"]] + rows)
+
+    # Where the time goes over all of the shots
+    print()
+    summary = render_timings.aggregate_timing_reports(all_reports)
+    total = sum(summary["phases"].values()) or 1.0
+    print_table([["Phase", "Total s", "%"]] +
+                [[name, "%.1f" % seconds, "%.1f" % (100.0 * seconds / total)]
+                 for (name, seconds) in sorted(summary["phases"].items(), key = lambda item: -item[1])])
 
 
 def main(*_args):
@@ -190,24 +740,70 @@ def main(*_args):
     shot_list_db = ShotListDb.from_file(SHOT_LIST_FILEPATH)
 
     if command == "LIST":
-        list_shots(shot_list_db)
+        list_shots(shot_list_db, as_json = len(args) > 0 and args[0].upper() in ["JSON", "--JSON"])
     elif command == "BUILD":
         try:
  #           if len(args) == 3:
  #               [shot_category, shot_id, quality] = args
  #               slate_number = None
+            shot_info_overrides = parse_shot_info_overrides([ arg for arg in args if "=" in arg ])
+            args = [ arg for arg in args if "=" not in arg ]
+
             if len(args) == 4:
                 [shot_category, shot_id, quality, slate_number] = args
             else:
                 raise ValueError("Not enough args")
 
-            if quality.upper() not in ["LOW", "MEDIUM", "HIGH", "FINAL"]:
+            if quality.upper() not in ["LOW", "MEDIUM", "HIGH", "FINAL", "SPARSE"]:
                 raise ValueError
         except ValueError:
-            print("Usage:", "render_manager.py", "BUILD", "<category>", "<id>", "<quality: LOW|MEDIUM|HIGH|FINAL>", "[slate number]") 
+            print("Usage:", "render_manager.py", "BUILD", "<category>", "<id>", "<quality: LOW|MEDIUM|HIGH|FINAL|SPARSE>", "[slate number]", "[KEY=VALUE ...]") 
             return
          
-        build_shot(shot_list_db, shot_category, shot_id, quality, slate_number) 
+        build_shot(shot_list_db, shot_category, shot_id, quality, slate_number, shot_info_overrides = shot_info_overrides) 
+    elif command == "LOOKDEV":
+        try:
+            if len(args) == 5:
+                [shot_category, shot_id, quality, slate_number, time_budget_seconds] = args
+                time_budget_seconds = float(time_budget_seconds)
+            else:
+                raise ValueError("Not enough args")
+
+            if quality.upper() not in ["LOW", "MEDIUM", "HIGH", "FINAL"]:
+                raise ValueError
+        except ValueError:
+            print("Usage:", "render_manager.py", "LOOKDEV", "<category>", "<id>", "<quality: LOW|MEDIUM|HIGH|FINAL>", "slate number", "<time budget in seconds>") 
+            return
+
+        # Render as well as we can in the time, rather than to max_cycles_samples.
+        build_shot(shot_list_db, shot_category, shot_id, quality, slate_number,
+                   shot_info_overrides = {"time_budget_seconds": time_budget_seconds})
+    elif command == "STITCH":
+        try:
+            if len(args) == 3:
+                [shot_category, shot_id, slate_number] = args
+            else:
+                raise ValueError("Not enough args")
+        except ValueError:
+            print("Usage:", "render_manager.py", "STITCH", "<category>", "<id>", "slate number") 
+            return
+
+        stitch_shot(shot_list_db, shot_category, shot_id, slate_number)
+    elif command == "SESSION":
+        try:
+            if len(args) < 2:
+                raise ValueError("Not enough args")
+
+            quality = args[0]
+            shots = [ tuple(shot.split("/")) for shot in args[1:] ]
+
+            if quality.upper() not in ["LOW", "MEDIUM", "HIGH", "FINAL", "SPARSE"] or not all(len(shot) == 3 for shot in shots):
+                raise ValueError
+        except ValueError:
+            print("Usage:", "render_manager.py", "SESSION", "<quality: LOW|MEDIUM|HIGH|FINAL|SPARSE>", "<category>/<id>/<slate>", "...") 
+            return
+
+        build_session(shot_list_db, shots, quality)
     elif command == "COMPOSITE":
         try:
             #f len(args) == 3:
@@ -215,25 +811,85 @@ def main(*_args):
             #   slate_number = None
             if len(args) == 4:
                 [shot_category, shot_id, quality, slate_number] = args
+                num_instances = None
+            elif len(args) == 5:
+                [shot_category, shot_id, quality, slate_number, num_instances] = args
+                num_instances = int(num_instances)
             else:
                 raise ValueError("Not enough args")
 
             if quality.upper() not in ["LOW", "MEDIUM", "HIGH", "FINAL"]:
                 raise ValueError
         except ValueError:
-            print("Usage:", "render_manager.py", "COMPOSITE", "<category>", "<id>", "<quality: LOW|MEDIUM|HIGH|FINAL>", "slate number") 
+            print("Usage:", "render_manager.py", "COMPOSITE", "<category>", "<id>", "<quality: LOW|MEDIUM|HIGH|FINAL>", "slate number", "[number of compositor processes]") 
+            return
+
+        composite_shot(shot_list_db, shot_category, shot_id, quality, slate_number, num_instances = num_instances) 
+
+    elif command == "DENOISE":
+        try:
+            if len(args) == 3:
+                [shot_category, shot_id, slate_number] = args
+            else:
+                raise ValueError("Not enough args")
+        except ValueError:
+            print("Usage:", "render_manager.py", "DENOISE", "<category>", "<id>", "slate number") 
+            return
+
+        denoise_shot(shot_list_db, shot_category, shot_id, slate_number)
+
+    elif command == "PREVIEW":
+        try:
+            if len(args) == 3:
+                [shot_category, shot_id, slate_number] = args
+                source = "RENDER"
+            elif len(args) == 4:
+                [shot_category, shot_id, slate_number, source] = args
+            else:
+                raise ValueError("Not enough args")
+
+            if source.upper() not in ["RENDER", "COMPOSITE"]:
+                raise ValueError
+        except ValueError:
+            print("Usage:", "render_manager.py", "PREVIEW", "<category>", "<id>", "slate number", "[RENDER|COMPOSITE]") 
+            return
+
+        preview_shot(shot_list_db, shot_category, shot_id, slate_number, source.upper())
+
+    elif command == "CUT":
+        try:
+            if len(args) == 2:
+                [cut_list_filepath, slate_number] = args
+                handles = None
+                render_queue_filepath = None
+            elif len(args) == 3:
+                [cut_list_filepath, slate_number, handles] = args
+                handles = int(handles)
+                render_queue_filepath = None
+            elif len(args) == 4:
+                [cut_list_filepath, slate_number, handles, render_queue_filepath] = args
+                handles = int(handles)
+            else:
+                raise ValueError("Wrong number of args")
+            int(slate_number)
+        except ValueError:
+            print("Usage:", "render_manager.py", "CUT", "<EDL or CSV cut list>", "slate number", "[handles]", "[render queue file to write]")
             return
 
-        composite_shot(shot_list_db, shot_category, shot_id, quality, slate_number) 
+        import_cut_list(shot_list_db, cut_list_filepath, int(slate_number), handles, render_queue_filepath)
 
     elif command == "VERIFY":
         try:
             if len(args) == 3:
                [shot_category, shot_id, slate] = args
+               frame_ranges = None
+            elif len(args) == 4:
+               [shot_category, shot_id, slate] = args[:3]
+               frame_ranges = contiguous_frame_ranges(parse_frame_ranges(args[3]))
             else:
                 raise ValueError("Not enough args")
         except ValueError:
-            print("Usage:", "render_manager.py", "VERIFY", "<category>", "<id>", "slate number") 
+            print("Usage:", "render_manager.py", "VERIFY", "<category>", "<id>", "slate number", "[frames, e.g. 1-10,20-30]") 
             return
 
         try:
@@ -242,16 +898,35 @@ def main(*_args):
             print("Slate number must be an integer")
             return
 
-        result = verify_shot(shot_list_db, shot_category, shot_id, slate_number)
+        result = verify_shot(shot_list_db, shot_category, shot_id, slate_number, frame_ranges)
         if result:
             print("Shot fully rendered")
         else:
             print("Render incomplete")
 
 
+    elif command == "TIMINGS":
+        try:
+            if len(args) == 0:
+                shots = None
+                slate_number = None
+            elif len(args) == 2:
+                shots = [(args[0], args[1])]
+                slate_number = None
+            elif len(args) == 3:
+                shots = [(args[0], args[1])]
+                slate_number = int(args[2])
+            else:
+                raise ValueError("Wrong number of args")
+        except ValueError:
+            print("Usage:", "render_manager.py", "TIMINGS", "[<category> <id> [slate number]]")
+            return
+
+        show_timings(shot_list_db, shots, slate_number)
+
     else:
         print("Unknown command:", command)
-        print("Usage:", "render_manager.py", "[LIST|BUILD|COMPOSITE]")
+        print("Usage:", "render_manager.py", "[LIST|BUILD|SESSION|LOOKDEV|STITCH|CUT|DENOISE|COMPOSITE|PREVIEW|VERIFY|TIMINGS]")
         
 
 if __name__ == '__main__':
@@ -11,23 +11,60 @@ ADD <params>        Adds a new job.
                     (params should match render_manager.py's BUILD cmd)
 DEL <params>        Removes the job with the givens params
 
+Status:
+
+While the queue is running, a JSON status report is served over HTTP on
+http://127.0.0.1:<status_port>/status (default port 8765; set "status_port"
+in render_queue.json to change it). The report gives the current job of each
+worker, frames per hour (overall and per shot), per-device utilization, the
+queue depth and an ETA for the remaining frames.
+
+Sessions:
+
+The renderer renders shots that share a blend file (and scene, engine and
+device) in one Blender session, so that the file is loaded, and the BVH and
+textures built, only once; see render_manager.build_session(). Up to
+"max_session_shots" (default 8) unrendered shots of the queue go in a session;
+set it to 1 in render_queue.json to render every shot on its own.
+
+Denoising:
+
+Shots with "denoise_enabled": true are rendered noisy, with their denoise
+passes, and denoised by a separate stage on the CPU (see denoise_script.py);
+so the renderer moves on to the next shot as soon as the frames are rendered.
+The compositor works on the denoised frames.
+
+Frame ranges:
+
+A shot in render_queue.json can give "frame_ranges": [[first, last], ...] to
+render (and check) only those frames, rather than the shot's whole frame
+range; e.g. the frames used in the cut. render_manager.py CUT writes queue
+files like that from an EDL. Shots with frame ranges are rendered on their own,
+one job per range; and the compositor, denoiser and previewer work on, and
+wait for, just those frames.
+
 """
 from multiprocessing.connection import Listener, wait
 from multiprocessing import Process, Manager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from array import array
 import logging
 import json
 import collections
+import threading
 import time
 import os
 
 logging.basicConfig(level=logging.INFO)
 
+DEFAULT_STATUS_PORT = 8765
+DEFAULT_MAX_SESSION_SHOTS = 8
+
 ###
 ### The Queue
 ###
 
-_Shot = collections.namedtuple("_Shot", "category,id,slate")
+_Shot = collections.namedtuple("_Shot", "category,id,slate,frame_ranges", defaults = (None,))
 
 def shot_to_str(shot):
     return str(shot.category) + "/" + str(shot.id) + "/" + str(shot.slate)
@@ -56,9 +93,11 @@ class RenderQueue:
         """Create an instace of RenderQueue from a dict loaded from JSON"""
         state["quality"] = db["quality"]
         state["shots"] = [
-            RenderQueue.Shot(shot["category"], shot["id"], shot["slate"])
+            RenderQueue.Shot(shot["category"], shot["id"], shot["slate"], shot.get("frame_ranges"))
             for shot in db["shots"]
         ]
+        state["status_port"] = db.get("status_port", DEFAULT_STATUS_PORT)
+        state["max_session_shots"] = db.get("max_session_shots", DEFAULT_MAX_SESSION_SHOTS)
 
     @classmethod
     def from_file(cls, manager, filepath):
@@ -113,11 +152,172 @@ class RenderQueue:
     def shots(self):
         return self._state["shots"]
 
+    @property
+    def status_port(self):
+        return self._state.get("status_port", DEFAULT_STATUS_PORT)
+
+    @property
+    def max_session_shots(self):
+        return self._state.get("max_session_shots", DEFAULT_MAX_SESSION_SHOTS)
+
     # Get the internal state (to pass to a sub-process)
     @property
     def state(self):
         return self._state
 
+###
+### Queue status
+###
+
+class QueueStatus:
+    """Live figures about what the workers are doing
+
+    The state lives in a multiprocessing.Manager dict so that the renderer and
+    compositor sub-processes can update it and the status server can read it.
+    Workers only write to it when a job starts or finishes, so keeping it up to
+    date costs nothing while Blender is running.
+
+    Keys are flat tuples, rather than nested dicts, because changes to a dict
+    nested inside a Manager dict are not propagated between processes.
+
+      ("worker", <worker name>) -> current job of the worker, or None if idle
+      ("shot", <worker name>, <shot>) -> {"frames": n, "seconds": t} done so far
+      ("device_busy", <device>) -> seconds of completed jobs on the device
+    """
+
+    @classmethod
+    def create(cls, manager):
+        state = manager.dict()
+        state["started_at"] = time.time()
+
+        return cls(state)
+
+    @classmethod
+    def from_state(cls, state):
+        return cls(state)
+
+    def __init__(self, state):
+        self._state = state
+
+    @property
+    def state(self):
+        return self._state
+
+    def job_started(self, worker_name, shot, device, frames_done, session_shots = None):
+        """Record that 'worker_name' started working on 'shot'
+
+        frames_done:   Frames of the shot already on disk when the job started.
+        session_shots: If the job renders several shots in one session, all of
+                       them (including 'shot'); the job's frames are counted
+                       over all of them, but reported against 'shot'.
+        """
+        self._state[("worker", worker_name)] = {
+            "shot": shot_to_str(shot),
+            "session": [ shot_to_str(s) for s in (session_shots or [shot]) ],
+            "device": device,
+            "started_at": time.time(),
+            "frames_at_start": frames_done,
+        }
+
+    def job_finished(self, worker_name, frames_done):
+        """Record that the current job of 'worker_name' has finished
+
+        frames_done: Frames of the shot on disk now that the job has finished.
+        """
+        job = self._state.get(("worker", worker_name))
+        if job is None:
+            return
+
+        seconds = time.time() - job["started_at"]
+        frames = max(0, frames_done - job["frames_at_start"])
+
+        shot_key = ("shot", worker_name, job["shot"])
+        totals = self._state.get(shot_key, {"frames": 0, "seconds": 0.0})
+        self._state[shot_key] = {"frames": totals["frames"] + frames,
+                                 "seconds": totals["seconds"] + seconds}
+
+        device_key = ("device_busy", job["device"])
+        self._state[device_key] = self._state.get(device_key, 0.0) + seconds
+
+        self._state[("worker", worker_name)] = None
+
+    def snapshot(self, live_frames = None):
+        """Return the status as a JSON-able dict
+
+        live_frames: Maps a worker name to the number of frames of its current
+                     shot now on disk; used to include running jobs in the figures.
+        """
+        if live_frames is None:
+            live_frames = {}
+        now = time.time()
+        state = dict(self._state) # One round trip to the manager.
+        uptime = now - state["started_at"]
+
+        def frames_per_hour(frames, seconds):
+            return round(frames * 3600.0 / seconds, 1) if seconds > 0 else None
+
+        workers = {}
+        shots = collections.defaultdict(lambda: {"frames": 0, "seconds": 0.0})
+        device_busy = collections.defaultdict(float)
+
+        for key, value in state.items():
+            if key[0] == "shot":
+                (_, worker_name, shot) = key
+                shots[(worker_name, shot)]["frames"] += value["frames"]
+                shots[(worker_name, shot)]["seconds"] += value["seconds"]
+            elif key[0] == "device_busy":
+                device_busy[key[1]] += value
+
+        for key, job in state.items():
+            if key[0] != "worker":
+                continue
+            worker_name = key[1]
+
+            if job is None:
+                workers[worker_name] = None
+                continue
+
+            seconds = now - job["started_at"]
+            frames = max(0, live_frames.get(worker_name, job["frames_at_start"]) - job["frames_at_start"])
+
+            shots[(worker_name, job["shot"])]["frames"] += frames
+            shots[(worker_name, job["shot"])]["seconds"] += seconds
+            device_busy[job["device"]] += seconds
+
+            workers[worker_name] = {
+                "shot": job["shot"],
+                "device": job["device"],
+                "running_for": round(seconds),
+                "frames": frames,
+                "frames_per_hour": frames_per_hour(frames, seconds),
+            }
+
+        per_worker = collections.defaultdict(lambda: {"frames": 0, "seconds": 0.0, "shots": {}})
+        for (worker_name, shot), totals in shots.items():
+            per_worker[worker_name]["frames"] += totals["frames"]
+            per_worker[worker_name]["seconds"] += totals["seconds"]
+            per_worker[worker_name]["shots"][shot] = {
+                "frames": totals["frames"],
+                "frames_per_hour": frames_per_hour(totals["frames"], totals["seconds"]),
+            }
+
+        return {
+            "uptime": round(uptime),
+            "workers": workers,
+            "throughput": {
+                worker_name: {
+                    "frames": totals["frames"],
+                    "frames_per_hour": frames_per_hour(totals["frames"], uptime),
+                    "shots": totals["shots"],
+                }
+                for worker_name, totals in per_worker.items()
+            },
+            "device_utilization": {
+                device: round(min(1.0, busy / uptime), 3) if uptime > 0 else None
+                for device, busy in device_busy.items()
+            },
+        }
+
 #
 # Do common initialization tasks of the renderer and compositor subprocesses
 #
@@ -181,10 +381,54 @@ def get_next_shot(render_queue, current_shot, end_of_queue_sleep_time):
 import render_manager
 import time
 
+# Number of frames of 'shot' already on disk.
+def count_frames_done(shot_list_db, shot):
+    """Frames of the shot on disk; only those in its "frame_ranges", if it has them"""
+    try:
+        return render_manager.count_rendered_frames(shot_list_db, shot.category, shot.id, shot.slate, shot.frame_ranges)[0]
+    except Exception:
+        logging.exception("Failed to count frames of shot \"" + shot_to_str(shot) + "\"")
+        return 0
+
+#
+# Pick the shots to render in the same Blender session as 'current_shot': the
+# unrendered shots with the same session key, in queue order starting from
+# 'current_shot'. A shot that can't share a session is rendered on its own.
+#
+def get_session_shots(render_queue, shot_list_db, current_shot):
+    try:
+        session_key = render_manager.get_session_key(shot_list_db, current_shot.category, current_shot.id)
+    except Exception:
+        logging.exception("Failed to get session key of shot \"" + shot_to_str(current_shot) + "\"")
+        session_key = None
+
+    if session_key is None or current_shot.frame_ranges or render_queue.max_session_shots <= 1:
+        return [current_shot]
+
+    shots = list(render_queue.shots)
+    start = ([ i for (i, shot) in enumerate(shots) if shot_to_str(shot) == shot_to_str(current_shot) ] + [0])[0]
+
+    session_shots = [current_shot]
+    for shot in shots[start:] + shots[:start]:
+        if len(session_shots) >= render_queue.max_session_shots:
+            break
+        if shot_to_str(shot) in [ shot_to_str(s) for s in session_shots ] or shot.frame_ranges:
+            continue
+
+        try:
+            if (render_manager.get_session_key(shot_list_db, shot.category, shot.id) == session_key
+                and not render_manager.verify_shot(shot_list_db, shot.category, shot.id, shot.slate)):
+                session_shots.append(shot)
+        except Exception:
+            logging.exception("Failed to check shot \"" + shot_to_str(shot) + "\" for session")
+
+    return session_shots
+
 # This is the main function of the render sub-process
-def render_queue_main(render_queue_state, current_shot_as_lst):
+def render_queue_main(render_queue_state, current_shot_as_lst, status_state):
 
     render_queue, shot_list_db, current_shot = setup_subprocess("render queue", render_queue_state, current_shot_as_lst)
+    status = QueueStatus.from_state(status_state)
 
     while True:
 
@@ -199,14 +443,31 @@ def render_queue_main(render_queue_state, current_shot_as_lst):
 
         is_render_complete = render_manager.verify_shot(shot_list_db, current_shot.category,
                                                         current_shot.id, 
-                                                        current_shot.slate)
+                                                        current_shot.slate,
+                                                        current_shot.frame_ranges)
         if not is_render_complete:
-            logging.info("Shot \""+ shot_to_str(current_shot) + "\" not rendered; launching Blender...")
-            render_manager.build_shot(shot_list_db, current_shot.category,
-                                                    current_shot.id, 
-                                                    render_queue.quality, 
-                                                    current_shot.slate,
-                                                    in_separate_window = True)
+            session_shots = get_session_shots(render_queue, shot_list_db, current_shot)
+            logging.info("Shot \""+ shot_to_str(current_shot) + "\" not rendered; launching Blender..." +
+                         ("" if len(session_shots) == 1 else
+                          " (session with " + ", ".join(shot_to_str(shot) for shot in session_shots[1:]) + ")"))
+
+            device = shot_list_db.get_shot_info(current_shot.category, current_shot.id).get("rendering_device", "GPU")
+            status.job_started("renderer", current_shot, device,
+                               sum(count_frames_done(shot_list_db, shot) for shot in session_shots),
+                               session_shots)
+
+            if current_shot.frame_ranges:
+                render_manager.build_frame_ranges(shot_list_db, current_shot.category, current_shot.id,
+                                                  render_queue.quality, current_shot.slate,
+                                                  current_shot.frame_ranges,
+                                                  in_separate_window = True)
+            else:
+                render_manager.build_session(shot_list_db,
+                                             [ (shot.category, shot.id, shot.slate) for shot in session_shots ],
+                                             render_queue.quality,
+                                             in_separate_window = True)
+
+            status.job_finished("renderer", sum(count_frames_done(shot_list_db, shot) for shot in session_shots))
         else:
             logging.info("Shot \"" + shot_to_str(current_shot) + "\" already built; trying next shot...")
 
@@ -218,25 +479,30 @@ def render_queue_main(render_queue_state, current_shot_as_lst):
         logging.info("Sleeping for 5 seconds...")
         time.sleep(5)
 
-# This is the main function of the compositor sub-process
-def compositor_queue_main(render_queue_state, current_shot_as_lst):
+#
+# The compositor and the other stages that follow the renderer all work through
+# the queue in the same way: for every shot that has 'enabled_key' set in its
+# shot info, call 'run_stage' and wait for it to finish. The stages run on the
+# CPU. We count rendered frames, because those are what the stages wait on.
+#
+def stage_queue_main(stage_name, enabled_key, run_stage, render_queue_state, current_shot_as_lst, status_state):
 
     # Do any setup of this sub-process; e.g. wrap 'render_queue_state' in a Python object.
-    render_queue, shot_list_db, current_shot = setup_subprocess("compositor queue", render_queue_state, current_shot_as_lst)
+    render_queue, shot_list_db, current_shot = setup_subprocess(stage_name + " queue", render_queue_state, current_shot_as_lst)
+    status = QueueStatus.from_state(status_state)
 
 
     while True:
         shot_info = shot_list_db.get_shot_info(current_shot.category, current_shot.id)
 
-        if shot_info.get("compositing_enabled", False):
-            render_manager.composite_shot(shot_list_db,
-                                          current_shot.category,
-                                          current_shot.id, 
-                                          render_queue.quality, 
-                                          current_shot.slate,
-                                          in_separate_window = True)
+        if shot_info.get(enabled_key, False):
+            status.job_started(stage_name, current_shot, "CPU", count_frames_done(shot_list_db, current_shot))
+
+            run_stage(shot_list_db, current_shot, render_queue.quality)
 
-        logging.info("Shot \"" + shot_to_str(current_shot) + "\" composited; trying next shot...")
+            status.job_finished(stage_name, count_frames_done(shot_list_db, current_shot))
+
+        logging.info("Shot \"" + shot_to_str(current_shot) + "\" done by " + stage_name + "; trying next shot...")
 
         current_shot = get_next_shot(render_queue, current_shot, end_of_queue_sleep_time = 300)
 
@@ -246,6 +512,140 @@ def compositor_queue_main(render_queue_state, current_shot_as_lst):
         logging.info("Sleeping for 5 seconds...")
         time.sleep(5)
 
+# This is the main function of the compositor sub-process
+def compositor_queue_main(render_queue_state, current_shot_as_lst, status_state):
+    def run_stage(shot_list_db, shot, quality):
+        render_manager.composite_shot(shot_list_db, shot.category, shot.id, quality, shot.slate,
+                                      in_separate_window = True, frame_ranges = shot.frame_ranges)
+
+    stage_queue_main("compositor", "compositing_enabled", run_stage,
+                     render_queue_state, current_shot_as_lst, status_state)
+
+# This is the main function of the denoiser sub-process; it denoises the frames
+# of shots rendered with their denoise passes, in place of Cycles denoising
+# them on the GPU machine.
+def denoise_queue_main(render_queue_state, current_shot_as_lst, status_state):
+    def run_stage(shot_list_db, shot, quality):
+        render_manager.denoise_shot(shot_list_db, shot.category, shot.id, shot.slate,
+                                    in_separate_window = True, frame_ranges = shot.frame_ranges)
+
+    stage_queue_main("denoiser", "denoise_enabled", run_stage,
+                     render_queue_state, current_shot_as_lst, status_state)
+
+# This is the main function of the preview sub-process; it makes proxies and
+# contact sheets of the rendered, or composited, frames as they land.
+def preview_queue_main(render_queue_state, current_shot_as_lst, status_state):
+    def run_stage(shot_list_db, shot, quality):
+        source = shot_list_db.get_shot_info(shot.category, shot.id).get("preview", {}).get("source", "RENDER")
+        render_manager.preview_shot(shot_list_db, shot.category, shot.id, shot.slate, source.upper(),
+                                    in_separate_window = True, frame_ranges = shot.frame_ranges)
+
+    stage_queue_main("previewer", "preview_enabled", run_stage,
+                     render_queue_state, current_shot_as_lst, status_state)
+
+#
+# Status server
+#
+# Serves the status report over HTTP. Requests are answered from a cached copy
+# of the report, which a background thread refreshes once a second, so polling
+# the server never touches the disk or slows down the workers. The directory
+# scans needed for the queue depth and ETA are slower, so they are only
+# refreshed every STATUS_SCAN_INTERVAL seconds.
+#
+STATUS_REFRESH_INTERVAL = 1
+STATUS_SCAN_INTERVAL = 30
+
+def status_server_main(render_queue_state, current_shot_as_lst, status_state):
+    render_queue, shot_list_db, _ = setup_subprocess("status server", render_queue_state, current_shot_as_lst)
+    status = QueueStatus.from_state(status_state)
+
+    cached_report = [b"{}"]
+    queue_summary = {}
+    live_frames = {}
+
+    def scan_queue():
+        """Count rendered frames of every shot in the queue"""
+        nonlocal queue_summary
+
+        shots_pending = 0
+        frames_remaining = 0
+        frames_unknown = False
+        for shot in render_queue.shots:
+            try:
+                rendered, expected = render_manager.count_rendered_frames(shot_list_db, shot.category, shot.id, shot.slate,
+                                                                         shot.frame_ranges)
+            except Exception:
+                logging.exception("Status server failed to scan shot \"" + shot_to_str(shot) + "\"")
+                continue
+
+            if expected is None:
+                frames_unknown = True
+                shots_pending += 1 if rendered == 0 else 0
+            elif rendered < expected:
+                shots_pending += 1
+                frames_remaining += expected - rendered
+
+        queue_summary = {"queue_depth": shots_pending,
+                         "frames_remaining": frames_remaining,
+                         "frames_remaining_is_lower_bound": frames_unknown}
+
+        # Refresh the frame count of the shots that the workers are on; the
+        # status only has their names, so look up their frame ranges in the queue.
+        queue_shots = { shot_to_str(shot): shot for shot in render_queue.shots }
+        for key, job in dict(status.state).items():
+            if key[0] == "worker" and job is not None:
+                live_frames[key[1]] = sum(count_frames_done(shot_list_db, queue_shots.get(shot, RenderQueue.Shot(*shot.split("/"))))
+                                          for shot in job.get("session", [job["shot"]]))
+
+    def refresh():
+        last_scan = 0
+        while True:
+            try:
+                if time.time() - last_scan > STATUS_SCAN_INTERVAL:
+                    shot_list_db.refresh()
+                    scan_queue()
+                    last_scan = time.time()
+
+                report = status.snapshot(live_frames)
+                report.update(queue_summary)
+                report["quality"] = render_queue.quality
+
+                # ETA from the rendering rate over the whole run.
+                fph = report["throughput"].get("renderer", {}).get("frames_per_hour")
+                frames_remaining = report.get("frames_remaining")
+                if fph and frames_remaining is not None:
+                    report["eta_seconds"] = round(frames_remaining * 3600.0 / fph)
+                else:
+                    report["eta_seconds"] = None
+
+                cached_report[0] = json.dumps(report, indent = 2).encode("utf-8")
+            except Exception:
+                logging.exception("Failed to refresh status report")
+
+            time.sleep(STATUS_REFRESH_INTERVAL)
+
+    class StatusRequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path not in ["/", "/status"]:
+                self.send_error(404)
+                return
+
+            body = cached_report[0]
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        # Don't log every request; clients will poll once a second.
+        def log_message(self, format, *args):
+            pass
+
+    threading.Thread(target = refresh, daemon = True).start()
+
+    server = ThreadingHTTPServer(("127.0.0.1", render_queue.status_port), StatusRequestHandler)
+    logging.info("Serving queue status on http://127.0.0.1:%d/status" % render_queue.status_port)
+    server.serve_forever()
 
 
 #
@@ -261,10 +661,14 @@ if __name__ == '__main__':
         render_queue = RenderQueue.from_file(manager, r"render_queue.json")
         # Copy of category/id/slate identifies the current shot.
         current_shot = manager.list(render_queue.shots[0])
+        status = QueueStatus.create(manager)
 
         children = []
-        children.append(Process(target=render_queue_main, args=(render_queue.state, current_shot)))
-        children.append(Process(target=compositor_queue_main, args=(render_queue.state, current_shot)))
+        children.append(Process(target=render_queue_main, args=(render_queue.state, current_shot, status.state)))
+        children.append(Process(target=denoise_queue_main, args=(render_queue.state, current_shot, status.state)))
+        children.append(Process(target=compositor_queue_main, args=(render_queue.state, current_shot, status.state)))
+        children.append(Process(target=preview_queue_main, args=(render_queue.state, current_shot, status.state)))
+        children.append(Process(target=status_server_main, args=(render_queue.state, current_shot, status.state)))
 
     
         [ c.start() for c in children ]
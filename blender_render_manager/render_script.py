@@ -1,81 +1,212 @@
+"""Render script
+
+Run inside Blender to render one shot, or a session of several shots that
+use the same blend file:
+
+  blender -b <blend file> --python render_script.py -- <shot list> <category> <id> <quality> <slate>
+  blender -b <blend file> --python render_script.py -- <shot list> SESSION <quality> <category>/<id>/<slate> ...
+
+Either can be followed by KEY=VALUE arguments, which override the shot info
+of the shot(s); VALUE is JSON if it parses as JSON, otherwise a string. e.g.
+"tile=[3,4,2]" renders tile 3 of a 4x2 grid (see tile_stitcher.py).
+
+In a session, each shot's settings are applied to the scene, the shot is
+rendered and then the settings are put back as they were before the next
+shot is set up. Persistent data is turned on, so Cycles keeps the BVH, the
+textures etc. from one shot to the next, rather than rebuilding them from
+scratch for every shot. Shots that run scripts, or use the Nuke workflow,
+change the file in ways that we can't undo, so they can't be rendered in a
+session; see render_manager.get_session_key().
+
+"""
 import bpy
 import mathutils
 import sys
 import copy
+import json
 import os
 import re
 
 
+class ShotOverrides:
+    """Record the changes that we make to the blend file for a shot, so that
+    they can be undone again before the next shot of a session.
+    """
+    def __init__(self):
+        self._undo = []
+
+    def set(self, obj, attribute_name, value):
+        """setattr(obj, attribute_name, value), remembering the old value"""
+        old_value = getattr(obj, attribute_name)
+        # Copy things like colors and vectors, which are references into Blender's data.
+        if isinstance(old_value, (mathutils.Vector, mathutils.Color, mathutils.Euler, mathutils.Quaternion, mathutils.Matrix)):
+            old_value = old_value.copy()
+        elif type(old_value).__name__ == "bpy_prop_array":
+            old_value = tuple(old_value)
+        self._undo.append(lambda: setattr(obj, attribute_name, old_value))
+        setattr(obj, attribute_name, value)
+
+    def on_revert(self, fn):
+        """Call 'fn' to undo a change that isn't just setting an attribute; e.g. adding a node"""
+        self._undo.append(fn)
+
+    def revert(self):
+        """Undo the changes, in the opposite order to that in which they were made"""
+        while self._undo:
+            self._undo.pop()()
+
+
+#
+# Render passes
+#
+# The "render_passes" section of the shot info enables passes and says how to
+# write them; e.g.
+#
+#    "render_passes": {
+#        "z": true,
+#        "vector": true,
+#        "denoise_data": true,
+#        "output_mode": "MULTILAYER",
+#        "pass_settings": {"vector": {"color_depth": "16", "exr_codec": "ZIP"}}
+#    }
+#
+# "output_mode" SEPARATE (the default) writes each pass as its own image
+# sequence in passes/<pass>/<pass>_####.exr. MULTILAYER writes the passes into
+# multilayer EXRs instead; one file per frame for each combination of bit
+# depth and codec, e.g. passes/float_zip_####.exr, which cuts down the number
+# of files a lot. Either way, each pass is written with the bit depth and
+# codec of its policy (DEFAULT_RENDER_PASS_SETTINGS, or "pass_settings").
+#
+# Passes are written for every view layer being rendered; with more than one,
+# each view layer gets its own directory under passes/.
+#
+
+# (flag in the shot info, view layer setting to enable, [(pass name, Render Layers outputs)])
+RENDER_PASSES = [
+    ("mist",         ("", "use_pass_mist"),                  [("mist", ["Mist"])]),
+    ("z",            ("", "use_pass_z"),                     [("z", ["Depth", "Z"])]),
+    ("position",     ("", "use_pass_position"),              [("position", ["Position"])]),
+    ("normal",       ("", "use_pass_normal"),                [("normal", ["Normal"])]),
+    ("vector",       ("", "use_pass_vector"),                [("vector", ["Vector"])]),
+    ("uv",           ("", "use_pass_uv"),                    [("uv", ["UV"])]),
+    ("denoise_data", ("cycles", "denoising_store_passes"),   [("denoise_albedo", ["Denoising Albedo"]),
+                                                              ("denoise_normal", ["Denoising Normal"]),
+                                                              ("denoise_depth", ["Denoising Depth"])]),
+]
+
+# Data passes must not be written with a lossy codec; the ones that hold
+# positions or distances need full float precision.
+DEFAULT_RENDER_PASS_SETTINGS = {
+    "mist":           {"color_depth": "16", "exr_codec": "ZIP"},
+    "z":              {"color_depth": "32", "exr_codec": "ZIP"},
+    "position":       {"color_depth": "32", "exr_codec": "ZIP"},
+    "normal":         {"color_depth": "16", "exr_codec": "ZIP"},
+    "vector":         {"color_depth": "32", "exr_codec": "ZIP"},
+    "uv":             {"color_depth": "32", "exr_codec": "ZIP"},
+    "denoise_albedo": {"color_depth": "16", "exr_codec": "ZIP"},
+    "denoise_normal": {"color_depth": "16", "exr_codec": "ZIP"},
+    "denoise_depth":  {"color_depth": "32", "exr_codec": "ZIP"},
+}
+
+def get_render_pass_settings(render_passes_db, pass_name):
+    settings = dict(DEFAULT_RENDER_PASS_SETTINGS.get(pass_name, {"color_depth": "32", "exr_codec": "ZIP"}))
+    settings.update(render_passes_db.get("pass_settings", {}).get(pass_name, {}))
+    return settings
+
+def get_render_layers_node(scene, view_layer, overrides):
+    """Find the Render Layers node of 'view_layer'; adding one if there isn't one"""
+    for node in scene.node_tree.nodes:
+        if node.type == 'R_LAYERS' and node.scene in [None, scene] and node.layer == view_layer.name:
+            return node
+
+    node = scene.node_tree.nodes.new(type="CompositorNodeRLayers")
+    node.scene = scene
+    node.layer = view_layer.name
+    overrides.on_revert(lambda: scene.node_tree.nodes.remove(node))
+    return node
+
 #
-# Add a File Output node to the compositor which writes the requested render passes
+# Add File Output nodes to the compositor which write the requested render passes
 #
-def configure_render_passes(scene, render_passes_db, render_output_path):
-    view_layer = scene.view_layers[0] # XXX Need to think about files with multiple scenes/view layers!!!
+def configure_render_passes(scene, render_passes_db, render_output_path, overrides):
+    output_mode = render_passes_db.get("output_mode", "SEPARATE").upper()
+    if output_mode not in ["SEPARATE", "MULTILAYER"]:
+        raise ValueError("Unknown render pass output mode \"%s\"" % output_mode)
 
     # Make sure the compositor is "using nodes"
-    scene.use_nodes = True
+    overrides.set(scene, "use_nodes", True)
+
+    view_layers = [ vl for vl in scene.view_layers if vl.use ]
+
+    for view_layer in view_layers:
+        render_layers_node = get_render_layers_node(scene, view_layer, overrides)
+        passes_dir = get_render_passes_dir(render_output_path, view_layer.name if len(view_layers) > 1 else None)
+
+        # Enable the passes on the view layer, and collect the outputs of the
+        # Render Layers node to write.
+        outputs = []
+        for (db_prop_name, (settings_path, view_layer_prop_name), pass_outputs) in RENDER_PASSES:
+            if not render_passes_db.get(db_prop_name, False):
+                continue
+
+            overrides.set(view_layer.path_resolve(settings_path) if settings_path else view_layer, view_layer_prop_name, True)
+
+            for (pass_name, output_names) in pass_outputs:
+                output = next((render_layers_node.outputs[name] for name in output_names if name in render_layers_node.outputs), None)
+                if output is None:
+                    print("WARNING: Render Layers node has no output for pass \"%s\"; skipped" % pass_name)
+                else:
+                    outputs.append((pass_name, output))
+
+        # Group the passes into File Output nodes. In SEPARATE mode one node
+        # does them all, with its own format for each slot; in MULTILAYER mode
+        # all the slots of a node share the node's format, so we need a node
+        # for each different format.
+        groups = {}
+        for (pass_name, output) in outputs:
+            settings = get_render_pass_settings(render_passes_db, pass_name)
+            if output_mode == "MULTILAYER":
+                group_key = (settings["color_depth"], settings["exr_codec"])
+            else:
+                group_key = None
+            groups.setdefault(group_key, []).append((pass_name, output, settings))
+
+        for (i, (group_key, group_outputs)) in enumerate(groups.items()):
+            output_node = scene.node_tree.nodes.new(type="CompositorNodeOutputFile")
+            overrides.on_revert(lambda output_node = output_node: scene.node_tree.nodes.remove(output_node))
+
+            # Move "File Output" node to be not too far from the Render Layers node
+            output_node.location = render_layers_node.location + mathutils.Vector((render_layers_node.width + 100, -500 - 300 * i))
+
+            output_node.format.file_format = "OPEN_EXR_MULTILAYER" if output_mode == "MULTILAYER" else "OPEN_EXR"
+            if group_key is not None:
+                (color_depth, exr_codec) = group_key
+                output_node.format.color_depth = color_depth
+                output_node.format.exr_codec = exr_codec
+                output_node.base_path = os.path.join(passes_dir, ("half" if color_depth == "16" else "float") + "_" + exr_codec.lower() + "_")
+            else:
+                output_node.base_path = passes_dir + "/"
 
-    # Setup a File Output node
-    #
-    output_node = scene.node_tree.nodes.new(type="CompositorNodeOutputFile")
-    output_node.base_path = render_output_path + "/passes/"
-
-    # This is how to set the output path of the first input, but we ignore it for the
-    # sake of keeping the code more homogeneous.
-    #bpy.data.scenes["Scene"].node_tree.nodes["File Output"].file_slots[0].path = "mist/mist_"
-
-    # Get the "Render Layers" node
-    render_layers_node = scene.node_tree.nodes["Render Layers"]
-
-    # Move "File Output" node to be not too far from the Render Layers node
-    output_node.location = render_layers_node.location + mathutils.Vector((render_layers_node.width + 100,-500))
-
-    # Helper func to connect the last node of 'output_node' to the given output of 'rl_node'.
-    def connect(rl_output_name):
-        scene.node_tree.links.new(render_layers_node.outputs[rl_output_name], output_node.inputs[-1])
-
-    def optional_connect_render_layer_output(db_prop_name,
-                                             output_subpath,
-                                             view_layer_prop_name,
-                                             render_layer_output_name):
-        """Connect the nodes to output the given render layer, if enabled.
-
-        db_prop_name:   The name of the flag in the JSON file to enable render layer; e.g. "z"
-        output_subpath: relative path in render output directory; e.g. mist/must_
-        view_layer_prop_name:  VL property to set to true to enable this render layer
-        render_layer_output_name: The output of the Render Layers node to conenct to
-
-        """
-        if render_passes_db.get(db_prop_name, False):
-            output_node.file_slots.new(output_subpath)
-            setattr(view_layer, view_layer_prop_name, True)
-            connect(render_layer_output_name)
-
-    #if render_passes_db.get("mist", False):
-    #    output_node.file_slots.new("mist/mist_")
-    #    view_layer.use_pass_mist = True
-    #    connect("Mist")
-
-    optional_connect_render_layer_output("mist", "mist/mist_", "use_pass_mist", "Mist")
-    optional_connect_render_layer_output("z", "z/z_", "use_pass_z", "Mist")
-    optional_connect_render_layer_output("position", "position/position_", "use_pass_position", "Position")
-    optional_connect_render_layer_output("normal", "normal/normal_", "use_pass_normal", "Position")
-    optional_connect_render_layer_output("vector", "vector/vector_", "use_pass_vector", "Vector")
-    optional_connect_render_layer_output("uv", "uv/uv_", "use_pass_uv", "UV")
-
-    # Denoise data is a but different from the other Render Layers.
-    if render_passes_db.get("denoise_data", False):
-        scene.view_layers[0].cycles.denoising_store_passes = True
-
-        output_node.file_slots.new("denoise_albedo/denoise_albedo_")
-        connect("Denoising Albedo")
-        output_node.file_slots.new("denoise_normal/denoise_normal_")
-        connect("Denoising Normal")
-        output_node.file_slots.new("denoise_depth/denoise_depth_")
-        connect("Denoising Depth")
-
-
-def set_material_node_properties(props):
+            # The node comes with an "Image" input, which we don't use.
+            slots = output_node.layer_slots if output_mode == "MULTILAYER" else output_node.file_slots
+            slots.remove(output_node.inputs[0])
+
+            for (pass_name, output, settings) in group_outputs:
+                if output_mode == "MULTILAYER":
+                    slots.new(pass_name)
+                else:
+                    slots.new(pass_name + "/" + pass_name + "_")
+                    slot = slots[-1]
+                    slot.use_node_format = False
+                    slot.format.file_format = "OPEN_EXR"
+                    slot.format.color_mode = "BW" if output.type == 'VALUE' else "RGBA"
+                    slot.format.color_depth = settings["color_depth"]
+                    slot.format.exr_codec = settings["exr_codec"]
+
+                scene.node_tree.links.new(output, output_node.inputs[-1])
+
+
+def set_material_node_properties(props, overrides):
     """ 'props' is a list of arrays of four elements each containing
          [Material name, node name, input name, value]
 
@@ -85,11 +216,354 @@ def set_material_node_properties(props):
     for prop in props:
         try:
             [material_name, node_name, input_name, default_value] = prop
-            bpy.data.materials[material_name].node_tree.nodes[node_name].inputs[input_name].default_value = default_value
+            overrides.set(bpy.data.materials[material_name].node_tree.nodes[node_name].inputs[input_name], "default_value", default_value)
         except ValueError:
             print("ERROR: Invalid material node input specification: " + prop)
 
 
+#
+# Performance profile
+#
+# The "performance_profile" section of the shot info trades quality for speed
+# per quality tier, without editing the blend file. Like "max_cycles_samples",
+# each setting is an array indexed by quality; e.g.
+#
+#    "performance_profile": {
+#        "max_bounces": [4, 8, 12, 12],
+#        "simplify_texture_limit": ["512", "2048", "OFF", "OFF"],
+#        "simplify_subdivision": [1, 2, 6, 6],
+#        "caustics_reflective": [false, false, true, true],
+#        "time_limit": [30, 0, 0, 0]
+#    }
+#
+# A null entry leaves the blend file's setting for that tier; a single value
+# (rather than an array) is used for every tier.
+#
+PERFORMANCE_PROFILE_SETTINGS = {
+    # Light paths
+    "max_bounces":             ("cycles", "max_bounces"),
+    "diffuse_bounces":         ("cycles", "diffuse_bounces"),
+    "glossy_bounces":          ("cycles", "glossy_bounces"),
+    "transmission_bounces":    ("cycles", "transmission_bounces"),
+    "volume_bounces":          ("cycles", "volume_bounces"),
+    "transparent_max_bounces": ("cycles", "transparent_max_bounces"),
+    "caustics_reflective":     ("cycles", "caustics_reflective"),
+    "caustics_refractive":     ("cycles", "caustics_refractive"),
+    "blur_glossy":             ("cycles", "blur_glossy"),
+    "sample_clamp_direct":     ("cycles", "sample_clamp_direct"),
+    "sample_clamp_indirect":   ("cycles", "sample_clamp_indirect"),
+
+    # Sampling
+    "time_limit":              ("cycles", "time_limit"),
+    "adaptive_threshold":      ("cycles", "adaptive_threshold"),
+    "adaptive_min_samples":    ("cycles", "adaptive_min_samples"),
+
+    # Simplify
+    "simplify_texture_limit":  ("cycles", "texture_limit_render"),
+    "simplify_subdivision":    ("render", "simplify_subdivision_render"),
+    "simplify_child_particles":("render", "simplify_child_particles_render"),
+    "simplify_volumes":        ("render", "simplify_volumes"),
+}
+
+def apply_performance_profile(scene, profile, quality_index, overrides):
+    """Apply the settings of a "performance_profile" for the given quality"""
+    use_simplify = False
+
+    for (setting_name, value) in profile.items():
+        try:
+            (settings_group, attribute_name) = PERFORMANCE_PROFILE_SETTINGS[setting_name]
+        except KeyError:
+            print("WARNING: Unknown performance profile setting \"%s\"; ignored" % setting_name)
+            continue
+
+        if isinstance(value, list):
+            value = value[quality_index]
+        if value is None:
+            continue
+
+        overrides.set(getattr(scene, settings_group), attribute_name, value)
+        use_simplify = use_simplify or setting_name.startswith("simplify_")
+
+    # The Simplify settings only count if Simplify is turned on.
+    if use_simplify:
+        overrides.set(scene.render, "use_simplify", True)
+
+
+#
+# Frustum culling
+#
+# Hide objects that are outside the camera's view for the whole shot, so that
+# Cycles doesn't build them into the BVH or upload them to the GPU. Enabled
+# with e.g.
+#
+#    "frustum_culling": {
+#        "margin": 0.1,
+#        "frame_step": 1,
+#        "keep_objects": ["Sun Blocker"],
+#        "keep_collections": ["Bounce Cards"]
+#    }
+#
+# "margin" grows the frame by that fraction of its size on every side, so
+# objects just out of shot, which still show up in reflections, refractions
+# etc. are kept. Objects that matter even though they're out of shot (e.g.
+# they cast shadows or bounce light into it) go in the keep lists; objects in
+# the shot's "indirect_collections" are always kept. The camera is checked
+# every "frame_step" frames; with a step of more than 1, fast moving objects
+# can be culled wrongly.
+#
+# Only geometry is culled; lights, and objects that instance other objects
+# (whose bounds we can't cheaply tell), are always kept.
+#
+FRUSTUM_CULLING_OBJECT_TYPES = {'MESH', 'CURVE', 'SURFACE', 'META', 'FONT', 'VOLUME', 'CURVES', 'POINTCLOUD'}
+
+def find_objects_outside_camera(scene, margin = 0.1, frame_step = 1):
+    """Return the objects which are outside the view of the scene's camera on every frame"""
+    import numpy as np
+
+    depsgraph = bpy.context.evaluated_depsgraph_get()
+    candidates = [ obj for obj in scene.objects
+                   if obj.type in FRUSTUM_CULLING_OBJECT_TYPES
+                      and not obj.hide_render
+                      and obj.instance_type == 'NONE' ]
+    outside = np.ones(len(candidates), dtype = bool)
+
+    # Bounding box corners as homogeneous coordinates; (corner, xyzw)
+    def corners(obj):
+        obj_eval = obj.evaluated_get(depsgraph)
+        local = np.ones((8, 4))
+        local[:, :3] = np.array([ tuple(co) for co in obj_eval.bound_box ])
+        return local @ np.array(obj_eval.matrix_world).T
+
+    frame_current = scene.frame_current
+    try:
+        for frame in list(range(scene.frame_start, scene.frame_end + 1, max(1, frame_step))) + [scene.frame_end]:
+            scene.frame_set(frame)
+            depsgraph = bpy.context.evaluated_depsgraph_get()
+
+            camera = scene.camera.evaluated_get(depsgraph)
+            projection = np.array(camera.calc_matrix_camera(depsgraph,
+                                                            x = scene.render.resolution_x,
+                                                            y = scene.render.resolution_y,
+                                                            scale_x = scene.render.pixel_aspect_x,
+                                                            scale_y = scene.render.pixel_aspect_y))
+            world_to_clip = projection @ np.array(camera.matrix_world.inverted())
+
+            for i in np.flatnonzero(outside):
+                clip = corners(candidates[i]) @ world_to_clip.T
+                w = clip[:, 3]
+
+                # If the box reaches behind the camera, its projection isn't
+                # meaningful; we can only cull it if it's entirely behind.
+                if (w <= 0).any():
+                    outside[i] = (w <= 0).all()
+                    continue
+
+                # Normalised device coordinates, -1..1 across the frame
+                ndc = clip[:, :2] / w[:, np.newaxis]
+                limit = 1.0 + 2.0 * margin
+                outside[i] = ((ndc.max(axis = 0) < -limit) | (ndc.min(axis = 0) > limit)).any()
+    finally:
+        scene.frame_set(frame_current)
+
+    return [ obj for (obj, is_outside) in zip(candidates, outside) if is_outside ]
+
+def cull_objects_outside_camera(scene, culling_db, indirect_collections, overrides):
+    """Hide the objects outside the camera for the whole shot; see above"""
+    keep = set(culling_db.get("keep_objects", []))
+    for collection_name in list(culling_db.get("keep_collections", [])) + list(indirect_collections):
+        keep.update(obj.name for obj in bpy.data.collections[collection_name].all_objects)
+
+    culled = [ obj for obj in find_objects_outside_camera(scene,
+                                                          margin = culling_db.get("margin", 0.1),
+                                                          frame_step = culling_db.get("frame_step", 1))
+               if obj.name not in keep ]
+
+    for obj in culled:
+        overrides.set(obj, "hide_render", True)
+
+    print("Frustum culling: hid %d object(s) outside the camera: %s" % (len(culled), ", ".join(sorted(obj.name for obj in culled))))
+    return culled
+
+
+#
+# Memory budget
+#
+# Estimate how much memory the render will need, before we start it, and
+# compare it with the budget for the rendering device; e.g.
+#
+#    "memory_budget_gb": {"GPU": 10, "CPU": 56},
+#    "memory_fallback": ["SIMPLIFY", "CPU"]
+#
+# If the estimate is over budget, the fallbacks are tried in order:
+#
+#   SIMPLIFY: Turn on Simplify, and lower the texture limit (and then the
+#             subdivision level) until the estimate fits.
+#   CPU:      Render on the CPU instead, if it fits the CPU budget.
+#
+# The estimate is rough: image textures are counted at their full size (or
+# the texture limit), geometry at MEMORY_BYTES_PER_TRIANGLE per triangle,
+# including the BVH, with subdivision surfaces counted at their render level.
+# Hair, volumes and the render buffers aren't counted. It's written to
+# <frames>memory_estimate.json, so that it can be compared with what the
+# render actually used.
+#
+MEMORY_BYTES_PER_TRIANGLE = 120
+TEXTURE_LIMITS = ["8192", "4096", "2048", "1024", "512", "256", "128"]
+
+def find_renderable_images(scene, view_layers):
+    """Images used by the materials of the objects being rendered, and by the world"""
+    images = set()
+    seen_node_trees = set()
+
+    def add_node_tree_images(node_tree):
+        if node_tree is None or node_tree.name in seen_node_trees:
+            return
+        seen_node_trees.add(node_tree.name)
+        for node in node_tree.nodes:
+            if node.type in ['TEX_IMAGE', 'TEX_ENVIRONMENT'] and node.image is not None:
+                images.add(node.image)
+            elif node.type == 'GROUP':
+                add_node_tree_images(node.node_tree)
+
+    # Objects in collections excluded from all the view layers aren't rendered.
+    object_names = set(obj.name for vl in view_layers for obj in vl.objects)
+
+    for obj in scene.objects:
+        if obj.hide_render or obj.name not in object_names:
+            continue
+        for slot in obj.material_slots:
+            if slot.material is not None and slot.material.use_nodes:
+                add_node_tree_images(slot.material.node_tree)
+
+    if scene.world is not None and scene.world.use_nodes:
+        add_node_tree_images(scene.world.node_tree)
+
+    return images
+
+def estimate_texture_bytes(images, texture_limit = None):
+    """Memory of 'images' once loaded by Cycles; 'texture_limit' is e.g. "2048" or None"""
+    total = 0
+    for image in images:
+        (width, height) = image.size
+        if texture_limit is not None:
+            while max(width, height) > int(texture_limit):
+                (width, height) = (width // 2, height // 2)
+        bytes_per_channel = 4 if image.is_float else (2 if image.depth > 32 else 1)
+        total += width * height * max(1, image.channels) * bytes_per_channel
+    return total
+
+def count_render_triangles(scene, subdivision_limit = None):
+    """Triangles of the geometry being rendered, with subdivision at render level
+
+    The depsgraph is evaluated with the viewport subdivision levels, so each
+    level more at render time is counted as four times the triangles.
+    'subdivision_limit' is Simplify's max subdivision.
+    """
+    depsgraph = bpy.context.evaluated_depsgraph_get()
+    triangles = 0
+
+    for obj_eval in depsgraph.objects:
+        if obj_eval.type != 'MESH' or obj_eval.original.hide_render:
+            continue
+
+        triangles_of_obj = sum(len(polygon.vertices) - 2 for polygon in obj_eval.data.polygons)
+
+        for modifier in obj_eval.original.modifiers:
+            if modifier.type in ['SUBSURF', 'MULTIRES'] and modifier.show_render:
+                render_levels = modifier.render_levels
+                if subdivision_limit is not None:
+                    render_levels = min(render_levels, subdivision_limit)
+                viewport_levels = modifier.levels if modifier.show_viewport else 0
+                triangles_of_obj = int(triangles_of_obj * 4 ** (render_levels - viewport_levels))
+
+        triangles += triangles_of_obj
+
+    return triangles
+
+def estimate_render_memory(scene, texture_limit = None, subdivision_limit = None, images = None, triangles = None):
+    view_layers = [ vl for vl in scene.view_layers if vl.use ]
+    if images is None:
+        images = find_renderable_images(scene, view_layers)
+    texture_bytes = estimate_texture_bytes(images, texture_limit)
+    if triangles is None:
+        triangles = count_render_triangles(scene, subdivision_limit)
+    geometry_bytes = triangles * MEMORY_BYTES_PER_TRIANGLE
+
+    return {
+        "textures": len(images),
+        "texture_bytes": texture_bytes,
+        "triangles": triangles,
+        "geometry_bytes": geometry_bytes,
+        "total_bytes": texture_bytes + geometry_bytes,
+        "texture_limit": texture_limit,
+        "subdivision_limit": subdivision_limit,
+    }
+
+def apply_memory_budget(scene, shot_info, estimate_filepath, overrides):
+    """Estimate render memory and fall back to cheaper settings if it's over budget; see above"""
+    budgets = { device: gb * 1024 ** 3 for (device, gb) in shot_info.get("memory_budget_gb", {}).items() }
+    fallbacks = [ fallback.upper() for fallback in shot_info.get("memory_fallback", ["SIMPLIFY", "CPU"]) ]
+    device = scene.cycles.device
+
+    view_layers = [ vl for vl in scene.view_layers if vl.use ]
+    images = find_renderable_images(scene, view_layers)
+
+    current_texture_limit = scene.cycles.texture_limit_render if scene.render.use_simplify else "OFF"
+    current_texture_limit = None if current_texture_limit == "OFF" else current_texture_limit
+    current_subdivision_limit = scene.render.simplify_subdivision_render if scene.render.use_simplify else None
+
+    estimate = estimate_render_memory(scene, current_texture_limit, current_subdivision_limit, images = images)
+    report = {"device": device, "budget_bytes": budgets.get(device), "estimate": estimate, "actions": []}
+
+    def fits(estimate, device):
+        return device not in budgets or estimate["total_bytes"] <= budgets[device]
+
+    if not fits(estimate, device) and "SIMPLIFY" in fallbacks:
+        # Lower the texture limit first, as it's the cheapest in quality; then subdivision.
+        texture_limits = [ limit for limit in TEXTURE_LIMITS
+                           if current_texture_limit is None or int(limit) < int(current_texture_limit) ]
+        triangles = estimate["triangles"]
+        for texture_limit in texture_limits:
+            estimate = estimate_render_memory(scene, texture_limit, current_subdivision_limit, images = images, triangles = triangles)
+            if fits(estimate, device):
+                break
+
+        subdivision_limit = current_subdivision_limit if current_subdivision_limit is not None else 6
+        while not fits(estimate, device) and subdivision_limit > 0:
+            subdivision_limit -= 1
+            estimate = estimate_render_memory(scene, estimate["texture_limit"], subdivision_limit, images = images)
+
+        overrides.set(scene.render, "use_simplify", True)
+        if estimate["texture_limit"] is not None:
+            overrides.set(scene.cycles, "texture_limit_render", estimate["texture_limit"])
+        if estimate["subdivision_limit"] is not None:
+            overrides.set(scene.render, "simplify_subdivision_render", estimate["subdivision_limit"])
+        report["actions"].append({"action": "SIMPLIFY", "estimate": estimate})
+
+    if not fits(estimate, device) and "CPU" in fallbacks and device != "CPU" and fits(estimate, "CPU"):
+        overrides.set(scene.cycles, "device", "CPU")
+        device = "CPU"
+        report["actions"].append({"action": "CPU"})
+
+    report["final_device"] = device
+    report["fits_budget"] = fits(estimate, device)
+
+    print("Memory estimate: %.2f GB (textures %.2f GB, %d triangles) on %s; budget %s%s"
+          % (report["estimate"]["total_bytes"] / 1024 ** 3,
+             report["estimate"]["texture_bytes"] / 1024 ** 3,
+             report["estimate"]["triangles"],
+             report["device"],
+             "none" if report["budget_bytes"] is None else "%.2f GB" % (report["budget_bytes"] / 1024 ** 3),
+             "".join("; " + action["action"] for action in report["actions"])))
+    if not report["fits_budget"]:
+        print("WARNING: Render is still estimated to be over its memory budget")
+
+    os.makedirs(os.path.dirname(estimate_filepath) or ".", exist_ok = True)
+    with open(estimate_filepath, "w") as f:
+        json.dump(report, f, indent = 2)
+
+    return report
+
 
 # Find the directory where this file (render_manager.py) resides
 # NOTE: This will break if os.chdir() is called before this line runs
@@ -98,7 +572,11 @@ render_script_py_path = os.path.dirname(os.path.realpath(__file__))
 # Append this directory to path, so that we can find "shot_list_db.py"
 sys.path.append(render_script_py_path)
 
+# ... and the addon, for the Nuke export node setup (see "nuke_aov_profile").
+blender_addon_path = os.path.join(os.path.dirname(render_script_py_path), "blender_addon")
+
 import shot_list_db
+import render_timings
 from common import *
 
 #def parse_resolution_string(resolution_string):
@@ -132,315 +610,607 @@ from common import *
 #        for candidate in os.listdir(path):
 #            m = pattern.fullmatch(candidate)
 #            if m:
-#                index = int(m.group(1)) 
+#                index = int(m.group(1))
 #                if index > max_index:
 #                    max_index = index
 #
 #        return max_index + 1
 #    except FileNotFoundError:
-#        # If os.listdir() failed, because the render output directory doesn't 
+#        # If os.listdir() failed, because the render output directory doesn't
 #        # exist, then this is the first render, so the slate number is 1.
 #        return 1
 
 
+def setup_shot(shot_list_db, shot_category, shot_id, quality, slate_number, overrides, timer, shot_info_overrides = None):
+    """Apply the settings of a shot to its scene. Returns the scene and the shot info
 
+    Every change goes through 'overrides', so that it can be undone.
+    shot_info_overrides: Replace these keys of the shot info.
+    """
+    # Index into lists in shot list file.
+    # - Parameters which are difference for low/medium/high quality renders are
+    #   given as arrays of three values; e.g.
+    #
+    #    "max_cycles_samples": [128, 1024, 4096],
+    #
+    quality_index = get_quality_index(quality)
 
+    # Look up the shot using category + ID. Work on a copy; the next shot of a
+    # session may read the same entry of the shot list.
+    shot_info = dict(shot_list_db.get_shot_info(shot_category, shot_id), **(shot_info_overrides or {}))
 
-# Parse command line
-#
-argv = sys.argv
-argv = argv[argv.index("--") + 1:]  # get all args after "--"
+    # Output job details
+    s = ("Rendering shot: %s/%s" % (shot_category, shot_id))
+    print(s)
+    print("=" * len(s))
+    width = max([ len(x) for x in shot_info.keys()])
+    for key, value in shot_info.items():
+        print(key + ":", (width - len(key)) * ".",value)
+    print()
 
-# Don' guess the slate number
-#if len(argv) == 4:
-#    [shot_list_db_filepath, shot_category, shot_id, quality] = argv
-#    slate_number = None
-if len(argv) == 5:
-    [shot_list_db_filepath, shot_category, shot_id, quality, slate_number ] = argv
-else:
-    raise ValueError("Not enough command line parameters supplied to render_script.py")
+    timer.info.update({"category": shot_category, "id": shot_id, "quality": quality, "slate": slate_number,
+                       "blend_file": bpy.data.filepath})
 
-# Index into lists in shot list file.
-# - Parameters which are difference for low/medium/high quality renders are
-#   given as arrays of three values; e.g.
-#
-#    "max_cycles_samples": [128, 1024, 4096], 
-#
-quality_index = get_quality_index(quality)
+    timer.mark("scene_settings")
 
-shot_list_db = shot_list_db.ShotListDb.from_file(shot_list_db_filepath)
+    # Get the scene name from the shot info, but default to the first scene.
+    scene_name = shot_info.get("scene", bpy.data.scenes[0].name)
+    scene = bpy.data.scenes[scene_name]
 
-# Look up the shot using category + ID.
-shot_info = shot_list_db.get_shot_info(shot_category, shot_id)
-
-# Output job details
-s = ("Rendering shot: %s/%s" % (shot_category, shot_id))
-print(s)
-print("=" * len(s))
-width = max([ len(x) for x in shot_info.keys()])
-for key, value in shot_info.items():
-    print(key + ":", (width - len(key)) * ".",value)
-print()
-
-# Get the scene name from the shot info, but default to the first scene.
-scene_name = shot_info.get("scene", bpy.data.scenes[0].name)
-scene = bpy.data.scenes[scene_name]
-
-scene.camera = bpy.data.objects[shot_info["camera"]]
-
-# Frame start and end defaults to whatever is in the Blender file
-if "frame_start" in shot_info:
-    scene.frame_start = shot_info["frame_start"]
-if "frame_end" in shot_info:
-    scene.frame_end = shot_info["frame_end"]
-    
-scene.render.film_transparent = parse_boolean(shot_info.get("film_transparent", False)) 
-scene.render.fps = shot_info.get("fps", 25) 
-scene.render.use_motion_blur = parse_boolean(shot_info.get("use_motion_blur", True))
-
-
-# Output settings
-set_render_resolution(scene, shot_info, quality)
-scene.render.image_settings.file_format = shot_info.get("render_file_format", "PNG")
-scene.render.image_settings.color_mode = shot_info.get("render_color_mode", 'RGBA')
-scene.render.image_settings.color_depth = shot_info.get("render_color_depth", "16")
-scene.render.image_settings.exr_codec = shot_info.get("render_exr_codec", "DWAA")
-scene.render.use_overwrite = False
-scene.render.use_placeholder = False
-
-# Use output path override given in the shot list, if given. Otherwise, fallback on eg. Renders/Title/slate_3/...
-if shot_info.get("output_filepath_override"):
-    render_filepath = shot_info.get("output_filepath_override")
-    scene.render.filepath = render_filepath
-else:
-    # Backwards compatble with files that use 'title' instead of 'shot_name'
-    shot_name = shot_info.get("shot_name")
-    if not shot_name:
-        shot_name = shot_info["title"]
+    overrides.set(scene, "camera", bpy.data.objects[shot_info["camera"]])
 
-    output_path_base =  os.path.join(shot_list_db.render_root, shot_name)
+    # Frame start and end defaults to whatever is in the Blender file
+    if "frame_start" in shot_info:
+        overrides.set(scene, "frame_start", shot_info["frame_start"])
+    if "frame_end" in shot_info:
+        overrides.set(scene, "frame_end", shot_info["frame_end"])
 
+    overrides.set(scene.render, "film_transparent", parse_boolean(shot_info.get("film_transparent", False)))
+    overrides.set(scene.render, "fps", shot_info.get("fps", 25))
+    overrides.set(scene.render, "use_motion_blur", parse_boolean(shot_info.get("use_motion_blur", True)))
 
-#    if slate_number is None:
-#        slate_number = find_next_slate_number(output_path_base)
 
+    # Output settings
+    for attribute_name in ["resolution_percentage", "resolution_x", "resolution_y"]:
+        overrides.set(scene.render, attribute_name, getattr(scene.render, attribute_name))
+    set_render_resolution(scene, shot_info, quality)
+    overrides.set(scene.render.image_settings, "file_format", shot_info.get("render_file_format", "PNG"))
+    overrides.set(scene.render.image_settings, "color_mode", shot_info.get("render_color_mode", 'RGBA'))
+    overrides.set(scene.render.image_settings, "color_depth", shot_info.get("render_color_depth", "16"))
+    overrides.set(scene.render.image_settings, "exr_codec", shot_info.get("render_exr_codec", "DWAA"))
+    overrides.set(scene.render, "use_overwrite", False)
+    overrides.set(scene.render, "use_placeholder", False)
 
-    filename =  shot_category + "_" + shot_id + "_" + slate_number + "_"
-    render_filepath = os.path.join(output_path_base, "slate_%s/" % str(slate_number)) + filename 
-    scene.render.filepath = render_filepath
+    # Use output path override given in the shot list, if given. Otherwise, fallback on eg. Renders/Title/slate_3/...
+    render_filepath = get_render_filestub(shot_list_db, shot_info, shot_category, shot_id, slate_number)
+    overrides.set(scene.render, "filepath", render_filepath)
 
 
-# Map EEVEE -> BLENDER_EEVEE and WORKBENCH -> BLENDER_WORKBENCH. Otherwise, use whatever was specified in the shot list.
-render_engine = shot_info.get("render_engine", "CYCLES")
-scene.render.engine = {"EEVEE": "BLENDER_EEVEE", "WORKBENCH": "BLENDER_WORKBENCH"}.get(render_engine, render_engine)
-
-# Cycles settings
-scene.cycles.samples = shot_info.get("max_cycles_samples", [256, 1024, 1024, 4096])[quality_index] 
-scene.cycles.use_adaptive_sampling = shot_info.get("use_adaptive_sampling", [True, True, False, False])[quality_index] 
-scene.cycles.use_denoising = parse_boolean(shot_info.get("use_denoising", False))
-scene.cycles.device = shot_info.get("rendering_device", 'GPU') 
-scene.cycles.use_animated_seed = shot_info.get("use_animated_seed", False) 
-
-# If we're using Cycles; setup compositor to output render passes
-render_passes_db = shot_info.get("render_passes")
-if render_passes_db is not None and render_engine == "CYCLES":
-    render_dir = os.path.dirname(render_filepath)
-    configure_render_passes(scene, render_passes_db, render_dir)
-
-
-# Render region
-#
-render_region = shot_info.get("render_region")
-if render_region:
-    scene.render.use_border = True
-    scene.render.border_min_x = render_region[0]
-    scene.render.border_max_x = render_region[1]
-    scene.render.border_min_y = render_region[2]
-    scene.render.border_max_y = render_region[3]
-
-# XXX We haven't thought about how rendering out render passes is going to work with 
-# multiple render later (see below). Probably, we should duplicate the Render Layers
-# node and File Output node for every view layer. We'd have to think about how
-# to set render_filepath as well.
-
-# Enable denoise data, vector and mist passes for all render layers.
-#if shot_info.get("enable_all_layers", False):
-#    for layer_name in bpy.context.scene.view_layers.keys():
-#        bpy.context.scene.view_layers[layer_name].cycles.denoising_store_passes = True
-#        bpy.context.scene.view_layers[layer_name].use_pass_vector = True
-#        bpy.context.scene.view_layers[layer_name].use_pass_mist = True
-#        bpy.context.scene.view_layers[layer_name].use_pass_z = True
-
-
-# Object to hide in render
-objects_to_hide = shot_info.get("objects_to_hide", [])
-for obj_name in objects_to_hide:
-    bpy.data.objects[obj_name].hide_render = True
-
-# Collections to hide in render
-collections_to_hide = shot_info.get("collections_to_hide", [])
-for collection_name in collections_to_hide:
-    bpy.data.collections[collection_name].hide_render = True
-
-# Object to unhide in render
-objects_to_hide = shot_info.get("objects_to_unhide", [])
-for obj_name in objects_to_hide:
-    bpy.data.objects[obj_name].hide_render = False
-
-# Collections to unhide in render
-collections_to_hide = shot_info.get("collections_to_unhide", [])
-for collection_name in collections_to_hide:
-    bpy.data.collections[collection_name].hide_render = False
-
-
-# Collections to set as "indirect only"
-indirect_collections = shot_info.get("indirect_collections", [])
-for collection_name in indirect_collections:
-    # XXX I think this only works for top-level collections; needs to extend this so that config file
-    # takes full path in the tree to the collection.
-    view_layer = scene.view_layers[0]
-    view_layer.layer_collection.children["Collection"]
-    layer_collection = view_layer.layer_collection.children[collection_name]
-    view_layer.active_layer_collection = layer_collection
-    view_layer.active_layer_collection.indirect_only = True
-
-# Mute/unmute compositor nodes
-#
-for node_name in shot_info.get("compositor_nodes_to_mute", []):
-    scene.node_tree.nodes[node_name].mute = True
-
-for node_name in shot_info.get("compositor_nodes_to_unmute", []):
-    scene.node_tree.nodes[node_name].mute = False
-
-# Mute/unmute world-shader nodes
-#
-for node_name in shot_info.get("world_shader_nodes_to_mute", []):
-    scene.world.node_tree.nodes[node_name].mute = True
-
-for node_name in shot_info.get("world_shader_nodes_to_unmute", []):
-    scene.world.node_tree.nodes[node_name].mute = False
-
-# Set compositor node attributues
-for node_name, node_attribute_name, node_attribute_value in shot_info.get("set_compositor_node_attributes", []):
-    # Replace any vars in the attribute values
-    node_attribute_value_replaced = node_attribute_value.replace("$RENDER_DIR", os.path.dirname(render_filepath))
-    
-    setattr(scene.node_tree.nodes[node_name], node_attribute_name, node_attribute_value_replaced)
-
-# If the shot specified a list of view layers, then enable only those specified.
-view_layers = shot_info.get("view_layers", [])
-if view_layers:
-    for vl in scene.view_layers:
-        vl.use = False 
-    for vl_name in view_layers:
-        scene.view_layers[vl_name].use = True
-
-##########################################################
-##########################################################
-## Nuke workflow
-##########################################################
-##########################################################
-# XXX Should share code here with the addon.
-if shot_info.get("use_nuke_workflow", False):
-
-    # Use the same logic as the Nuke Export 
-    # Panel to set the render filepath and enable the File Output nodes before
-    # rendering
-    try:
-        render_directory = scene.render_directory
-    except AttributeError:
-        print("Couldn't get render directroy; is addon installed?")
-        exit()
+    # Map EEVEE -> BLENDER_EEVEE and WORKBENCH -> BLENDER_WORKBENCH. Otherwise, use whatever was specified in the shot list.
+    render_engine = shot_info.get("render_engine", "CYCLES")
+    overrides.set(scene.render, "engine", {"EEVEE": "BLENDER_EEVEE", "WORKBENCH": "BLENDER_WORKBENCH"}.get(render_engine, render_engine))
 
-    # Update the default Blender output path based on our settings.
-    #
-    scene.render.filepath = os.path.join(render_directory, 
-                                         shot_info["shot_name"],
-                                         ("slate %s" % slate_number),
-                                          shot_info["shot_name"].replace("_","") + "_s" + str(slate_number) + "_"
-                                         )
-
-    # We capture to proceeding '/' or '\' and reproduce it in the replacement
-    # string to, anally, avoid changing anything.
-    def repl(m):
-        path_sep = m.group(1)
-        path_sep_end = m.group(2)
-        return (path_sep + "slate %d" + path_sep_end) % slate_number
-
-    # set the base path for all file output nodes to filename:
-    for node in scene.node_tree.nodes:
-        if node.type == 'OUTPUT_FILE':
-            nuke_view_layer_name = node.get("nuke_view_layer_name")
-            nuke_node_type = node.get("nuke_node_type")
-
-            # If we have one but not the other of the custom attributes, then it's a mistake.
-            # If we have neither, then we assume this node is not releated to the Nuke export.
-            if not nuke_view_layer_name ^ nuke_node_type:
-                raise AttributeError("Nuke export File output node not correctly setup.")
-
-            if nuke_view_layer_name:                
-                node.base_path = os.path.join(render_directory, 
-                                              shot_info["shot_name"], 
-                                              "slate %s" % slate_number, 
-                                              nuke_view_layer_name.lower(), 
-                                              shot_info["shot_name"] + "_" + 
-                                              nuke_view_layer_name.lower() + "_" + 
-                                              ("" if nuke_node_type == "image" else (nuke_node_type + "_")) + 
-                                              ("s%s"%slate_number) + "_"
-                                              )
-
-                # Enable node
-                node.mute = False
-            else:
-                # Disable any File Output nodes that weren't created by the addon.
-                node.mute = True
+    # Cycles settings
+    overrides.set(scene.cycles, "samples", shot_info.get("max_cycles_samples", [256, 1024, 1024, 4096])[quality_index])
+    overrides.set(scene.cycles, "use_adaptive_sampling", shot_info.get("use_adaptive_sampling", [True, True, False, False])[quality_index])
+    # With the separate denoise stage (see denoise_script.py), the frames are left
+    # noisy and the denoise passes stored for it instead.
+    denoise_enabled = parse_boolean(shot_info.get("denoise_enabled", False))
+    overrides.set(scene.cycles, "use_denoising", parse_boolean(shot_info.get("use_denoising", False)) and not denoise_enabled)
+    overrides.set(scene.cycles, "device", shot_info.get("rendering_device", 'GPU'))
+    overrides.set(scene.cycles, "use_animated_seed", shot_info.get("use_animated_seed", False))
 
-    # Set the preview output directory (overrides anything set above)
-    scene.render.filepath = os.path.join(render_directory, 
-                                         shot_info["shot_name"], 
-                                         "slate %s" % slate_number, 
-                                         shot_info["shot_name"] + "_" + nuke_view_layer_name.lower() + "_" + ("s%s"%slate_number)
-                                        )
+    apply_performance_profile(scene, shot_info.get("performance_profile", {}), quality_index, overrides)
 
-    # Set preview file format (we smaller the better as this is jsut a preview and to act as placeholders)
-    scene.render.image_settings.file_format = "JPEG"
-    scene.render.image_settings.color_mode = "RGB"
-    scene.render.image_settings.color_depth = "8"
 
+    # Render region
+    #
+    render_region = shot_info.get("render_region")
+    if render_region:
+        overrides.set(scene.render, "use_border", True)
+        overrides.set(scene.render, "border_min_x", render_region[0])
+        overrides.set(scene.render, "border_max_x", render_region[1])
+        overrides.set(scene.render, "border_min_y", render_region[2])
+        overrides.set(scene.render, "border_max_y", render_region[3])
+
+    # One tile of a tiled render; [tile index, columns, rows]. The tile isn't
+    # cropped, so that all the tiles are the same size; tile_stitcher.py
+    # puts them together.
+    tile = shot_info.get("tile")
+    if tile:
+        (tile_index, columns, rows) = tile
+        (min_x, max_x, min_y, max_y) = get_tile_border(tile_index, columns, rows)
+        overrides.set(scene.render, "use_border", True)
+        overrides.set(scene.render, "use_crop_to_border", False)
+        overrides.set(scene.render, "border_min_x", min_x)
+        overrides.set(scene.render, "border_max_x", max_x)
+        overrides.set(scene.render, "border_min_y", min_y)
+        overrides.set(scene.render, "border_max_y", max_y)
+
+        render_filepath = get_tile_filestub(render_filepath, tile_index)
+        overrides.set(scene.render, "filepath", render_filepath)
+
+    # Enable denoise data, vector and mist passes for all render layers.
+    #if shot_info.get("enable_all_layers", False):
+    #    for layer_name in bpy.context.scene.view_layers.keys():
+    #        bpy.context.scene.view_layers[layer_name].cycles.denoising_store_passes = True
+    #        bpy.context.scene.view_layers[layer_name].use_pass_vector = True
+    #        bpy.context.scene.view_layers[layer_name].use_pass_mist = True
+    #        bpy.context.scene.view_layers[layer_name].use_pass_z = True
+
+
+    # Object to hide in render
+    timer.mark("visibility")
+    objects_to_hide = shot_info.get("objects_to_hide", [])
+    for obj_name in objects_to_hide:
+        overrides.set(bpy.data.objects[obj_name], "hide_render", True)
+
+    # Collections to hide in render
+    collections_to_hide = shot_info.get("collections_to_hide", [])
+    for collection_name in collections_to_hide:
+        overrides.set(bpy.data.collections[collection_name], "hide_render", True)
+
+    # Object to unhide in render
+    objects_to_hide = shot_info.get("objects_to_unhide", [])
+    for obj_name in objects_to_hide:
+        overrides.set(bpy.data.objects[obj_name], "hide_render", False)
+
+    # Collections to unhide in render
+    collections_to_hide = shot_info.get("collections_to_unhide", [])
+    for collection_name in collections_to_hide:
+        overrides.set(bpy.data.collections[collection_name], "hide_render", False)
+
+
+    # Collections to set as "indirect only"
+    indirect_collections = shot_info.get("indirect_collections", [])
+    for collection_name in indirect_collections:
+        # XXX I think this only works for top-level collections; needs to extend this so that config file
+        # takes full path in the tree to the collection.
+        view_layer = scene.view_layers[0]
+        layer_collection = view_layer.layer_collection.children[collection_name]
+        overrides.set(layer_collection, "indirect_only", True)
+
+    # Hide whatever the camera can't see
+    culling_db = shot_info.get("frustum_culling")
+    if culling_db:
+        timer.mark("frustum_culling")
+        cull_objects_outside_camera(scene, culling_db if isinstance(culling_db, dict) else {}, indirect_collections, overrides)
+
+    # Mute/unmute compositor nodes
+    #
+    timer.mark("node_overrides")
+    for node_name in shot_info.get("compositor_nodes_to_mute", []):
+        overrides.set(scene.node_tree.nodes[node_name], "mute", True)
 
+    for node_name in shot_info.get("compositor_nodes_to_unmute", []):
+        overrides.set(scene.node_tree.nodes[node_name], "mute", False)
+
+    # Mute/unmute world-shader nodes
+    #
+    for node_name in shot_info.get("world_shader_nodes_to_mute", []):
+        overrides.set(scene.world.node_tree.nodes[node_name], "mute", True)
+
+    for node_name in shot_info.get("world_shader_nodes_to_unmute", []):
+        overrides.set(scene.world.node_tree.nodes[node_name], "mute", False)
+
+    # Set compositor node attributues
+    for node_name, node_attribute_name, node_attribute_value in shot_info.get("set_compositor_node_attributes", []):
+        # Replace any vars in the attribute values
+        node_attribute_value_replaced = node_attribute_value.replace("$RENDER_DIR", os.path.dirname(render_filepath))
+
+        overrides.set(scene.node_tree.nodes[node_name], node_attribute_name, node_attribute_value_replaced)
+
+    # If the shot specified a list of view layers, then enable only those specified.
+    timer.mark("view_layers")
+    view_layers = shot_info.get("view_layers", [])
+    if view_layers:
+        for vl in scene.view_layers:
+            overrides.set(vl, "use", vl.name in view_layers)
+
+    # If we're using Cycles; setup compositor to output render passes of the
+    # view layers enabled above.
+    timer.mark("render_passes")
+    render_passes_db = shot_info.get("render_passes")
+    if denoise_enabled:
+        render_passes_db = dict(render_passes_db or {}, denoise_data = True)
+        if render_passes_db.get("output_mode", "SEPARATE").upper() != "SEPARATE":
+            print("WARNING: The denoise stage needs the denoise passes in SEPARATE output mode")
+    if render_passes_db is not None and render_engine == "CYCLES":
+        render_dir = os.path.dirname(render_filepath)
+        configure_render_passes(scene, render_passes_db, render_dir, overrides)
+
+    ##########################################################
+    ##########################################################
+    ## Nuke workflow
+    ##########################################################
+    ##########################################################
+    # XXX Should share code here with the addon.
+    timer.mark("nuke_workflow")
+    if shot_info.get("use_nuke_workflow", False):
+
+        # Use the same logic as the Nuke Export
+        # Panel to set the render filepath and enable the File Output nodes before
+        # rendering
+        try:
+            render_directory = scene.render_directory
+        except AttributeError:
+            print("Couldn't get render directroy; is addon installed?")
+            exit()
+
+        # Export the AOVs of the shot's profile, with the shot's EXR policy, rather than the blend file's.
+        if "nuke_aov_profile" in shot_info or "nuke_exr_policy" in shot_info:
+            if blender_addon_path not in sys.path:
+                sys.path.append(blender_addon_path)
+            import create_nuke_export_nodes
+
+            # Through 'overrides', so that the next shot of a session gets the blend
+            # file's setup back; and leaving on the passes written above.
+            keep_passes = [ view_layer_prop_name for (db_prop_name, (_, view_layer_prop_name), _) in RENDER_PASSES
+                            if (render_passes_db or {}).get(db_prop_name, False) ]
+            view_layer_names = create_nuke_export_nodes.apply_nuke_export_settings(scene,
+                                                                                  shot_info.get("nuke_aov_profile"),
+                                                                                  shot_info.get("nuke_exr_policy"),
+                                                                                  keep_passes = keep_passes,
+                                                                                  overrides = overrides)
+            print("Applied AOV profile %s and EXR policy %s to view layers: %s" % (
+                      shot_info.get("nuke_aov_profile", "(blend file's)"),
+                      shot_info.get("nuke_exr_policy", "(blend file's)"),
+                      ", ".join(view_layer_names)))
+
+        # Update the default Blender output path based on our settings.
+        #
+        overrides.set(scene.render, "filepath", os.path.join(render_directory,
+                                                             shot_info["shot_name"],
+                                                             ("slate %s" % slate_number),
+                                                             shot_info["shot_name"].replace("_","") + "_s" + str(slate_number) + "_"
+                                                            ))
+
+        # We capture to proceeding '/' or '\' and reproduce it in the replacement
+        # string to, anally, avoid changing anything.
+        def repl(m):
+            path_sep = m.group(1)
+            path_sep_end = m.group(2)
+            return (path_sep + "slate %d" + path_sep_end) % slate_number
+
+        # set the base path for all file output nodes to filename:
+        preview_view_layer_name = None
+        for node in scene.node_tree.nodes:
+            if node.type == 'OUTPUT_FILE':
+                nuke_view_layer_name = node.get("nuke_view_layer_name")
+                nuke_node_type = node.get("nuke_node_type")
+
+                # If we have one but not the other of the custom attributes, then it's a mistake.
+                # If we have neither, then we assume this node is not releated to the Nuke export.
+                if bool(nuke_view_layer_name) != bool(nuke_node_type):
+                    raise AttributeError("Nuke export File output node not correctly setup.")
+
+                if nuke_view_layer_name:
+                    overrides.set(node, "base_path", os.path.join(render_directory,
+                                                                  shot_info["shot_name"],
+                                                                  "slate %s" % slate_number,
+                                                                  nuke_view_layer_name.lower(),
+                                                                  shot_info["shot_name"] + "_" +
+                                                                  nuke_view_layer_name.lower() + "_" +
+                                                                  ("" if nuke_node_type == "image" else (nuke_node_type + "_")) +
+                                                                  ("s%s"%slate_number) + "_"
+                                                                 ))
+
+                    # Enable node
+                    overrides.set(node, "mute", False)
+                    preview_view_layer_name = preview_view_layer_name or nuke_view_layer_name
+                else:
+                    # Disable any File Output nodes that weren't created by the addon.
+                    overrides.set(node, "mute", True)
+
+        # Set the preview output directory (overrides anything set above); named
+        # after the first view layer exported, not whichever node came last.
+        if preview_view_layer_name:
+            overrides.set(scene.render, "filepath", os.path.join(render_directory,
+                                                                 shot_info["shot_name"],
+                                                                 "slate %s" % slate_number,
+                                                                 shot_info["shot_name"] + "_" + preview_view_layer_name.lower() + "_" + ("s%s"%slate_number)
+                                                                ))
+
+        # Set preview file format (we smaller the better as this is jsut a preview and to act as placeholders)
+        overrides.set(scene.render.image_settings, "file_format", "JPEG")
+        overrides.set(scene.render.image_settings, "color_mode", "RGB")
+        overrides.set(scene.render.image_settings, "color_depth", "8")
+
+
+
+    # Replace the world HDRI
+    def find_env_texture_node():
+        if scene.world.use_nodes == False:
+            return None
+
+        for node in scene.world.node_tree.nodes:
+            if type(node) is bpy.types.ShaderNodeTexEnvironment:
+                return node
 
-# Replace the world HDRI
-def find_env_texture_node():
-    if scene.world.use_nodes == False:
         return None
 
-    for node in scene.world.node_tree.nodes:
-        if type(node) is bpy.types.ShaderNodeTexEnvironment:
-            return node
+    timer.mark("world_hdri")
+    world_hdri_filepath = shot_info.get('world_hdri', None)
+    if world_hdri_filepath:
+        # Find the environment texture node
+        env_texture_node = find_env_texture_node()
+        if env_texture_node is None:
+            print("Couldn't set world HDRI; environment texture node not found or nodes not enabled.")
+        else:
+            try:
+                # Loaded images are left in the file; with persistent data the
+                # next shot of a session that uses the same HDRI gets it for free.
+                overrides.set(env_texture_node, "image", bpy.data.images.load(world_hdri_filepath, check_existing = True))
+            except RuntimeError as e:
+                print("FAILED to set world HDRI: %s" % str(e))
+
+    # Override any material node properties.
+    #
+    timer.mark("material_overrides")
+    set_material_node_properties(shot_info.get('material_node_overrides', []), overrides)
+
+    # Run script files
+    #
+    timer.mark("scripts")
+    for script_name in shot_info.get("scripts", []):
+        print("Running script '" + script_name + "'")
+        exec(bpy.data.texts[script_name].as_string())
 
-    return None
+    # Check the render will fit in memory; last, so that it sees the effect of everything above.
+    if shot_info.get("memory_budget_gb") and scene.render.engine == "CYCLES":
+        timer.mark("memory_estimate")
+        apply_memory_budget(scene, shot_info, bpy.path.abspath(scene.render.filepath) + "memory_estimate.json", overrides)
+
+    return scene, shot_info
+
+
+def get_output_node_mutes(scene):
+    """{name: mute} of the scene's File Output nodes; see render_frame()"""
+    if not scene.node_tree:
+        return {}
+    return { node.name: node.mute for node in scene.node_tree.nodes if node.type == 'OUTPUT_FILE' }
+
+def unmute_output_nodes(scene, output_node_mutes):
+    """Put the File Output nodes' mutes back as they were before the first frame
+
+    The addon mutes every File Output node once a render is complete (see
+    blender_addon/__init__.py), so that rendering a still doesn't overwrite the
+    shot's passes; when we render a frame at a time, each frame would
+    otherwise write its passes only for the first.
+    """
+    for (name, mute) in output_node_mutes.items():
+        scene.node_tree.nodes[name].mute = mute
+
+def render_frame(scene, frame, output_node_mutes):
+    """Render one frame to its numbered path, scene.render.frame_path()
+
+    A still render writes to the output path without a frame number, so we
+    save the Render Result ourselves; under a temporary name, so that a half
+    written frame is never taken for a finished one.
+    """
+    unmute_output_nodes(scene, output_node_mutes)
+    scene.frame_set(frame)
+    bpy.ops.render.render(scene = scene.name)
+
+    frame_filepath = scene.render.frame_path(frame = frame)
+    (frame_base, frame_ext) = os.path.splitext(frame_filepath)
+    os.makedirs(os.path.dirname(frame_filepath), exist_ok = True)
+    bpy.data.images["Render Result"].save_render(frame_base + ".tmp" + frame_ext, scene = scene)
+    os.replace(frame_base + ".tmp" + frame_ext, frame_filepath)
+
+def render_frames(scene, frames):
+    """Render the given frames, in the given order, skipping any already on disk
+
+    For "frame_order": "BISECT" (first, last, middle, quarters, ...), so that a
+    half finished render covers the whole shot, and for chunked jobs, where
+    "frame_chunk": [i, k] renders every k-th frame of the order starting at i.
+    """
+    output_node_mutes = get_output_node_mutes(scene)
+    for frame in frames:
+        if os.path.exists(scene.render.frame_path(frame = frame)):
+            continue
+        render_frame(scene, frame, output_node_mutes)
+
+
+#
+# Time-boxed progressive rendering
+#
+# For look-dev, we want the best image we can get in a given time, rather than
+# a given number of samples. With e.g.
+#
+#    "time_budget_seconds": [20, 60, 300, 1800],
+#    "progressive_samples": [16, 64, 256, 1024, 4096]
+#
+# each frame is rendered at 16 samples, then 64, then 256, ... for as long as
+# the next step is expected to finish within the frame's share of the budget
+# (we assume render time is proportional to samples). Each refinement is saved
+# as it completes, as <frame>_s<samples>.<ext>, so reviewers can look at a
+# usable image within seconds. Only once the frame's budget is used up is the
+# last refinement copied to the frame itself; until then the frame doesn't
+# exist, so the render manager and the compositor don't take an unfinished
+# frame for a finished one, and a render that's killed part way through a frame
+# redoes it. The refinements start from scratch each time, so the ladder costs
+# about a third more than rendering the last step on its own.
+#
+# With "progressive_mode": "TIME_LIMIT", each frame is rendered once with the
+# Cycles time limit set to its share of the budget, instead.
+#
+DEFAULT_PROGRESSIVE_SAMPLES = [16, 64, 256, 1024, 4096]
+
+def render_progressive(scene, shot_info, quality_index, overrides):
+    global time_each_render
+    import shutil
+    import time
+
+    time_budget = shot_info["time_budget_seconds"]
+    if isinstance(time_budget, list):
+        time_budget = time_budget[quality_index]
+
+    ladder = sorted(shot_info.get("progressive_samples", DEFAULT_PROGRESSIVE_SAMPLES))
+    mode = shot_info.get("progressive_mode", "LADDER").upper()
+
+    # Only this job's share of the frames, for chunked jobs; see get_frame_order().
+    frames = [ frame for frame in get_frame_order(scene.frame_start, scene.frame_end,
+                                                  shot_info.get("frame_order", "SEQUENTIAL"),
+                                                  shot_info.get("frame_chunk"))
+               if (frame - scene.frame_start) % scene.frame_step == 0
+               and not os.path.exists(scene.render.frame_path(frame = frame)) ]
+    if not frames:
+        print("All frames already rendered")
+        return
+    frame_budget = time_budget / len(frames)
+    output_node_mutes = get_output_node_mutes(scene)
+
+    for frame in frames:
+        scene.frame_set(frame)
+        frame_filepath = scene.render.frame_path(frame = frame)
+
+        if mode == "TIME_LIMIT":
+            overrides.set(scene.cycles, "samples", ladder[-1])
+            overrides.set(scene.cycles, "time_limit", frame_budget)
+            render_frame(scene, frame, output_node_mutes)
+            continue
+
+        # Time the frame as a whole, rather than each step of the ladder.
+        time_each_render = False
+        if current_timer is not None:
+            current_timer.frame_started(frame)
 
-world_hdri_filepath = shot_info.get('world_hdri', None)
-if world_hdri_filepath:
-    # Find the environment texture node
-    env_texture_node = find_env_texture_node()
-    if env_texture_node is None:
-        print("Couldn't set world HDRI; environment texture node not found or nodes not enabled.")
-    else:
         try:
-            node.image = bpy.data.images.load(world_hdri_filepath, check_existing = True)
-        except RuntimeError as e:
-            print("FAILED to set world HDRI: %s" % str(e))
+            start_time = time.time()
+            last = None # (samples, seconds) of the last step
+            (frame_base, frame_ext) = os.path.splitext(frame_filepath)
+            for samples in ladder:
+                if last is not None:
+                    (last_samples, last_seconds) = last
+                    predicted_seconds = last_seconds * samples / last_samples
+                    if time.time() - start_time + predicted_seconds > frame_budget:
+                        break
+
+                overrides.set(scene.cycles, "samples", samples)
+                unmute_output_nodes(scene, output_node_mutes)
+                step_start_time = time.time()
+                bpy.ops.render.render(scene = scene.name)
+                last = (samples, time.time() - step_start_time)
+
+                refinement_filepath = frame_base + ("_s%05d" % samples) + frame_ext
+                bpy.data.images["Render Result"].save_render(refinement_filepath, scene = scene)
+
+                print("Frame %d: %d samples in %.1fs (%.1fs of %.1fs budget used)"
+                      % (frame, samples, last[1], time.time() - start_time, frame_budget))
+
+            # The frame is finished; put the last refinement in place in one go, so
+            # that anyone watching never sees a half written frame.
+            shutil.copyfile(refinement_filepath, frame_base + ".tmp" + frame_ext)
+            os.replace(frame_base + ".tmp" + frame_ext, frame_filepath)
+        finally:
+            time_each_render = True
+
+        if current_timer is not None:
+            current_timer.frame_finished(frame)
+            current_timer.write(current_timings_filepath)
+
+
+# Time each frame, and rewrite the report as each frame finishes, so that
+# there's something to look at if the render is killed part way through.
+# The handlers are installed once and time the frames of whichever shot is
+# being rendered. render_progressive() renders each frame several times, so
+# it times the frames itself.
+current_timer = None
+current_timings_filepath = None
+time_each_render = True
+
+def on_render_pre(scene, *args):
+    if current_timer is not None and time_each_render:
+        current_timer.frame_started(scene.frame_current)
+
+def on_render_post(scene, *args):
+    if current_timer is not None and time_each_render:
+        current_timer.frame_finished(scene.frame_current)
+        current_timer.write(current_timings_filepath)
+
+bpy.app.handlers.render_pre.append(on_render_pre)
+bpy.app.handlers.render_post.append(on_render_post)
+
+
+def render_shot(shot_list_db, shot_category, shot_id, quality, slate_number, timer = None, shot_info_overrides = None):
+    """Set up and render a shot, then undo the changes made for it"""
+    global current_timer, current_timings_filepath
+
+    # Time each phase of the setup, and each frame, so that we can see where the
+    # time goes. See render_timings.py.
+    timer = timer or render_timings.PhaseTimer()
+    overrides = ShotOverrides()
+
+    (scene, shot_info) = setup_shot(shot_list_db, shot_category, shot_id, quality, slate_number, overrides, timer, shot_info_overrides)
+
+    current_timer = timer
+    current_timings_filepath = render_timings.get_timings_filepath(bpy.path.abspath(scene.render.filepath), timer.start_time)
+
+    timer.mark("render")
+    if shot_info.get("time_budget_seconds"):
+        render_progressive(scene, shot_info, get_quality_index(quality), overrides)
+    elif quality.upper() == "SPARSE":
+        # render_manager.py fills in the other frames; see frame_interpolator.py,
+        # which looks for the keyframes at their numbered paths.
+        keyframes = get_sparse_frames(scene.frame_start, scene.frame_end, shot_info.get("sparse_frame_step", 4),
+                                      shot_info.get("frame_chunk"))
+        render_frames(scene, keyframes)
+        missing_keyframes = [ frame for frame in keyframes if not os.path.exists(scene.render.frame_path(frame = frame)) ]
+        if missing_keyframes:
+            print("WARNING: SPARSE keyframes %s not written to \"%s\"" % (format_frame_ranges(missing_keyframes),
+                                                                          scene.render.frame_path(frame = missing_keyframes[0])))
+    elif shot_info.get("frame_order", "SEQUENTIAL").upper() != "SEQUENTIAL" or shot_info.get("frame_chunk"):
+        render_frames(scene, get_frame_order(scene.frame_start, scene.frame_end,
+                                             shot_info.get("frame_order", "SEQUENTIAL"),
+                                             shot_info.get("frame_chunk")))
+    else:
+        bpy.ops.render.render(animation=True, scene = scene.name)
+
+    timer.mark("revert_overrides")
+    overrides.revert()
 
-# Override any material node properties.
-# 
-set_material_node_properties(shot_info.get('material_node_overrides', []))
+    timer.finish()
+    timer.write(current_timings_filepath)
+    print("Timings written to \"%s\"" % current_timings_filepath)
+    current_timer = None
 
-# Run script files
+
+# Parse command line
 #
-for script_name in shot_info.get("scripts", []):
-    print("Running script '" + script_name + "'")
-    exec(bpy.data.texts[script_name].as_string())
+argv = sys.argv
+argv = argv[argv.index("--") + 1:]  # get all args after "--"
+
+# Pull out the KEY=VALUE shot info overrides
+shot_info_overrides = parse_shot_info_overrides([ arg for arg in argv if "=" in arg ])
+argv = [ arg for arg in argv if "=" not in arg ]
+
+# Don' guess the slate number
+#if len(argv) == 4:
+#    [shot_list_db_filepath, shot_category, shot_id, quality] = argv
+#    slate_number = None
+if len(argv) == 5:
+    [shot_list_db_filepath, shot_category, shot_id, quality, slate_number ] = argv
+    shots = [(shot_category, shot_id, slate_number)]
+elif len(argv) >= 4 and argv[1].upper() == "SESSION":
+    [shot_list_db_filepath, _, quality] = argv[:3]
+    shots = [ tuple(shot.split("/")) for shot in argv[3:] ]
+    if not all(len(shot) == 3 for shot in shots):
+        raise ValueError("Session shots must be given as <category>/<id>/<slate>")
+else:
+    raise ValueError("Not enough command line parameters supplied to render_script.py")
+
+timer = render_timings.PhaseTimer()
+timer.mark("load_shot_list")
+shot_list_db = shot_list_db.ShotListDb.from_file(shot_list_db_filepath)
+
+# Keep the BVH, textures etc. in memory between the shots of a session; the
+# shots share a blend file and usually differ only by a few settings.
+if len(shots) > 1:
+    for scene in bpy.data.scenes:
+        scene.render.use_persistent_data = True
 
-bpy.ops.render.render(animation=True)
-    
+for (shot_category, shot_id, slate_number) in shots:
+    # The shot list loading time is counted against the first shot.
+    render_shot(shot_list_db, shot_category, shot_id, quality, slate_number, timer, shot_info_overrides)
+    timer = None
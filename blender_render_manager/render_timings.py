@@ -0,0 +1,154 @@
+"""Render timings
+
+Time the phases of render_script.py (loading the shot list, hiding
+collections, setting up render pass nodes, loading the HDRI, running scripts,
+...) and each rendered frame, and write the results to a JSON report next to
+the frames; e.g.
+
+  Renders/Title/slate_3/film_1_3_timings_20230412_093000.json
+
+Each run of render_script.py writes its own report, so a slate that was
+rendered in several goes (or by several machines) has several reports.
+render_manager.py TIMINGS sums them up across shots.
+
+Nothing in here uses bpy, so that render_manager.py can load the reports.
+
+"""
+import json
+import os
+import re
+import socket
+import time
+
+TIMINGS_FILENAME_PATTERN = re.compile("timings_([0-9]{8}_[0-9]{6})(_[0-9]+)?\\.json")
+
+
+def get_timings_filepath(render_filestub, start_time):
+    """Path of the timing report of a render started at 'start_time'"""
+    return "%stimings_%s_%d.json" % (render_filestub,
+                                     time.strftime("%Y%m%d_%H%M%S", time.localtime(start_time)),
+                                     os.getpid())
+
+
+class PhaseTimer:
+    """Time a sequence of named phases, plus the frames of the render
+
+    Phases are marked in order; each call to mark() ends the previous phase:
+
+        timer = PhaseTimer()
+        timer.mark("load_shot_list")
+        ...
+        timer.mark("hide_collections")
+        ...
+        timer.finish()
+
+    """
+    def __init__(self, info = None):
+        self.info = dict(info or {})
+        self.start_time = time.time()
+        self.phases = []
+        self.frames = []
+
+        self._phase_name = None
+        self._phase_start = None
+        self._frame = None
+        self._frame_start = None
+
+    def mark(self, phase_name):
+        """End the current phase (if any) and start the one called 'phase_name'"""
+        now = time.perf_counter()
+        self._end_phase(now)
+        self._phase_name = phase_name
+        self._phase_start = now
+
+    def _end_phase(self, now):
+        if self._phase_name is not None:
+            self.phases.append({"name": self._phase_name, "seconds": round(now - self._phase_start, 3)})
+            self._phase_name = None
+
+    def frame_started(self, frame_number):
+        self._frame = frame_number
+        self._frame_start = time.perf_counter()
+
+    def frame_finished(self, frame_number):
+        if self._frame_start is None or frame_number != self._frame:
+            return
+        self.frames.append({"frame": frame_number, "seconds": round(time.perf_counter() - self._frame_start, 3)})
+        self._frame_start = None
+
+    def finish(self):
+        self._end_phase(time.perf_counter())
+
+    def report(self):
+        frame_seconds = [frame["seconds"] for frame in self.frames]
+        return {
+            **self.info,
+            "host": socket.gethostname(),
+            "pid": os.getpid(),
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.start_time)),
+            "elapsed_seconds": round(time.time() - self.start_time, 3),
+            "phases": self.phases,
+            "frames": self.frames,
+            "frame_summary": summarise_seconds(frame_seconds),
+        }
+
+    def write(self, filepath):
+        """Write the report; via a temporary file, so that readers never see half of it"""
+        os.makedirs(os.path.dirname(filepath) or ".", exist_ok = True)
+        tmp_filepath = filepath + ".tmp"
+        with open(tmp_filepath, "w") as f:
+            json.dump(self.report(), f, indent = 2)
+        os.replace(tmp_filepath, filepath)
+
+
+def summarise_seconds(seconds):
+    """count/total/mean/median/max of a list of durations"""
+    if not seconds:
+        return {"count": 0, "total": 0.0, "mean": None, "median": None, "max": None}
+    ordered = sorted(seconds)
+    return {
+        "count": len(ordered),
+        "total": round(sum(ordered), 3),
+        "mean": round(sum(ordered) / len(ordered), 3),
+        "median": ordered[len(ordered) // 2],
+        "max": ordered[-1],
+    }
+
+
+def load_timing_reports(render_filestub):
+    """Load every timing report written for the frames of 'render_filestub'"""
+    directory, prefix = os.path.split(render_filestub)
+    reports = []
+
+    try:
+        filenames = sorted(os.listdir(directory or "."))
+    except FileNotFoundError:
+        return reports
+
+    for filename in filenames:
+        if filename.startswith(prefix) and TIMINGS_FILENAME_PATTERN.fullmatch(filename[len(prefix):]):
+            try:
+                with open(os.path.join(directory, filename)) as f:
+                    reports.append(json.load(f))
+            except (OSError, ValueError) as e:
+                print("Skipping unreadable timing report \"%s\": %s" % (filename, e))
+
+    return reports
+
+
+def aggregate_timing_reports(reports):
+    """Combine the reports of one or more renders
+
+    Returns the time spent in each phase (summed over the reports, in the
+    order that the phases first appear) and a summary of the frame times.
+    """
+    phase_totals = {}
+    for report in reports:
+        for phase in report.get("phases", []):
+            phase_totals[phase["name"]] = phase_totals.get(phase["name"], 0.0) + phase["seconds"]
+
+    return {
+        "runs": len(reports),
+        "phases": { name: round(seconds, 3) for (name, seconds) in phase_totals.items() },
+        "frames": summarise_seconds([frame["seconds"] for report in reports for frame in report.get("frames", [])]),
+    }
@@ -0,0 +1,81 @@
+"""Tests of frame_interpolator.py against synthetic SPARSE renders
+
+The keyframes are written where render_script.py writes them, at Blender's
+numbered frame paths, <filestub>NNNN.<ext>; e.g. test_1_1_0005.png.
+
+  python -m unittest discover -s blender_render_manager/tests
+
+"""
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import image_io
+import shot_list_db
+import frame_interpolator
+from common import get_render_filestub
+
+
+@unittest.skipUnless(image_io.is_available(), "needs OpenCV")
+class InterpolateShotTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        # Cross-fade, whatever is installed, so that the frames are known.
+        self.saved_ffmpeg = os.environ.get("FFMPEG")
+        os.environ["FFMPEG"] = os.path.join(self.tmp_dir, "no_ffmpeg")
+
+        shot = {
+            "category": "test", "id": 1, "shot_name": "test_shot",
+            "frame_start": 1, "frame_end": 9, "sparse_frame_step": 4,
+            "render_file_format": "PNG", "render_color_depth": "16",
+        }
+        with open(os.path.join(self.tmp_dir, "shot_list.json"), "w") as f:
+            json.dump({"project_root": self.tmp_dir, "render_root": self.tmp_dir, "shots": [shot]}, f)
+        self.db = shot_list_db.ShotListDb.from_file(os.path.join(self.tmp_dir, "shot_list.json"))
+        self.filestub = get_render_filestub(self.db, self.db.get_shot_info("test", "1"), "test", "1", "1")
+
+    def tearDown(self):
+        if self.saved_ffmpeg is None:
+            del os.environ["FFMPEG"]
+        else:
+            os.environ["FFMPEG"] = self.saved_ffmpeg
+        shutil.rmtree(self.tmp_dir)
+
+    def frame_filepath(self, frame):
+        return self.filestub + ("%04d" % frame) + ".png"
+
+    def write_keyframes(self, frames):
+        os.makedirs(os.path.dirname(self.filestub), exist_ok = True)
+        for frame in frames:
+            image_io.write_image(self.frame_filepath(frame), np.full((4, 6, 4), frame / 10.0, dtype = np.float32),
+                                 file_format = "PNG", color_depth = "16")
+
+    def test_keyframes_at_numbered_paths_are_interpolated(self):
+        self.write_keyframes([1, 5, 9])
+
+        self.assertEqual(frame_interpolator.interpolate_shot(self.db, "test", "1", "1"), 6)
+        for frame in range(1, 10):
+            self.assertTrue(os.path.exists(self.frame_filepath(frame)), "frame %d" % frame)
+
+        # Half way between frames 1 and 5
+        pixels = image_io.read_image(self.frame_filepath(3))
+        self.assertLessEqual(float(np.abs(pixels - 0.3).max()), 1e-3)
+
+    def test_waits_for_missing_keyframes(self):
+        # An un-numbered still, as a still render would write, isn't a keyframe.
+        self.write_keyframes([1, 9])
+        image_io.write_image(self.filestub + ".png", np.zeros((4, 6, 4), dtype = np.float32), file_format = "PNG", color_depth = "16")
+
+        self.assertEqual(frame_interpolator.interpolate_shot(self.db, "test", "1", "1"), 0)
+        self.assertFalse(os.path.exists(self.frame_filepath(3)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,177 @@
+"""Tests of numpy_compositor.py against small synthetic frames
+
+Each node is checked against a reference frame worked out independently of
+the node's implementation, to within a tolerance; then whole shots are
+composited from synthetic frames on disk.
+
+  python -m unittest discover -s blender_render_manager/tests
+
+"""
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import image_io
+import numpy_compositor
+from common import parse_frame_ranges
+
+TOLERANCE = 1e-4
+
+# 16-bit PNG quantisation
+FILE_TOLERANCE = 1.0 / 65535.0 + 1e-6
+
+
+def synthetic_frame(width = 8, height = 6, seed = 0):
+    """A small RGBA frame of smooth gradients plus noise, with values in 0..1"""
+    rng = np.random.default_rng(seed)
+    (y, x) = np.mgrid[0:height, 0:width].astype(np.float32)
+    pixels = np.empty((height, width, 4), dtype = np.float32)
+    pixels[:, :, 0] = x / max(1, width - 1)
+    pixels[:, :, 1] = y / max(1, height - 1)
+    pixels[:, :, 2] = 0.5 * rng.random((height, width))
+    pixels[:, :, 3] = 0.5 + 0.5 * rng.random((height, width))
+    return pixels
+
+
+class NodeTests(unittest.TestCase):
+    def assertClose(self, actual, expected, tolerance = TOLERANCE):
+        self.assertEqual(actual.shape, expected.shape)
+        self.assertLessEqual(float(np.abs(actual - expected).max()), tolerance)
+
+    def test_exposure_scales_colour_not_alpha(self):
+        pixels = synthetic_frame()
+        reference = pixels.copy()
+        reference[:, :, 0:3] *= 2.0
+
+        self.assertClose(numpy_compositor.exposure(pixels.copy(), exposure = 1.0), reference)
+
+    def test_soften_leaves_flat_frame_alone(self):
+        pixels = np.full((6, 8, 4), 0.25, dtype = np.float32)
+        self.assertClose(numpy_compositor.soften(pixels, factor = 1.0), pixels)
+
+    def test_soften_matches_3x3_kernel_inside_frame(self):
+        pixels = synthetic_frame()
+        kernel = np.outer([1.0, 2.0, 1.0], [1.0, 2.0, 1.0]) / 16.0
+
+        reference = pixels.copy()
+        for y in range(1, pixels.shape[0] - 1):
+            for x in range(1, pixels.shape[1] - 1):
+                reference[y, x] = np.tensordot(kernel, pixels[y - 1:y + 2, x - 1:x + 2], axes = ([0, 1], [0, 1]))
+
+        softened = numpy_compositor.soften(pixels, factor = 1.0)
+        self.assertClose(softened[1:-1, 1:-1], reference[1:-1, 1:-1])
+
+    def test_gaussian_blur_matches_reference(self):
+        # A single bright pixel spreads into the filter's own (normalised) kernel;
+        # far enough from the edges that renormalisation there doesn't come into it.
+        pixels = np.zeros((15, 15, 4), dtype = np.float32)
+        pixels[7, 7] = 1.0
+
+        radius = 3
+        x = np.arange(-radius, radius + 1, dtype = np.float32)
+        weights = np.exp(-0.5 * (3.0 * x / radius) ** 2)
+        weights /= weights.sum()
+        reference = np.zeros_like(pixels)
+        reference[4:11, 4:11] = np.outer(weights, weights)[:, :, np.newaxis]
+
+        blurred = numpy_compositor.gaussian_blur(pixels, size_x = radius, size_y = radius, size = 1.0)
+        self.assertClose(blurred, reference)
+
+    def test_zero_lens_distortion_is_identity(self):
+        pixels = synthetic_frame()
+        self.assertClose(numpy_compositor.lens_distortion(pixels, distortion = 0.0, dispersion = 0.0), pixels)
+
+    def test_resize_to_quality_resolution(self):
+        shot_info = {"target_resolution": "8x6", "resolution_percentage": [50, 50, 100, 100]}
+        self.assertEqual(numpy_compositor.get_output_resolution(shot_info, "LOW"), (4, 3))
+        self.assertEqual(numpy_compositor.get_output_resolution(shot_info, "FINAL"), (8, 6))
+
+        # Shrinking by 2 averages 2x2 blocks.
+        pixels = synthetic_frame()
+        reference = pixels.reshape(3, 2, 4, 2, 4).mean(axis = (1, 3))
+        self.assertClose(numpy_compositor.resize(pixels, 4, 3), reference)
+
+    def test_unsupported_chain_is_refused(self):
+        self.assertFalse(numpy_compositor.is_chain_supported({"Glare": {"mute": False}}))
+        self.assertTrue(numpy_compositor.is_chain_supported({"Exposure": {"exposure": 1.0}}))
+
+
+@unittest.skipUnless(image_io.is_available(), "needs OpenCV")
+class ShotTests(unittest.TestCase):
+    NUM_FRAMES = 3
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def make_shot(self, quality = "FINAL", frames_wanted = None, **shot_info):
+        """Write a shot list and synthetic rendered frames; returns (shot, source frames)"""
+        shot = {
+            "category": "test", "id": 1, "shot_name": "test_shot",
+            "frame_start": 1, "frame_end": self.NUM_FRAMES,
+            "render_file_format": "PNG", "composite_file_format": "PNG", "composite_color_depth": "16",
+            "target_resolution": "8x6", "resolution_percentage": [50, 50, 100, 100],
+            "compositor_chain": {"Exposure": {"exposure": 1.0}},
+        }
+        shot.update(shot_info)
+        shot_list_filepath = os.path.join(self.tmp_dir, "shot_list.json")
+        with open(shot_list_filepath, "w") as f:
+            json.dump({"project_root": self.tmp_dir, "render_root": self.tmp_dir, "shots": [shot]}, f)
+
+        numpy_shot = numpy_compositor.Shot(shot_list_filepath, "test", "1", quality, "1", frames_wanted)
+        frames = {}
+        for frame in range(1, self.NUM_FRAMES + 1):
+            frames[frame] = synthetic_frame(seed = frame) * 0.5
+            image_io.write_image(numpy_shot.incoming_frame_filepath(frame), frames[frame], file_format = "PNG", color_depth = "16")
+        return (numpy_shot, frames)
+
+    def test_composite_shot_matches_reference_frames(self):
+        (shot, frames) = self.make_shot()
+        self.assertTrue(numpy_compositor.composite_shot(shot, num_processes = 1))
+
+        for (frame, pixels) in frames.items():
+            reference = pixels.copy()
+            reference[:, :, 0:3] = np.clip(reference[:, :, 0:3] * 2.0, 0.0, 1.0)
+            composited = image_io.read_image(shot.outgoing_frame_filepath(frame))
+            self.assertLessEqual(float(np.abs(composited - reference).max()), 2 * FILE_TOLERANCE)
+
+        # And VERIFY agrees with itself.
+        self.assertTrue(numpy_compositor.verify_shot(shot, tolerance = FILE_TOLERANCE))
+
+    def test_composite_shot_at_low_quality_writes_low_resolution(self):
+        (shot, _) = self.make_shot(quality = "LOW")
+        self.assertTrue(numpy_compositor.composite_shot(shot, num_processes = 1))
+        self.assertEqual(image_io.read_image(shot.outgoing_frame_filepath(1)).shape, (3, 4, 4))
+
+    def test_composite_shot_with_frame_ranges_does_just_those_frames(self):
+        # e.g. the frames used in the cut; frame 2 is never rendered, so waiting for it would never end.
+        (shot, _) = self.make_shot(frames_wanted = parse_frame_ranges("1,3"))
+        os.remove(shot.incoming_frame_filepath(2))
+
+        self.assertTrue(numpy_compositor.composite_shot(shot, num_processes = 1))
+        self.assertTrue(os.path.exists(shot.outgoing_frame_filepath(1)))
+        self.assertFalse(os.path.exists(shot.outgoing_frame_filepath(2)))
+        self.assertTrue(os.path.exists(shot.outgoing_frame_filepath(3)))
+
+    def test_composite_shot_gives_up_on_unreadable_frame(self):
+        (shot, _) = self.make_shot(numpy_compositor_max_attempts = 1)
+        with open(shot.incoming_frame_filepath(2), "wb") as f:
+            f.write(b"not a PNG")
+
+        self.assertFalse(numpy_compositor.composite_shot(shot, num_processes = 1))
+        self.assertTrue(os.path.exists(shot.outgoing_frame_filepath(1)))
+        self.assertFalse(os.path.exists(shot.outgoing_frame_filepath(2)))
+        self.assertTrue(os.path.exists(shot.outgoing_frame_filepath(3)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,93 @@
+"""Tile stitcher
+
+Stitch the tiles of a tiled render back into whole frames.
+
+A shot with "tiles": [columns, rows] in the shot info is rendered as
+columns x rows jobs, each of which renders one region of the frame with
+render_script.py (see render_manager.build_tiled_shot()). The tiles are not
+cropped to their region, so each tile file is a full size frame which is
+empty outside its region; that way, the stitcher can work out the regions
+from the size of the tiles and doesn't depend on the render resolution
+settings.
+
+  Renders/Title/slate_3/tiles/film_1_3_tile_0_0001.exr
+  Renders/Title/slate_3/tiles/film_1_3_tile_1_0001.exr
+  ...
+  -> Renders/Title/slate_3/film_1_3_0001.exr
+
+Render passes of tiled renders are left in the tiles directory; only the
+main image is stitched.
+
+"""
+import math
+import logging
+
+import numpy as np
+
+import image_io
+from common import *
+
+
+def get_tile_pixel_rect(width, height, tile_index, columns, rows):
+    """Rows and columns of the pixels of a tile; (y0, y1, x0, x1), top to bottom
+
+    Blender rounds the render border down to whole pixels, and so do we, so
+    that the tiles meet without gaps or overlaps.
+    """
+    (min_x, max_x, min_y, max_y) = get_tile_border(tile_index, columns, rows)
+    return (height - math.floor(max_y * height), height - math.floor(min_y * height),
+            math.floor(min_x * width), math.floor(max_x * width))
+
+
+def stitch_frame(tile_filepaths, columns, rows, output_filepath, output_settings):
+    """Paste the region of each tile into one frame and write it
+
+    tile_filepaths:   One frame of each tile, in tile order.
+    output_settings:  Keyword arguments for image_io.write_image()
+    """
+    frame = None
+    for (tile_index, tile_filepath) in enumerate(tile_filepaths):
+        tile = image_io.read_image(tile_filepath)
+        if frame is None:
+            frame = np.zeros(tile.shape, dtype = np.float32)
+        elif tile.shape != frame.shape:
+            raise ValueError("Tile \"%s\" is %dx%d; expected %dx%d"
+                             % (tile_filepath, tile.shape[1], tile.shape[0], frame.shape[1], frame.shape[0]))
+
+        (y0, y1, x0, x1) = get_tile_pixel_rect(frame.shape[1], frame.shape[0], tile_index, columns, rows)
+        frame[y0:y1, x0:x1] = tile[y0:y1, x0:x1]
+        del tile
+
+    image_io.write_image(output_filepath, frame, **output_settings)
+
+
+def stitch_shot(shot_list_db, shot_category, shot_id, slate):
+    """Stitch every frame of a tiled shot whose tiles are all rendered. Returns the number of frames stitched"""
+    shot_info = shot_list_db.get_shot_info(shot_category, shot_id)
+    (columns, rows) = shot_info["tiles"]
+
+    render_filestub = get_render_filestub(shot_list_db, shot_info, shot_category, shot_id, slate)
+    file_format = shot_info.get("render_file_format", "PNG")
+    ext = IMAGE_FILE_EXTENSIONS[file_format]
+
+    output_settings = {
+        "file_format": file_format,
+        "color_depth": shot_info.get("render_color_depth", "16"),
+        "color_mode": shot_info.get("render_color_mode", "RGBA"),
+        "exr_codec": shot_info.get("render_exr_codec", "DWAA"),
+    }
+
+    tile_filestubs = [ get_tile_filestub(render_filestub, tile_index) for tile_index in range(columns * rows) ]
+
+    # Frames that every tile has, but which haven't been stitched yet.
+    complete_frames = set.intersection(*[ scan_frame_numbers(tile_filestub, ext) for tile_filestub in tile_filestubs ])
+    frames_to_stitch = sorted(complete_frames - scan_frame_numbers(render_filestub, ext))
+
+    for frame in frames_to_stitch:
+        logging.info("Stitching frame %d of %s/%s from %d tiles" % (frame, shot_category, shot_id, columns * rows))
+        stitch_frame([ tile_filestub + ("%04d" % frame) + "." + ext for tile_filestub in tile_filestubs ],
+                     columns, rows,
+                     render_filestub + ("%04d" % frame) + "." + ext,
+                     output_settings)
+
+    return len(frames_to_stitch)
@@ -44,17 +44,53 @@ However, the offset relative to the reference audio track is noticable and
 it's easier in post production if you can quickly check that the 
 syncronisation is exact.
 
+Clips are processed in parallel, by a pool of -j/--jobs processes; each
+clip's extraction, timecode reading, remux and audio padding run in order, but
+one clip can be extracting its audio while another is remuxing. Reading from
+the card and writing the output are limited to --io-jobs processes at a time
+each, so that a slow card or disk isn't thrashed by every process at once.
+The output of the tools run for each clip goes to a log next to its temporary
+files (tmp/<clip>.log), and a summary of every clip is printed at the end.
+
 """
-from subprocess import call, run
+from subprocess import call, run, STDOUT
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing
+import contextlib
 import os, sys
 import json
+import time
 import collections
 import argparse
 import traceback
 
 TimecodeData = collections.namedtuple("TimecodeData", "timecode,num_discarded_bits")
 
-def extract_timecode_data(filename):
+ClipResult = collections.namedtuple("ClipResult", "video_filename,success,timecode,seconds,log_filename,error")
+
+MICROSECS_PER_FRAME = 1000000 / 25
+MICROSECS_PER_BIT = MICROSECS_PER_FRAME / 80
+
+# Limits on the processes reading the source clips (the card) and writing the
+# output, at once; set in each worker process by init_worker().
+source_io_semaphore = None
+output_io_semaphore = None
+
+def init_worker(source_semaphore, output_semaphore):
+    global source_io_semaphore, output_io_semaphore
+    source_io_semaphore = source_semaphore
+    output_io_semaphore = output_semaphore
+
+def io_slot(semaphore):
+    """Context manager that holds one of the semaphore's I/O slots, if there's a limit"""
+    return semaphore if semaphore is not None else contextlib.nullcontext()
+
+def call_logged(command, log):
+    """Run a command, sending its output to the clip's log. Returns the return code"""
+    print(command, file = log, flush = True)
+    return call(command, stdout = log, stderr = STDOUT)
+
+def extract_timecode_data(filename, log = sys.stdout):
     """Call ltcdump to get the starting timecode of the given audio file"""
 
     # Convert filename to Windows path
@@ -66,59 +102,32 @@ def extract_timecode_data(filename):
     try:
         ltc_reader_output = json.loads(result.stdout)
     except json.decoder.JSONDecodeError as e:
-        print("Error parsing JSON output from ltcdump:")
-        print()
-        print("Command: " + " ".join(command))
-        print()
-        print(e.doc)
-        print()
-        print(e.msg)
-        print("at line: %d, column %d" % (e.lineno, e.colno))
-        print()
+        print("Error parsing JSON output from ltcdump:", file = log)
+        print(file = log)
+        print("Command: " + " ".join(command), file = log)
+        print(file = log)
+        print(e.doc, file = log)
+        print(file = log)
+        print(e.msg, file = log)
+        print("at line: %d, column %d" % (e.lineno, e.colno), file = log)
+        print(file = log)
         raise
 
 
     if ltc_reader_output['ResultCode'] == 200:
-        print("Found timecode %s in file %s" % (ltc_reader_output['Start'], filename))
+        print("Found timecode %s in file %s" % (ltc_reader_output['Start'], filename), file = log)
         return TimecodeData(ltc_reader_output['Start'],
                             ltc_reader_output['DiscardedBitsAtStart'])
     else:
         return None
 
-def mux(video_filename, audio_filename, timecode, output_filename):
+def mux(video_filename, audio_filename, timecode, output_filename, log = sys.stdout):
     """Mux a video-only file with an audio file and set starting timecode"""
-    status = run(['ffmpeg', '-i', video_filename, 
-                            '-i', audio_filename, 
-                            '-c', 'copy', '-map', '0:0', '-map', '1:0', 
-                            '-timecode', timecode, output_filename ])
-
-
-
-##
-## Main
-##
-parser = argparse.ArgumentParser(description="Remux video files containin timecode audio track")
-parser.add_argument('video_tracks', 
-                    metavar='video-track', 
-                    nargs='+',
-                    help="A list of video tracks to remux")
-parser.add_argument('-a, --audio-track', 
-                    dest='audio_recorder_tracks', 
-                    action='append', 
-                    default=[], 
-                    required=False,
-                    help="A list of audio recorder tracks that are to be padded to match video timecodes"
-                    )
-
-args = parser.parse_args()
+    return call_logged(['ffmpeg', '-i', video_filename, 
+                                  '-i', audio_filename, 
+                                  '-c', 'copy', '-map', '0:0', '-map', '1:0', 
+                                  '-timecode', timecode, output_filename ], log)
 
-video_filenames = args.video_tracks
-audio_recorder_filenames = args.audio_recorder_tracks
-
-if len(video_filenames) == 0:
-    print("No input files given")
-
-ClipFiles = collections.namedtuple("ClipFiles", "video_filename,input_path,left_channel_filename,right_channel_filename,out_path,tmp_path")
 
 class Filename:
     def __init__(self, path, name, extension):
@@ -142,135 +151,197 @@ class Filename:
     def fq_name(self):
         return os.path.join(self._path, self._name + self._extension)
 
-clips = []
-failed_video_filenames = []
 
-for video_filename in video_filenames:
+def process_clip(video_filename, audio_recorder_filenames):
+    """Extract the timecode of one clip, remux it and pad the audio recorder tracks to match
+
+    Runs in a worker process. Returns a ClipResult.
+    """
+    start_time = time.time()
+
     # Parse filename to path / filename . extension
     path, filename = os.path.split(video_filename)
     name, extension = os.path.splitext(filename)
     video_filename_obj = Filename(path, name, extension)
 
-    # Create temp and output directories..
+    # Create temp and output directories; other workers may be doing the same.
     tmp_path = os.path.join(video_filename_obj.path, "tmp")
-    try:
-        os.mkdir(tmp_path)
-    except FileExistsError:
-        pass
-    
+    os.makedirs(tmp_path, exist_ok = True)
     out_path = os.path.join(video_filename_obj.path, "out")
-    try:
-        os.mkdir(out_path)
-    except FileExistsError:
-        pass
-
-
-    # Extract both audio channels
-    #
-    left_channel_filename = os.path.join(tmp_path, video_filename_obj.name + '-left.wav')
-    right_channel_filename = os.path.join(tmp_path, video_filename_obj.name + '-right.wav')
-
-    returncode = call(['ffmpeg', '-i', video_filename, 
-                             '-vn',
-                             '-map_channel', '0.1.0', left_channel_filename, 
-                             '-map_channel', ' 0.1.1', right_channel_filename])
-    
-    if returncode != 0:
-        failed_video_filenames.append(video_filename)
-        continue
-
-    clips.append(ClipFiles(video_filename_obj, path, left_channel_filename, right_channel_filename,out_path,tmp_path))
-
-
-# Extract timecode and remux the audio + video
-#
-for clip in clips:
-    timecode_datas = [ extract_timecode_data(clip.left_channel_filename), 
-                       extract_timecode_data(clip.right_channel_filename) 
-                  ]
-
-
-    try:
-        if not any(timecode_datas):
-            raise SystemError("No timecodes found in file");
-        elif all(timecode_datas):
-            raise SystemError("No audio found in file");
-        else:
-            if timecode_datas[0].timecode:
+    os.makedirs(out_path, exist_ok = True)
+
+    log_filename = os.path.join(tmp_path, video_filename_obj.name + '.log')
+    timecode = None
+    errors = []
+
+    with open(log_filename, "w") as log:
+        try:
+            # Extract both audio channels
+            #
+            left_channel_filename = os.path.join(tmp_path, video_filename_obj.name + '-left.wav')
+            right_channel_filename = os.path.join(tmp_path, video_filename_obj.name + '-right.wav')
+
+            with io_slot(source_io_semaphore):
+                returncode = call_logged(['ffmpeg', '-i', video_filename, 
+                                                    '-vn',
+                                                    '-map_channel', '0.1.0', left_channel_filename, 
+                                                    '-map_channel', ' 0.1.1', right_channel_filename], log)
+            if returncode != 0:
+                raise SystemError("Failed to extract audio channels")
+
+            # Extract timecode and remux the audio + video
+            #
+            timecode_datas = [ extract_timecode_data(left_channel_filename, log), 
+                               extract_timecode_data(right_channel_filename, log) 
+                          ]
+
+            if not any(timecode_datas):
+                raise SystemError("No timecodes found in file");
+            elif all(timecode_datas):
+                raise SystemError("No audio found in file");
+
+            if timecode_datas[0] and timecode_datas[0].timecode:
                 timecode_data = timecode_datas[0]
-                audio_filename = clip.right_channel_filename
+                audio_filename = right_channel_filename
             else:
                 timecode_data = timecode_datas[1]
-                audio_filename = clip.left_channel_filename
+                audio_filename = left_channel_filename
+            timecode = timecode_data.timecode
 
-            output_filename_stub =  "OUT_" + clip.video_filename.name 
-            output_filename = os.path.join(clip.out_path, 
-                                           output_filename_stub + clip.video_filename.extension)
+            output_filename_stub =  "OUT_" + video_filename_obj.name 
+            output_filename = os.path.join(out_path, 
+                                           output_filename_stub + video_filename_obj.extension)
 
-            mux(clip.video_filename.fq_name, audio_filename, timecode_data.timecode, output_filename) 
+            with io_slot(output_io_semaphore):
+                returncode = mux(video_filename_obj.fq_name, audio_filename, timecode, output_filename, log) 
+            if returncode != 0:
+                raise SystemError("Failed to remux video")
 
 
             ##
             ## Trim audio files for this video
             ##
-            MICROSECS_PER_FRAME = 1000000 / 25
-            MICROSECS_PER_BIT = MICROSECS_PER_FRAME / 80
             us_to_pad = int(timecode_data.num_discarded_bits * MICROSECS_PER_BIT)
             for audio_recorder_filename_in in audio_recorder_filenames:
                 audio_recorder_path, audio_recorder_name = os.path.split(audio_recorder_filename_in)
 
                 audio_recorder_filename_out = os.path.join(
-                                                  clip.tmp_path, 
+                                                  tmp_path, 
                                                   output_filename_stub + "__" + audio_recorder_name)
 
-
-                print(["pad_wav", 
-                                   audio_recorder_filename_in, 
-                                   audio_recorder_filename_out, 
-                                   '--microseconds', str(us_to_pad) ])
-
-                returncode = call(["pad_wav", 
-                                   audio_recorder_filename_in, 
-                                   audio_recorder_filename_out, 
-                                   '--microseconds', str(us_to_pad) ])
-                if returncode != 0:
-                    print("ERROR: Failed to pad audio file %s for video %s" % (audio_recorder_filename_in, video_filename),
-                           file = sys.stderr)
-
-
                 ## Copy metadate (including timecode from origianl WAV file
                 ##
-                riff_merge_filename_out = os.path.join(clip.out_path, 
+                riff_merge_filename_out = os.path.join(out_path, 
                                                        output_filename_stub + "__" + audio_recorder_name)
-                print(["riff_merge", 
-                                   audio_recorder_filename_in, 
-                                   audio_recorder_filename_out, 
-                                   riff_merge_filename_out,
-                                   ])
-
-                returncode = call(["riff_merge", 
-                                   audio_recorder_filename_in, 
-                                   audio_recorder_filename_out, 
-                                   riff_merge_filename_out,
-                                   ])
-                if returncode != 0:
-                    print("ERROR: Failed to pad audio file %s for video %s" % (audio_recorder_filename_in, video_filename),
-                           file = sys.stderr)
-                
-
-    except Exception as e:  
-        failed_video_filenames.append(clip.video_filename.fq_name)
-
-        print("ERROR: ",  e, file=sys.stderr)
-        print(traceback.format_exc(), file=sys.stderr)
-
-
-print()
-if len(failed_video_filenames) == 0:
-    print("All files processed successfully")
-else:
-    print("FAILED TO PROCESS THESE FILES: " + ",".join(failed_video_filenames))
-
 
+                with io_slot(output_io_semaphore):
+                    returncode = call_logged(["pad_wav", 
+                                              audio_recorder_filename_in, 
+                                              audio_recorder_filename_out, 
+                                              '--microseconds', str(us_to_pad) ], log)
+                    if returncode != 0:
+                        errors.append("Failed to pad audio file %s" % audio_recorder_filename_in)
+                        continue
+
+                    returncode = call_logged(["riff_merge", 
+                                              audio_recorder_filename_in, 
+                                              audio_recorder_filename_out, 
+                                              riff_merge_filename_out,
+                                              ], log)
+                    if returncode != 0:
+                        errors.append("Failed to copy metadata to audio file %s" % riff_merge_filename_out)
+
+        except Exception as e:  
+            errors.append(str(e))
+            print("ERROR: ",  e, file = log)
+            print(traceback.format_exc(), file = log)
+
+        for error in errors:
+            print("ERROR: " + error, file = log)
+
+    return ClipResult(video_filename, not errors, timecode, time.time() - start_time, log_filename, "; ".join(errors))
+
+
+def print_summary(results, elapsed_time):
+    print()
+    print("%-40s %-8s %-12s %8s  %s" % ("Clip", "Status", "Timecode", "Time (s)", "Log / error"))
+    for result in results:
+        print("%-40s %-8s %-12s %8.1f  %s" % (os.path.basename(result.video_filename),
+                                              "OK" if result.success else "FAILED",
+                                              result.timecode or "-",
+                                              result.seconds,
+                                              result.log_filename if result.success else result.error + " (see " + result.log_filename + ")"))
+
+    failed_video_filenames = [ result.video_filename for result in results if not result.success ]
+    print()
+    print("%d clips in %.1fs" % (len(results), elapsed_time))
+    if len(failed_video_filenames) == 0:
+        print("All files processed successfully")
+    else:
+        print("FAILED TO PROCESS THESE FILES: " + ",".join(failed_video_filenames))
 
 
+##
+## Main
+##
+def main():
+    parser = argparse.ArgumentParser(description="Remux video files containin timecode audio track")
+    parser.add_argument('video_tracks', 
+                        metavar='video-track', 
+                        nargs='+',
+                        help="A list of video tracks to remux")
+    parser.add_argument('-a, --audio-track', 
+                        dest='audio_recorder_tracks', 
+                        action='append', 
+                        default=[], 
+                        required=False,
+                        help="A list of audio recorder tracks that are to be padded to match video timecodes"
+                        )
+    parser.add_argument('-j', '--jobs',
+                        type=int,
+                        default=min(4, os.cpu_count() or 1),
+                        help="Number of clips to process at once (default: %(default)s)")
+    parser.add_argument('--io-jobs',
+                        type=int,
+                        default=2,
+                        help="Number of clips reading from the source, and writing the output, at once (default: %(default)s)")
+
+    args = parser.parse_args()
+
+    video_filenames = args.video_tracks
+    audio_recorder_filenames = args.audio_recorder_tracks
+
+    if len(video_filenames) == 0:
+        print("No input files given")
+
+    start_time = time.time()
+    results = {}
+
+    if args.jobs <= 1:
+        for video_filename in video_filenames:
+            print("Processing %s" % video_filename)
+            results[video_filename] = process_clip(video_filename, audio_recorder_filenames)
+    else:
+        source_semaphore = multiprocessing.Semaphore(max(1, args.io_jobs))
+        output_semaphore = multiprocessing.Semaphore(max(1, args.io_jobs))
+        with ProcessPoolExecutor(max_workers = args.jobs,
+                                 initializer = init_worker,
+                                 initargs = (source_semaphore, output_semaphore)) as executor:
+            futures = { executor.submit(process_clip, video_filename, audio_recorder_filenames): video_filename
+                        for video_filename in video_filenames }
+            for future in as_completed(futures):
+                video_filename = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    # The worker itself failed, e.g. couldn't create its directories.
+                    result = ClipResult(video_filename, False, None, 0.0, "-", str(e))
+                results[video_filename] = result
+                print("%s %s (%d of %d)" % ("Processed" if result.success else "FAILED", video_filename, len(results), len(futures)))
+
+    print_summary([ results[video_filename] for video_filename in video_filenames ], time.time() - start_time)
+    return 0 if all(result.success for result in results.values()) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())